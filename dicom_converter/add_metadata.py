@@ -9,6 +9,8 @@ import os
 import pydicom
 import argparse
 
+from utils.large_dicom import LARGE_FILE_SIZE, PIXEL_DATA_TAG, is_large_file, read_header, save_with_pixel_data_of
+
 ## Add a new label 'Indication Label' for the classificatiion task
 def add_label_in_dcm(dcmFile, label, tag):
     '''
@@ -31,7 +33,35 @@ def add_label_in_dcm(dcmFile, label, tag):
     dcmFile.add_new(tag, "SH", label) # [0x0014,0x2016] = Indication Label
     return dcmFile
 
-def go_through_folder(folderPath, label, tag):
+def add_label_in_large_dcm(filePath, label, tag):
+    '''
+    Add the label metadata in a large DICOM file without loading its pixel data,
+    which is copied by blocks (cf utils.large_dicom)
+
+    Parameters
+    ----------
+    filePath : string
+        /.../filename.dcm, replaced by the labelled file
+    label : short string
+        ex: '0', '1'
+    tag : tuple of two elements
+        DICOM tag, must be in hexagonal format. ex: (0x10,0x20)
+
+    Returns
+    -------
+    done : True/False
+        False if the pixel data cannot be copied as is (deflated file or tag after
+        PixelData), the file is then unchanged.
+    '''
+    with open(filePath, 'rb') as fp:
+        dcmFile, pixelData = read_header(fp)
+    if pixelData is None or pydicom.tag.Tag(tag) >= PIXEL_DATA_TAG:
+        return False
+    newDcmFile = add_label_in_dcm(dcmFile, label, tag)
+    save_with_pixel_data_of(newDcmFile, filePath, pixelData[0], filePath)
+    return True
+
+def go_through_folder(folderPath, label, tag, largeFileSize=LARGE_FILE_SIZE):
     '''
     Go trough the folder to add the label tag metadata
 
@@ -43,6 +73,9 @@ def go_through_folder(folderPath, label, tag):
         ex: '0', '1'
     tag : tuple of two elements
         DICOM tag, must be in hexagonal format. ex: (0x10,0x20)
+    largeFileSize : int, optional
+        Size in bytes from which the pixel data of a file is not loaded, cf
+        add_label_in_large_dcm. None to always load the whole file. The default is LARGE_FILE_SIZE.
     
     Returns
     -------
@@ -51,6 +84,9 @@ def go_through_folder(folderPath, label, tag):
     for file in os.listdir(folderPath):
         #print('file', file)
 
+        if is_large_file(folderPath+file, largeFileSize) and add_label_in_large_dcm(folderPath+file, label, tag):
+            continue
+
         dcmFile = pydicom.dcmread(folderPath+file)
         newDcmFile = add_label_in_dcm(dcmFile, label, tag)
         newDcmFile.save_as(folderPath+file)
@@ -60,9 +96,10 @@ if __name__ == "__main__":
     parser.add_argument('inputFolder', help = 'Path to the input Folder')
     parser.add_argument('label', help='label to classify')
     parser.add_argument('tag', help = 'Tag to add in the DCM file')
+    parser.add_argument('--largeFileSize', type=int, default=LARGE_FILE_SIZE // (1024 * 1024), help = 'Size in MB from which the pixel data of a file is copied by blocks instead of being loaded')
     args = parser.parse_args()
     
-    go_through_folder(args.inputFolder, args.label, eval(args.tag))
+    go_through_folder(args.inputFolder, args.label, eval(args.tag), args.largeFileSize * 1024 * 1024)
     
 
 
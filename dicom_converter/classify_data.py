@@ -11,8 +11,10 @@ import json
 import shutil
 import argparse
 
+from utils.header_index import build_index
 
-def get_tag_from_json(json_path,tag):
+
+def get_tag_from_json(json_path,tag,index=None):
     '''
     Get tag value from .json fiel containing DICOM metadata
 
@@ -22,19 +24,27 @@ def get_tag_from_json(json_path,tag):
         /.../dicominfo.json
     tag : tuple of two elements
         DICOM tag, must be in hexagonal format. ex: (0x10,0x20)
+    index : HeaderIndex, optional
+        Header index (cf utils.header_index) containing the .json file. If the tag is
+        indexed, its value is read from the index, as a string, instead of the file.
 
     Returns
     -------
     value : Value stored in tag
     '''
     
+    if index is not None:
+        value=index.get_value(json_path+'.json',tag)
+        if value is not None:
+            return value
+
     ds_json=json.load(open(json_path+'.json'))
     ds = pydicom.dataset.Dataset.from_json(ds_json)
     value=ds[tag].value
     return value
 
 # Classer les fichiers en: Covid vs NON-Covid sur base du tag dans le .json
-def classify_in_labelled_folders(inputFolder, labelTag, outputDir):
+def classify_in_labelled_folders(inputFolder, labelTag, outputDir, indexPath=None, jobs=None):
     '''
     Classify the IMAGES vs METADATA in folders according to the label tag   
 
@@ -46,16 +56,26 @@ def classify_in_labelled_folders(inputFolder, labelTag, outputDir):
         DICOM tag, must be in hexagonal format. ex: (0x10,0x20)
     outputDir : string
         /.../outputs
+    indexPath : string, optional
+        /.../index.npz header index of the input folder (cf utils.header_index), built
+        or refreshed with the label tag, then used instead of parsing each .json file.
+        The default is None.
+    jobs : int, optional
+        Number of processes building the index. The default is the number of CPUs.
     Returns
     -------
     None.
     '''
+    index = None
+    if indexPath is not None:
+        index = build_index(inputFolder, indexPath, [labelTag], jobs)
+
     # lire uniquement les .json et classer en folders de types et labellisés 
     for file in os.listdir(inputFolder):
         if file.endswith(".json"):
             jsonFilePath = inputFolder + file
             associatedPngFilePath = jsonFilePath[:-5] + '.png'
-            labelValue = get_tag_from_json(jsonFilePath[:-5], labelTag)
+            labelValue = get_tag_from_json(os.path.abspath(jsonFilePath[:-5]), labelTag, index)
             
             
             newPathJson = outputDir + '/METADATA/JSON-' + str(labelValue) + '/'
@@ -74,8 +94,10 @@ if __name__ == "__main__":
     parser.add_argument('inputFolder', help = 'Path to the input Folder')
     parser.add_argument('tag', help = 'Tag to add search for in the JSON')
     parser.add_argument('outputFolder', help= 'Path where to create the new folders')
+    parser.add_argument('--index', help = 'Path to the header index (.npz) of the input Folder, built or refreshed and used instead of parsing the JSON files')
+    parser.add_argument('--jobs', type=int, default=None, help = 'Number of processes building the index')
     args = parser.parse_args()
     
-    classify_in_labelled_folders(args.inputFolder, eval(args.tag), args.outputFolder)
+    classify_in_labelled_folders(args.inputFolder, eval(args.tag), args.outputFolder, args.index, args.jobs)
     #classify_in_labelled_folders('/Users/eloyen/Desktop/folderTRAIL/', [0x0014,0x2018], '/Users/eloyen/Desktop/folderTRAIL/')
 
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Decompose all the DICOM files of a folder into image and metadata (.json or .npz)
+files (cf utils.dicom_to_img.decompose_dicom), in parallel.
+
+The input tree is walked lazily and its files are dispatched to a pool of processes
+as they are found, the sub-folders being recreated in the output folder. The files
+whose metadata and image files are newer than the DICOM file are skipped, so that an
+interrupted or repeated run only decomposes the new or modified files.
+
+Usage, from the dicom_converter folder:
+    python decompose_folder.py path/to/input_folder path/to/output_folder --format png --jobs 8
+"""
+import os
+import time
+import argparse
+from multiprocessing import Pool
+
+from utils.dicom_to_img import decompose_dicom
+from utils.large_dicom import LARGE_FILE_SIZE
+
+# Extensions of the files of the input tree which are not DICOM files
+SKIPPED_EXTENSIONS = ('.json', '.png', '.bmp', '.jpg', '.j2k', '.npz', '.txt', '.csv')
+
+def iter_dicom_files(folderPath, relativeFolder=''):
+    '''
+    Recursively generate the DICOM files of a folder (.dcm files and files without
+    the extension of another format), sorted by name in each folder
+
+    Parameters
+    ----------
+    folderPath : string
+        /.../dicoms/
+    relativeFolder : string, optional
+        Path of folderPath relative to the root of the tree, used in the recursion. The default is ''.
+
+    Returns
+    -------
+    g : generator
+        (os.DirEntry, relative path) couples, the relative path using '/' as separator
+    '''
+    with os.scandir(folderPath) as iterator:
+        entries=sorted(iterator,key=lambda entry: entry.name)
+    for entry in entries:
+        relativePath=relativeFolder+entry.name
+        if entry.is_dir():
+            yield from iter_dicom_files(entry.path,relativePath+'/')
+        elif entry.is_file() and not entry.name.lower().endswith(SKIPPED_EXTENSIONS):
+            yield entry,relativePath
+
+def is_up_to_date(entry, outputPrefix, imgFormat, metadataFormat='json'):
+    '''
+    Whether a DICOM file has already been decomposed: its metadata file and its image
+    (or the image of its first frame) are not older than the file
+
+    Parameters
+    ----------
+    entry : os.DirEntry
+        DICOM file
+    outputPrefix : string
+        /.../foldername/filename, without extension
+    imgFormat : string
+        Image file format : bmp, png, ...
+    metadataFormat : string, optional
+        Format of the metadata file: 'json' or 'npz'. The default is 'json'.
+
+    Returns
+    -------
+    b : True/False
+    '''
+    mtime=entry.stat().st_mtime_ns
+    for imagePath in (outputPrefix+'.'+imgFormat,outputPrefix+'_0000.'+imgFormat):
+        if os.path.exists(imagePath):
+            break
+    else:
+        return False
+    metadataPath=outputPrefix+'.'+metadataFormat
+    return (os.path.exists(metadataPath) and os.stat(metadataPath).st_mtime_ns>=mtime
+            and os.stat(imagePath).st_mtime_ns>=mtime)
+
+def decompose_task(task):
+    '''
+    Decompose a DICOM file in a worker process
+
+    Parameters
+    ----------
+    task : tuple
+        (file path, output folder, image format, removeImgInJson, largeFileSize,
+        metadataFormat), cf decompose_dicom
+
+    Returns
+    -------
+    result : tuple
+        (file path, number of images written, error message or None)
+    '''
+    try:
+        return task[0],decompose_dicom(*task),None
+    except Exception as e:
+        return task[0],0,str(e)
+
+def decompose_folder(inputFolder, outputFolder, imgFormat='png', removeImgInJson=True,
+                     largeFileSize=LARGE_FILE_SIZE, jobs=None, force=False, metadataFormat='json'):
+    '''
+    Decompose all the DICOM files of a folder, cf module documentation
+
+    Parameters
+    ----------
+    inputFolder : string
+        /.../dicoms/
+    outputFolder : string
+        /.../outputs/, the sub-folders of inputFolder are recreated in it
+    imgFormat : string, optional
+        Image file format : bmp, png, ... The default is 'png'.
+    removeImgInJson : True/False, optional
+        Removes PixelData from the metadata files. The default is True.
+    largeFileSize : int, optional
+        Cf decompose_dicom. The default is LARGE_FILE_SIZE.
+    jobs : int, optional
+        Number of processes. The default is the number of CPUs.
+    force : True/False, optional
+        Decomposes again the files already up to date. The default is False.
+    metadataFormat : string, optional
+        Format of the metadata files: 'json' or 'npz' (cf utils.metadata_sidecar). The default is 'json'.
+
+    Returns
+    -------
+    stats : dict
+        Numbers of files decomposed, skipped and failed, of images written, and time in seconds
+    '''
+    stats={'files':0,'skipped':0,'failed':0,'images':0}
+    createdFolders=set()
+
+    def iter_tasks():
+        for entry,relativePath in iter_dicom_files(inputFolder):
+            folder,_,filename=('/'+relativePath).rpartition('/')
+            outputPath=outputFolder.rstrip('/')+folder+'/'
+            if filename.endswith('.dcm'):
+                filename=filename[:-4]
+            if not force and is_up_to_date(entry,outputPath+filename,imgFormat,metadataFormat):
+                stats['skipped']+=1
+                continue
+            if outputPath not in createdFolders:
+                os.makedirs(outputPath,exist_ok=True)
+                createdFolders.add(outputPath)
+            yield entry.path,outputPath,imgFormat,removeImgInJson,largeFileSize,metadataFormat
+
+    start=time.time()
+    if jobs==1:
+        results=map(decompose_task,iter_tasks())
+        pool=None
+    else:
+        pool=Pool(jobs)
+        results=pool.imap_unordered(decompose_task,iter_tasks(),chunksize=4)
+    try:
+        for filePath,images,error in results:
+            if error is not None:
+                print('Error, cannot decompose',filePath,':',error)
+                stats['failed']+=1
+                continue
+            stats['files']+=1
+            stats['images']+=images
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    stats['seconds']=time.time()-start
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('inputFolder', help = 'Path to the input Folder, crossed recursively')
+    parser.add_argument('outputFolder', help = 'Path to the folder where the image and metadata files are written')
+    parser.add_argument('--format', default='png', help = 'Image file format : png, bmp, ...')
+    parser.add_argument('--keepImgInJson', action='store_true', help = 'If used, the PixelData is kept in the metadata files')
+    parser.add_argument('--metadataFormat', choices=['json', 'npz'], default='json', help = 'Format of the metadata files: json, or npz for a compact binary sidecar whose tags can be read one at a time')
+    parser.add_argument('--largeFileSize', type=int, default=LARGE_FILE_SIZE // (1024 * 1024), help = 'Size in MB from which a file is decomposed one frame at a time')
+    parser.add_argument('--jobs', type=int, default=None, help = 'Number of processes')
+    parser.add_argument('--force', action='store_true', help = 'If used, the files already decomposed are decomposed again')
+    args = parser.parse_args()
+
+    stats = decompose_folder(args.inputFolder, args.outputFolder, args.format, not args.keepImgInJson,
+                             args.largeFileSize * 1024 * 1024, args.jobs, args.force, args.metadataFormat)
+    print('{} files decomposed ({} images) in {:.1f} s, {:.1f} images/s, {} up to date, {} failed'.format(
+        stats['files'], stats['images'], stats['seconds'],
+        stats['images'] / stats['seconds'] if stats['seconds'] else 0.0, stats['skipped'], stats['failed']))
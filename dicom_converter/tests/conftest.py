@@ -0,0 +1,52 @@
+'''
+Fixtures of the tests of the converter, run from the repository root with:
+    python -m pytest dicom_converter/tests
+'''
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+# The modules are imported as in the scripts of the dicom_converter folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_dicom(tmp_path):
+    '''
+    Write a small uncompressed greyscale DICOM file of the given stored values.
+    '''
+    def make_dicom(pixels, bits_stored=None, signed=False, name='image.dcm', **elements):
+        pixels = np.asarray(pixels)
+        if pixels.ndim == 2:
+            pixels = pixels[np.newaxis]
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+        ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.PatientName = 'Test^Patient'
+        ds.Rows, ds.Columns = pixels.shape[1:]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = pixels.dtype.itemsize * 8
+        ds.BitsStored = bits_stored or ds.BitsAllocated
+        ds.HighBit = ds.BitsStored - 1
+        ds.PixelRepresentation = 1 if signed else 0
+        if pixels.shape[0] > 1:
+            ds.NumberOfFrames = pixels.shape[0]
+        for keyword, value in elements.items():
+            setattr(ds, keyword, value)
+        ds.PixelData = pixels.tobytes()
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        file_path = str(tmp_path / name)
+        ds.save_as(file_path, write_like_original=False)
+        return file_path
+    return make_dicom
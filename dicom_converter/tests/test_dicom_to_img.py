@@ -0,0 +1,35 @@
+import cv2
+import numpy as np
+import pydicom
+import pytest
+
+from utils.dicom_to_img import img_from_dicom
+
+
+def img_from_dicom_float(ds):
+    '''
+    Windowing and normalization of the whole image in floating point, as before the lookup table
+    '''
+    data = ds.pixel_array
+    if 'WindowWidth' in ds:
+        data = pydicom.pixel_data_handlers.util.apply_voi_lut(data, ds)
+    return np.round(cv2.normalize(data, None, 0, 255, cv2.NORM_MINMAX)).astype('uint8')
+
+
+@pytest.mark.parametrize('dtype, bits_stored, elements', [
+    ('uint8', 8, {}),
+    ('uint16', 12, {}),
+    ('uint16', 12, {'WindowCenter': 1000, 'WindowWidth': 800}),
+    ('int16', 16, {'WindowCenter': 40, 'WindowWidth': 400, 'RescaleSlope': 1, 'RescaleIntercept': -1024}),
+    ('int16', 16, {'WindowCenter': [-600, 40], 'WindowWidth': [1500, 400], 'VOILUTFunction': 'SIGMOID'}),
+])
+def test_lut_same_as_float_windowing(make_dicom, dtype, bits_stored, elements):
+    info = np.iinfo(dtype)
+    low, high = max(info.min, -2000), min(info.max, 2 ** bits_stored - 1)
+    pixels = np.random.default_rng(0).integers(low, high, size=(2, 16, 16), endpoint=True).astype(dtype)
+    ds = pydicom.dcmread(make_dicom(pixels, bits_stored=bits_stored, signed=info.min < 0, **elements))
+
+    img = img_from_dicom(ds)
+
+    assert img.dtype == np.uint8
+    np.testing.assert_array_equal(img, img_from_dicom_float(ds))
@@ -0,0 +1,62 @@
+import json
+import os
+
+import numpy as np
+
+import utils.header_index as header_index
+from utils.header_index import build_index, load_index
+
+
+def test_build_and_refresh_index(tmp_path, make_dicom, monkeypatch):
+    pixels = np.zeros((4, 4), dtype='uint8')
+    make_dicom(pixels, name='a.dcm', PatientID='P1', Modality='CT')
+    make_dicom(pixels, name='b.dcm', PatientID='P2', Modality='MR')
+    with open(str(tmp_path / 'c.json'), 'w') as json_file:
+        json.dump({'00100020': {'vr': 'LO', 'Value': ['P1']}, '00080060': {'vr': 'CS', 'Value': ['CT']}}, json_file)
+    index_path = str(tmp_path / 'index.npz')
+
+    index = build_index(str(tmp_path), index_path, jobs=1)
+
+    assert len(index) == 3
+    assert index.find((0x0010, 0x0020), 'P1') == ['a.dcm', 'c.json']
+    assert index.get_value(str(tmp_path / 'b.dcm'), (0x0008, 0x0060)) == 'MR'
+    assert index.get_value('a.dcm', (0x0028, 0x0010)) == '4'
+    assert index.get_value('missing.dcm', (0x0010, 0x0020)) is None
+
+    loaded = load_index(index_path)
+    assert loaded.tags == index.tags
+    for key, column in index.columns.items():
+        np.testing.assert_array_equal(loaded.columns[key], column)
+
+    # Only the modified and new files are parsed again
+    parsed = []
+    read_header = header_index.read_header
+
+    def spy_read_header(args):
+        parsed.append(os.path.basename(args[0]))
+        return read_header(args)
+
+    monkeypatch.setattr(header_index, 'read_header', spy_read_header)
+    make_dicom(pixels, name='b.dcm', PatientID='P3', Modality='MR')
+    stat = os.stat(str(tmp_path / 'b.dcm'))
+    os.utime(str(tmp_path / 'b.dcm'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    make_dicom(pixels, name='d.dcm', PatientID='P1', Modality='CT')
+    os.remove(str(tmp_path / 'c.json'))
+
+    index = build_index(str(tmp_path), index_path, jobs=1)
+
+    assert sorted(parsed) == ['b.dcm', 'd.dcm']
+    assert list(index.columns['path']) == ['a.dcm', 'b.dcm', 'd.dcm']
+    assert index.find((0x0010, 0x0020), 'P1') == ['a.dcm', 'd.dcm']
+    assert index.get_value('b.dcm', (0x0010, 0x0020)) == 'P3'
+
+
+def test_new_tag_parses_every_file(tmp_path, make_dicom):
+    make_dicom(np.zeros((4, 4), dtype='uint8'), name='a.dcm', PatientID='P1', StudyDescription='Chest')
+    index_path = str(tmp_path / 'index.npz')
+    build_index(str(tmp_path), index_path, jobs=1)
+
+    index = build_index(str(tmp_path), index_path, tags=[(0x0008, 0x1030)], jobs=1)
+
+    assert index.get_value('a.dcm', (0x0008, 0x1030)) == 'Chest'
+    assert index.get_value('a.dcm', (0x0010, 0x0020)) == 'P1'
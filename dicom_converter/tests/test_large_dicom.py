@@ -0,0 +1,63 @@
+import numpy as np
+import pydicom
+
+from add_metadata import add_label_in_dcm, add_label_in_large_dcm
+from utils.large_dicom import iter_frames, sign_extend
+
+
+def read_frames(file_path, largeFileSize):
+    ds, frames = iter_frames(file_path, largeFileSize)
+    return [np.array(frame) for frame in frames]
+
+
+def test_iter_frames_same_frames_small_and_large(make_dicom):
+    pixels = np.arange(3 * 4 * 5, dtype='uint16').reshape(3, 4, 5) * 100
+    file_path = make_dicom(pixels)
+
+    small = read_frames(file_path, None)
+    large = read_frames(file_path, 1)
+
+    assert len(small) == len(large) == 3
+    for frame, small_frame, large_frame in zip(pixels, small, large):
+        np.testing.assert_array_equal(small_frame, frame)
+        np.testing.assert_array_equal(large_frame, frame)
+
+
+def test_iter_frames_sign_extends_unused_high_bits(make_dicom):
+    # 12 bits stored of 16: -1, -2048, 2047 and 1, the high bits left to zero
+    stored = np.array([[0x0FFF, 0x0800], [0x07FF, 0x0001]], dtype='uint16')
+    file_path = make_dicom(np.stack([stored, stored]), bits_stored=12, signed=True)
+    expected = np.array([[-1, -2048], [2047, 1]], dtype='int16')
+
+    for largeFileSize in (None, 1):
+        frames = read_frames(file_path, largeFileSize)
+        assert len(frames) == 2
+        for frame in frames:
+            assert frame.dtype == np.int16
+            np.testing.assert_array_equal(frame, expected)
+
+
+def test_sign_extend_is_idempotent(make_dicom):
+    file_path = make_dicom(np.array([[0x0FFF, 0x0800]], dtype='uint16'), bits_stored=12, signed=True)
+    ds = pydicom.dcmread(file_path)
+    extended = sign_extend(ds, np.array([[-1, -2048]], dtype='int16'))
+    np.testing.assert_array_equal(sign_extend(ds, extended), [[-1, -2048]])
+
+    unsigned = np.array([[0x0FFF]], dtype='uint16')
+    assert sign_extend(ds, unsigned) is unsigned
+
+
+def test_header_only_pixel_data_copy(make_dicom):
+    pixels = np.arange(2 * 8 * 8, dtype='uint16').reshape(2, 8, 8)
+    file_path = make_dicom(pixels)
+    expected = pydicom.dcmread(file_path)
+    add_label_in_dcm(expected, '1', (0x0014, 0x2016))
+
+    assert add_label_in_large_dcm(file_path, '1', (0x0014, 0x2016))
+
+    ds = pydicom.dcmread(file_path)
+    assert ds == expected
+    np.testing.assert_array_equal(ds.pixel_array, pixels)
+    # A tag after the pixel data cannot be added without rewriting it
+    assert not add_label_in_large_dcm(file_path, '1', (0x7FE1, 0x0010))
+    assert pydicom.dcmread(file_path) == expected
@@ -4,22 +4,134 @@ Created on Wed Sep  1 15:44:11 2021
 
 Module with functions used to convert DICOM files (.dcm) to .png/.bmp and .json files and from .png/.bmp to DICOM. 
 
-The function 'compress_to_png' calls executables from OpenJPEG (https://www.openjpeg.org/) available at 'https://github.com/uclouvain/openjpeg/releases/tag/v2.4.0'. 
+The function 'compress_to_png' compresses images to JPEG 2000 in memory with OpenCV, or calls executables from OpenJPEG (https://www.openjpeg.org/) available at 'https://github.com/uclouvain/openjpeg/releases/tag/v2.4.0' if OpenCV has no JPEG 2000 support. 
+Images of a folder can be compressed in parallel, from the dicom_converter folder:
+    python -m utils.dicom_to_img path/to/images/ --compressRatio 8 --jobs 8
 """
 
 import os
 import random
 import string
 import json
+import time
+import argparse
 import subprocess
+from multiprocessing import Pool
 import cv2
 import pydicom
 import numpy as np
 
+from utils.large_dicom import LARGE_FILE_SIZE, is_large_file, iter_frames, sign_extend
+from utils.metadata_sidecar import get_tag_from_sidecar, load_sidecar, save_sidecar
+
+# Windowed intensities of all the values of a pixel type, cf get_windowed_values
+windowed_values={}
+WINDOWED_VALUES_CACHE_SIZE=32
+
+def get_windowing_key(ds,dtype):
+    '''
+    Key of the windowing of a dataset for the pixel type of its pixel_array, None if
+    the intensities cannot be mapped by a lookup table (colour, VOI LUT Sequence,
+    Modality LUT Sequence, pixel type larger than 16 bits...)
+    '''
+    if dtype not in (np.uint8,np.int8,np.uint16,np.int16) or ds.get('SamplesPerPixel',1)!=1:
+        return None
+    if 'WindowWidth' not in ds:
+        return (dtype.str,)
+    if ds.get('VOILUTSequence') or ds.get('ModalityLUTSequence'):
+        return None
+    if ds.get('PhotometricInterpretation') not in ('MONOCHROME1','MONOCHROME2'):
+        return None
+    center=ds['WindowCenter'] if 'WindowCenter' in ds else None
+    width=ds['WindowWidth']
+    if center is None or center.value is None or width.value is None:
+        return None
+    center=center.value[0] if center.VM>1 else center.value
+    width=width.value[0] if width.VM>1 else width.value
+    rescale=(float(ds.RescaleSlope),float(ds.RescaleIntercept)) if (
+        ds.get('RescaleSlope') is not None and ds.get('RescaleIntercept') is not None) else None
+    return (dtype.str,int(ds.BitsStored),int(ds.PixelRepresentation),float(center),float(width),
+            rescale,str(ds.get('VOILUTFunction','LINEAR')).upper())
+
+def get_windowed_values(ds,dtype):
+    '''
+    Windowed intensities of all the values of a pixel type, as computed by apply_voi_lut,
+    in the order of the values. The arrays are cached by windowing, cf get_windowing_key.
+
+    Parameters
+    ----------
+    ds : FileDataset object of pydicom.dataset module
+    dtype : numpy dtype
+        Pixel type of ds.pixel_array
+
+    Returns
+    -------
+    values : array or None
+        Values of the pixel type, from the smallest, when there is no windowing,
+        float64 windowed values otherwise. None if a lookup table cannot be used.
+    '''
+    key=get_windowing_key(ds,dtype)
+    if key is None:
+        return None
+    if key not in windowed_values:
+        info=np.iinfo(dtype)
+        values=np.arange(info.min,info.max+1).astype(dtype)
+        if 'WindowWidth' in ds:
+            values=pydicom.pixel_data_handlers.util.apply_voi_lut(values,ds)
+        values.flags.writeable=False
+        if len(windowed_values)>=WINDOWED_VALUES_CACHE_SIZE:
+            del windowed_values[next(iter(windowed_values))]
+        windowed_values[key]=values
+    return windowed_values[key]
+
+def get_uint8_lut(ds,dtype,minimum,maximum):
+    '''
+    Lookup table giving the [0,255] intensities of img_from_dicom for the pixel values
+    between minimum and maximum.
+
+    The windowing is monotonic, so the extreme windowed intensities of an image are the
+    ones of its extreme pixel values: normalizing the windowed values between minimum
+    and maximum with cv2.normalize gives the intensities of every pixel exactly as
+    normalizing the whole windowed image.
+
+    Parameters
+    ----------
+    ds : FileDataset object of pydicom.dataset module
+    dtype : numpy dtype
+        Pixel type of ds.pixel_array
+    minimum, maximum : int
+        Smallest and largest pixel values of the image
+
+    Returns
+    -------
+    lut : array or None
+        uint8 array of 2**bits entries indexed by the pixel values viewed as unsigned
+        integers, cf apply_uint8_lut. None if a lookup table cannot be used.
+    '''
+    values=get_windowed_values(ds,dtype)
+    if values is None:
+        return None
+    offset=int(np.iinfo(dtype).min)
+    lut=np.zeros(len(values),dtype='uint8')
+    used=values[int(minimum)-offset:int(maximum)-offset+1]
+    lut[int(minimum)-offset:int(maximum)-offset+1]=np.round(cv2.normalize(used, None, 0, 255, cv2.NORM_MINMAX)).ravel()
+    # Index of a signed value viewed as unsigned
+    return np.roll(lut,offset) if offset else lut
+
+def apply_uint8_lut(lut,data):
+    '''
+    Map pixel values (any shape, e.g. all the frames of an image) with a lookup table of get_uint8_lut
+    '''
+    unsigned=data.dtype.str.replace('i','u')
+    return np.take(lut,data.view(unsigned))
+
 def img_from_dicom(ds):
     '''
     Extract array from dicom dataset 'dcm' with [0,256] pixel intensities.
 
+    Greyscale images of at most 16 bits are mapped by a lookup table (cf get_uint8_lut)
+    instead of being windowed and normalized in floating point, for all the frames at once.
+
     Parameters
     ----------
     dcm : FileDataset object of pydicom.dataset module
@@ -30,21 +142,28 @@ def img_from_dicom(ds):
         Image array of the dicom dataset
     '''
 
-    data=ds.pixel_array
+    data=sign_extend(ds,ds.pixel_array)
+    
+    lut=get_uint8_lut(ds,data.dtype,data.min(),data.max()) if data.size else None
+    if lut is not None:
+        return apply_uint8_lut(lut,data)
     
     if 'WindowWidth' in ds:
     
         # Uses window levels written in dicom header    
-        data = pydicom.pixel_data_handlers.util.apply_voi_lut(ds.pixel_array, ds)
+        data = pydicom.pixel_data_handlers.util.apply_voi_lut(data, ds)
         
     img = np.round(cv2.normalize(data,  None, 0, 255, cv2.NORM_MINMAX)).astype('uint8')
     
     return img
     
-def decompose_dicom(file_path,output_path,img_format='bmp',removeImgInJson=False):
+def decompose_dicom(file_path,output_path,img_format='bmp',removeImgInJson=True,largeFileSize=LARGE_FILE_SIZE,
+                    metadataFormat='json'):
     '''
     Divides dicom file into a .json file with the dicom metadata and a 
     .'img_format' file containing the image.
+    The metadata can be written to a compact .npz sidecar instead of the .json file,
+    cf utils.metadata_sidecar.
 
     Parameters
     ----------
@@ -55,17 +174,26 @@ def decompose_dicom(file_path,output_path,img_format='bmp',removeImgInJson=False
     img_format : string, optional
         Image file format : bmp, png, ... The default is 'bmp'.
     removeImgInJson : True/False, optional
-        Removes PixelData from dicom metadata. The default is False.
+        Removes PixelData from dicom metadata. The default is True.
+    largeFileSize : int, optional
+        Size in bytes from which the file is decomposed frame by frame, cf
+        decompose_large_dicom. None to always load the whole file. The default is LARGE_FILE_SIZE.
+    metadataFormat : string, optional
+        Format of the metadata file: 'json' or 'npz'. The default is 'json'.
 
     Returns
     -------
-    None.
+    n : int
+        Number of images written
     '''
     
     filename=file_path.rsplit("/")[-1]
     if filename.endswith('.dcm'):
         filename=filename[:-4]
     
+    if is_large_file(file_path,largeFileSize):
+        return decompose_large_dicom(file_path,output_path+filename,img_format,largeFileSize,metadataFormat)
+    
     # Open DICOM
     
     ds = pydicom.dcmread(file_path,force=True)
@@ -75,11 +203,105 @@ def decompose_dicom(file_path,output_path,img_format='bmp',removeImgInJson=False
     if removeImgInJson==True:
         ds.PixelData=None
     
-    metadata=ds.to_json_dict()
-    
     cv2.imwrite(output_path+filename+'.'+img_format, img)
-    with open(output_path+filename+'.json','w') as outfile:
-        json.dump(metadata, outfile)
+    save_metadata(ds,output_path+filename,metadataFormat)
+    return 1
+    
+def decompose_large_dicom(file_path,output_prefix,img_format='bmp',largeFileSize=LARGE_FILE_SIZE,metadataFormat='json'):
+    '''
+    Decompose a large DICOM file with only one frame in memory at a time, cf utils.large_dicom.
+    The intensities are normalized over all the frames, as by img_from_dicom. The
+    PixelData is always removed from the metadata file.
+
+    Parameters
+    ----------
+    file_path : string
+        /.../filename.dcm
+    output_prefix : string
+        /.../foldername/filename, the image of a single frame file is written to
+        output_prefix.'img_format' and the frame i of a multi-frame file to
+        output_prefix_000i.'img_format'.
+    img_format : string, optional
+        Image file format : bmp, png, ... The default is 'bmp'.
+    largeFileSize : int, optional
+        Cf iter_frames. The default is LARGE_FILE_SIZE.
+    metadataFormat : string, optional
+        Format of the metadata file: 'json' or 'npz'. The default is 'json'.
+
+    Returns
+    -------
+    n : int
+        Number of images written
+    '''
+    
+    def windowed_frames(windowing=True):
+        ds,frames=iter_frames(file_path,largeFileSize)
+        for frame in frames:
+            if windowing and 'WindowWidth' in ds:
+                frame=pydicom.pixel_data_handlers.util.apply_voi_lut(frame, ds)
+            yield ds,frame
+    
+    def get_range(frames):
+        minimum,maximum,frame_count=None,None,0
+        for ds,frame in frames:
+            minimum=frame.min() if minimum is None else min(minimum,frame.min())
+            maximum=frame.max() if maximum is None else max(maximum,frame.max())
+            frame_count+=1
+        return ds,frame.dtype,minimum,maximum,frame_count
+    
+    # First pass: range of the pixel values of all the frames
+    ds,dtype,minimum,maximum,frame_count=get_range(windowed_frames(False))
+    
+    # Greyscale frames of at most 16 bits are mapped by a lookup table, cf get_uint8_lut
+    lut=get_uint8_lut(ds,dtype,minimum,maximum)
+    if lut is None and 'WindowWidth' in ds:
+        ds,dtype,minimum,maximum,frame_count=get_range(windowed_frames())
+    
+    # Second pass: without lookup table, the extreme values are added to each frame
+    # normalized by cv2, so that the frames are scaled exactly as the whole volume
+    for i,(ds,frame) in enumerate(windowed_frames(lut is None)):
+        if lut is not None:
+            img=apply_uint8_lut(lut,frame)
+        else:
+            extremes=np.full((1,)+frame.shape[1:],minimum,dtype=frame.dtype)
+            extremes.flat[0]=maximum
+            data=cv2.normalize(np.concatenate([frame,extremes]), None, 0, 255, cv2.NORM_MINMAX)[:-1]
+            img=np.round(data).astype('uint8')
+        suffix='' if frame_count==1 else '_{:04d}'.format(i)
+        cv2.imwrite(output_prefix+suffix+'.'+img_format, img)
+    
+    if 'PixelData' in ds:
+        ds.PixelData=None
+    else:
+        # Not read from the file: VR as written by pydicom
+        encapsulated=ds.file_meta.TransferSyntaxUID.is_compressed
+        ds.add_new(0x7FE00010,'OB' if encapsulated or ds.BitsAllocated<=8 else 'OW',None)
+    save_metadata(ds,output_prefix,metadataFormat)
+    return frame_count
+    
+def save_metadata(ds,output_prefix,metadataFormat='json'):
+    '''
+    Write the metadata of a dataset to output_prefix.json or to the sidecar output_prefix.npz
+
+    Parameters
+    ----------
+    ds : FileDataset object of pydicom.dataset module
+    output_prefix : string
+        /.../foldername/filename
+    metadataFormat : string, optional
+        'json' or 'npz' (cf utils.metadata_sidecar). The default is 'json'.
+
+    Returns
+    -------
+    None.
+    '''
+    if metadataFormat=='npz':
+        save_sidecar(ds,output_prefix+'.npz')
+    elif metadataFormat=='json':
+        with open(output_prefix+'.json','w') as outfile:
+            json.dump(ds.to_json_dict(), outfile)
+    else:
+        raise ValueError('Unknown metadata format: '+metadataFormat)
     
 def dicom_from_img_or_json(file_path,output_folder,metadata_path=None,
                        randomizeName=False,verbose=False):
@@ -89,7 +311,7 @@ def dicom_from_img_or_json(file_path,output_folder,metadata_path=None,
     Parameters
     ----------
     file_path : string
-        /.../filename.png|.json
+        /.../filename.png|.json|.npz
     output_path : string
         /.../foldername/
     metadata_path : string, optional
@@ -118,6 +340,8 @@ def dicom_from_img_or_json(file_path,output_folder,metadata_path=None,
     elif suffix=='json' or os.path.exists(file_path+'.json'):
         ds_json=json.load(open(file_path+'.json'))
         ds = pydicom.dataset.Dataset.from_json(ds_json)
+    elif suffix=='npz' or os.path.exists(file_path+'.npz'):
+        ds = load_sidecar(file_path+'.npz')
     elif verbose:
         raise RuntimeWarning('No .json file ('+
                              file_path_ex+'.json) or metadata_path found')
@@ -129,27 +353,66 @@ def dicom_from_img_or_json(file_path,output_folder,metadata_path=None,
             suffixList=[suffix]
         for suff in suffixList:
             if os.path.exists(file_path+'.'+suff):
-                im=cv2.imread(file_path+'.'+suff)
-                img=im[:,:,0].flatten()
-
-                #ds.PixelData=bytes(img)
-                ds.PixelData=img
-                
-                # To conform with uint8 greyscale png format
-                ds.BitsAllocated=8      # bit depth of image
-                ds.BitsStored=8
-                ds.HighBit = ds.BitsStored - 1
-                ds.Rows=im.shape[0]
-                ds.Columns=im.shape[1]
-                ds.SamplesPerPixel = 1 # 1 for greyscale, 3 for RGB
-                ds.PixelRepresentation = 0 # 0 for unsigned, 1 for signed data
-                ds.WindowWidth=np.max(im)-np.min(im)
-                ds.WindowCenter=np.round(np.max(im)-ds.WindowWidth/2)
+                set_image(ds,read_greyscale_image(file_path+'.'+suff))
                 break
                 
             elif verbose:
                 raise RuntimeWarning('No pixelData in json or .png file found')
     
+    save_rebuilt_dicom(ds,output_folder+filename+'.dcm',randomizeName)
+
+def read_greyscale_image(image_path):
+    '''
+    Read a .png/.bmp image as a contiguous uint8 greyscale array, without converting it to colour
+    '''
+    im=cv2.imread(image_path,cv2.IMREAD_GRAYSCALE)
+    if im is None:
+        raise ValueError('Cannot read image '+image_path)
+    return im
+
+def set_image(ds,im):
+    '''
+    Set the pixel data of a dataset to a uint8 greyscale image, with the attributes of its format
+
+    Parameters
+    ----------
+    ds : Dataset object of pydicom.dataset module
+    im : array
+        Contiguous uint8 image, cf read_greyscale_image
+
+    Returns
+    -------
+    None.
+    '''
+    ds.PixelData=im.tobytes()
+    
+    # To conform with uint8 greyscale png format
+    ds.BitsAllocated=8      # bit depth of image
+    ds.BitsStored=8
+    ds.HighBit = ds.BitsStored - 1
+    ds.Rows=im.shape[0]
+    ds.Columns=im.shape[1]
+    ds.SamplesPerPixel = 1 # 1 for greyscale, 3 for RGB
+    ds.PixelRepresentation = 0 # 0 for unsigned, 1 for signed data
+    ds.WindowWidth=np.max(im)-np.min(im)
+    ds.WindowCenter=np.round(np.max(im)-ds.WindowWidth/2)
+
+def save_rebuilt_dicom(ds,output_file,randomizeName=False):
+    '''
+    Write a dataset rebuilt from an image, in implicit VR little endian
+
+    Parameters
+    ----------
+    ds : Dataset object of pydicom.dataset module
+    output_file : string
+        /.../filename.dcm
+    randomizeName : True/False, optional
+        Creates a random patientID. The default is False.
+
+    Returns
+    -------
+    None.
+    '''
     ds.is_little_endian = True
     ds.is_implicit_VR = True
     
@@ -159,47 +422,300 @@ def dicom_from_img_or_json(file_path,output_folder,metadata_path=None,
     
     if randomizeName:       #Improv on Patient name
         letters = string.ascii_lowercase
+        if 'PatientID' in ds:
+            # New element, the one of a template may be shared (cf clone_template)
+            del ds.PatientID
         ds.PatientID=''.join(random.choice(letters) for i in range(10))
     
-    ds.save_as(output_folder+filename+'.dcm')
+    ds.save_as(output_file)
+
+# Keywords of the elements set on each copy of a template, cf clone_template
+IMAGE_KEYWORDS=('PixelData','BitsAllocated','BitsStored','HighBit','Rows','Columns','SamplesPerPixel',
+                'PixelRepresentation','WindowWidth','WindowCenter')
+
+# Template of the worker processes of dicom_from_images, cf init_template
+template=None
+
+def load_template(metadata_path):
+    '''
+    Parse a reference header once, to be cloned for each image by clone_template
+
+    Parameters
+    ----------
+    metadata_path : string
+        /.../filename.dcm|.json|.npz
+
+    Returns
+    -------
+    ds : Dataset object of pydicom.dataset module
+        Dataset without PixelData, with all its elements parsed
+    '''
+    if metadata_path.endswith('.json'):
+        with open(metadata_path) as json_file:
+            ds = pydicom.dataset.Dataset.from_json(json.load(json_file))
+    elif metadata_path.endswith('.npz'):
+        ds = load_sidecar(metadata_path)
+    else:
+        ds = pydicom.dcmread(metadata_path,force=True)
+    if 'PixelData' in ds:
+        del ds.PixelData
+    # The raw elements are converted once instead of in every clone
+    for element in ds:
+        pass
+    return ds
+
+def clone_template(ds):
+    '''
+    Shallow copy of a template: the elements are shared with the template, except the
+    ones of IMAGE_KEYWORDS which are left out, to be set on the copy
+
+    Parameters
+    ----------
+    ds : Dataset object of pydicom.dataset module
+        Template, cf load_template
+
+    Returns
+    -------
+    clone : FileDataset object of pydicom.dataset module
+    '''
+    clone=pydicom.dataset.FileDataset('',dict(ds.items()),preamble=getattr(ds,'preamble',None))
+    for keyword in IMAGE_KEYWORDS:
+        if keyword in clone:
+            delattr(clone,keyword)
+    return clone
+
+def init_template(metadata_path):
+    '''
+    Load the template of a worker process of dicom_from_images
+    '''
+    global template
+    template=load_template(metadata_path)
+
+def rebuild_task(task):
+    '''
+    Create a dicom from an image and the template of the process
+
+    Parameters
+    ----------
+    task : tuple
+        (image path, output folder, randomizeName)
+
+    Returns
+    -------
+    result : tuple
+        (image path, error message or None)
+    '''
+    image_path,output_folder,randomizeName=task
+    try:
+        ds=clone_template(template)
+        set_image(ds,read_greyscale_image(image_path))
+        filename=os.path.basename(image_path).rsplit('.',1)[0]
+        save_rebuilt_dicom(ds,output_folder+filename+'.dcm',randomizeName)
+        return image_path,None
+    except Exception as e:
+        return image_path,str(e)
+
+def dicom_from_images(image_paths,output_folder,metadata_path,randomizeName=False,jobs=None):
+    '''
+    Creates dicoms from .png/.bmp images sharing the same reference header, as
+    dicom_from_img_or_json with metadata_path, in parallel. The reference header is
+    parsed once per process and shallow-cloned for each image.
+
+    Parameters
+    ----------
+    image_paths : iterable
+        /.../filename.png|.bmp paths, can be a generator
+    output_folder : string
+        /.../foldername/
+    metadata_path : string
+        Path to the reference dicom file, or to a .json/.npz metadata file
+    randomizeName : True/False, optional
+        Creates a random patientID for each dicom. The default is False.
+    jobs : int, optional
+        Number of processes. The default is the number of CPUs.
+
+    Returns
+    -------
+    stats : dict
+        Numbers of dicoms created and failed, and time in seconds
+    '''
+    tasks=((image_path,output_folder,randomizeName) for image_path in image_paths)
+    stats={'images':0,'failed':0}
+    start=time.time()
+    if jobs==1:
+        init_template(metadata_path)
+        results=map(rebuild_task,tasks)
+        pool=None
+    else:
+        pool=Pool(jobs,init_template,(metadata_path,))
+        results=pool.imap_unordered(rebuild_task,tasks,chunksize=16)
+    try:
+        for image_path,error in results:
+            if error is not None:
+                print('Error, cannot create dicom from',image_path,':',error)
+                stats['failed']+=1
+            else:
+                stats['images']+=1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    stats['seconds']=time.time()-start
+    return stats
 
-def compress_to_png(file_path,software_root,compress_ratio=1):
+def jpeg2000_round_trip(img,compress_ratio=1):
+    '''
+    Compresses an image to JPEG 2000 in memory with OpenCV, then decompresses it
+
+    Parameters
+    ----------
+    img : array
+        Greyscale or colour image, 8 or 16 bits
+    compress_ratio : int, optional
+        Best if multiple of 8, 1 for a lossless compression. The default is 1.
+
+    Returns
+    -------
+    img : array
+        Decompressed image
+    size : int
+        Size of the JPEG 2000 code stream in bytes
+    '''
+    # OpenCV takes the inverse of the ratio, multiplied by 1000 (1000: lossless)
+    rate=max(1,int(round(1000/compress_ratio)))
+    ok,buffer=cv2.imencode('.jp2',img,[cv2.IMWRITE_JPEG2000_COMPRESSION_X1000,rate])
+    if not ok:
+        raise RuntimeError('JPEG 2000 encoding failed')
+    return cv2.imdecode(buffer,cv2.IMREAD_UNCHANGED),len(buffer)
+
+def compress_to_png(file_path,software_root=None,compress_ratio=1):
     '''
     Compresses an image to a .png with a specified 'compress_ratio'
 
+    The JPEG 2000 compression is done in memory by OpenCV (cf jpeg2000_round_trip)
+    when it supports JPEG 2000, the OpenJPEG executables are only called otherwise.
+
     Parameters
     ----------
     file_path : string
         /.../filename.png
-    software_root : string
-        Path to the folder containing the openjpeg .exe programs
+    software_root : string, optional
+        Path to the folder containing the openjpeg .exe programs, used if OpenCV has
+        no JPEG 2000 support. The default is None.
     compress_ratio : int, optional
         Best if multiple of 8. The default is 1.
 
     Returns
     -------
-    None.
+    size : int or None
+        Size of the JPEG 2000 code stream in bytes, None with the OpenJPEG executables
+    '''
+    output_prefix=file_path.rsplit(".",1)[0]
+    if cv2.haveImageWriter('.jp2'):
+        img=cv2.imread(file_path,cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise ValueError('Cannot read image '+file_path)
+        img,size=jpeg2000_round_trip(img,compress_ratio)
+        cv2.imwrite(output_prefix+'.png',img)
+        return size
+    
+    if software_root is None:
+        raise RuntimeError('OpenCV has no JPEG 2000 support, software_root is needed')
+    subprocess.run([software_root+'opj_compress','-i',file_path,'-o',output_prefix+'.j2k',
+                    '-r',str(compress_ratio)],check=True)
+    subprocess.run([software_root+'opj_decompress','-i',output_prefix+'.j2k',
+                    '-o',output_prefix+'.png'],check=True)
+    os.remove(output_prefix+'.j2k')
+    return None
+
+def compress_task(task):
     '''
+    Compress an image in a worker process of compress_folder
+
+    Parameters
+    ----------
+    task : tuple
+        (file path, software_root, compress_ratio), cf compress_to_png
+
+    Returns
+    -------
+    result : tuple
+        (file path, size of the image file, size of the code stream or None, error message or None)
+    '''
+    try:
+        size=os.path.getsize(task[0])
+        return task[0],size,compress_to_png(*task),None
+    except Exception as e:
+        return task[0],0,None,str(e)
+
+def compress_folder(folderPath,compress_ratio=1,software_root=None,jobs=None):
+    '''
+    Compresses all the .png and .bmp images of a folder and of its sub-folders with
+    compress_to_png, in parallel
+
+    Parameters
+    ----------
+    folderPath : string
+        /.../images/
+    compress_ratio : int, optional
+        Cf compress_to_png. The default is 1.
+    software_root : string, optional
+        Cf compress_to_png. The default is None.
+    jobs : int, optional
+        Number of processes. The default is the number of CPUs.
+
+    Returns
+    -------
+    stats : dict
+        Numbers of images compressed and failed, total sizes of the image files and
+        of the code streams in bytes, and time in seconds
+    '''
+    def iter_tasks():
+        for root,folders,files in os.walk(folderPath):
+            folders.sort()
+            for file in sorted(files):
+                if file.lower().endswith(('.png','.bmp')):
+                    yield os.path.join(root,file),software_root,compress_ratio
     
-    subprocess.call(software_root+'opj_compress'+
-              ' -i '+file_path+
-              ' -o '+file_path.rsplit(".",1)[0]+'.j2k'+
-              ' -r '+str(compress_ratio))
-    subprocess.call(software_root+'opj_decompress'+
-              ' -i '+file_path.rsplit(".",1)[0]+'.j2k'+
-              ' -o '+file_path.rsplit(".",1)[0]+'.png')
-    os.system('rm '+file_path.rsplit(".",1)[0]+'.j2k')
+    stats={'images':0,'failed':0,'image_bytes':0,'encoded_bytes':0}
+    start=time.time()
+    if jobs==1:
+        results=map(compress_task,iter_tasks())
+        pool=None
+    else:
+        pool=Pool(jobs)
+        results=pool.imap_unordered(compress_task,iter_tasks(),chunksize=8)
+    try:
+        for file_path,size,encoded_size,error in results:
+            if error is not None:
+                print('Error, cannot compress',file_path,':',error)
+                stats['failed']+=1
+                continue
+            stats['images']+=1
+            stats['image_bytes']+=size
+            stats['encoded_bytes']+=encoded_size or 0
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    stats['seconds']=time.time()-start
+    return stats
     
-def get_tag_from_json(json_path,tag):
+def get_tag_from_json(json_path,tag,index=None):
     '''
     Get tag value from .json fiel containing DICOM metadata
+    If there is no .json file, the tag is read from the .npz sidecar (cf
+    utils.metadata_sidecar), without reading the other tags.
 
     Parameters
     ----------
     json_path : string
-        /.../dicominfo.json
+        /.../dicominfo, without extension
     tag : tuple of two elements
         DICOM tag, must be in hexagonal format. ex: (0x10,0x20)
+    index : HeaderIndex, optional
+        Header index (cf utils.header_index) containing the .json file. If the tag is
+        indexed, its value is read from the index, as a string, instead of the file.
 
     Returns
     -------
@@ -207,9 +723,30 @@ def get_tag_from_json(json_path,tag):
 
     '''
     
+    if index is not None:
+        value=index.get_value(json_path+'.json',tag)
+        if value is not None:
+            return value
+
+    if not os.path.exists(json_path+'.json') and os.path.exists(json_path+'.npz'):
+        return get_tag_from_sidecar(json_path+'.npz',tag)
+
     ds_json=json.load(open(json_path+'.json'))
     ds = pydicom.dataset.Dataset.from_json(ds_json)
     
     value=ds[tag].value
     
     return value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('inputFolder', help = 'Path to the folder of .png and .bmp images to compress, crossed recursively')
+    parser.add_argument('--compressRatio', type=int, default=1, help = 'JPEG 2000 compression ratio, best if multiple of 8, 1 for lossless')
+    parser.add_argument('--softwareRoot', default=None, help = 'Path to the folder containing the openjpeg programs, used if OpenCV has no JPEG 2000 support')
+    parser.add_argument('--jobs', type=int, default=None, help = 'Number of processes')
+    args = parser.parse_args()
+
+    stats = compress_folder(args.inputFolder, args.compressRatio, args.softwareRoot, args.jobs)
+    print('{} images compressed in {:.1f} s, {:.1f} images/s, {:.1f} MB of JPEG 2000 code streams, {} failed'.format(
+        stats['images'], stats['seconds'], stats['images'] / stats['seconds'] if stats['seconds'] else 0.0,
+        stats['encoded_bytes'] / (1024 * 1024), stats['failed']))
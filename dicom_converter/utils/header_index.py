@@ -0,0 +1,255 @@
+'''
+    Columnar index of selected DICOM header tags of a folder of DICOM (.dcm) and JSON (.json) files
+
+    The index is built in one parallel pass and saved as a compressed numpy file (.npz)
+    with one array per column: the path of the file (relative to the indexed folder), its
+    size and modification time, and the value of each indexed tag as a string ('' when
+    the tag is missing, values of multi-valued tags joined with '\\'). Refreshing the index
+    only parses again the files whose size or modification time changed.
+
+    Usage, from the dicom_converter folder:
+        python -m utils.header_index path/to/folder path/to/index.npz --tag "(0x0014,0x2016)" --jobs 8
+'''
+
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pydicom
+
+# PatientID, AccessionNumber, StudyInstanceUID, SeriesInstanceUID, Modality, Rows, Columns
+DEFAULT_TAGS = [(0x0010, 0x0020), (0x0008, 0x0050), (0x0020, 0x000D), (0x0020, 0x000E),
+                (0x0008, 0x0060), (0x0028, 0x0010), (0x0028, 0x0011)]
+
+
+def tag_key(tag):
+    '''
+    Name of the column of a tag, as in DICOM JSON: 8 upper case hexadecimal digits. ex: '00100020'
+    '''
+    return '{:08X}'.format(int(pydicom.tag.Tag(tag)))
+
+
+def format_value(value):
+    '''
+    Convert a tag value to the string stored in the index
+    '''
+    if value is None or isinstance(value, (bytes, pydicom.sequence.Sequence)):
+        return ''
+    if isinstance(value, (list, pydicom.multival.MultiValue)):
+        return '\\'.join(format_value(item) for item in value)
+    if isinstance(value, dict): # Person name in DICOM JSON
+        return value.get('Alphabetic', '')
+    return str(value)
+
+
+def read_header(args):
+    '''
+    Read the indexed tags of a file
+
+    Parameters
+    ----------
+    args : tuple
+        (file path, list of tags)
+
+    Returns
+    -------
+    values : list
+        Value of each tag as a string
+    '''
+    path, tags = args
+    if path.endswith('.json'):
+        # The JSON is read as is, without building a pydicom Dataset
+        with open(path) as json_file:
+            ds_json = json.load(json_file)
+        values = []
+        for tag in tags:
+            element = ds_json.get(tag_key(tag), {})
+            values.append(format_value(element.get('Value')))
+        return values
+
+    ds = pydicom.dcmread(path, force=True, stop_before_pixels=True, specific_tags=tags)
+    values = []
+    for tag in tags:
+        element = ds.get(tag)
+        values.append('' if element is None else format_value(element.value))
+    return values
+
+
+def iter_indexable_files(folder, relative_folder=''):
+    '''
+    Recursively generate the (relative path, os.DirEntry) of the .dcm and .json files of a folder
+    '''
+    with os.scandir(folder) as iterator:
+        entries = sorted(iterator, key=lambda entry: entry.name)
+    for entry in entries:
+        relative_path = relative_folder + entry.name
+        if entry.is_dir():
+            yield from iter_indexable_files(entry.path, relative_path + '/')
+        elif entry.name.endswith(('.dcm', '.json')):
+            yield relative_path, entry
+
+
+class HeaderIndex:
+    '''
+    Index of the header tags of the files of a folder, cf module documentation
+
+    Parameters
+    ----------
+    root : string
+        Indexed folder
+    tags : list
+        Indexed tags, tuples of two elements. ex: (0x10,0x20)
+    columns : dict
+        Column name -> numpy array, the columns are 'path', 'size', 'mtime' and the tag keys
+    '''
+
+    def __init__(self, root, tags, columns):
+        self.root = os.path.abspath(root)
+        self.tags = [tuple(tag) for tag in tags]
+        self.columns = columns
+        self.rows = None
+
+    def __len__(self):
+        return len(self.columns['path'])
+
+    def get_row(self, path):
+        '''
+        Row of a file in the index, None if it is not indexed. path is absolute or relative to the root.
+        '''
+        if self.rows is None:
+            self.rows = {relative_path: row for row, relative_path in enumerate(self.columns['path'])}
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.root).replace(os.sep, '/')
+        return self.rows.get(path)
+
+    def get_column(self, tag):
+        '''
+        Values of a tag for all the files, in the order of the 'path' column
+        '''
+        return self.columns[tag_key(tag)]
+
+    def get_value(self, path, tag):
+        '''
+        Value of a tag for a file, None if the file or the tag is not indexed
+        '''
+        row = self.get_row(path)
+        key = tag_key(tag)
+        if row is None or key not in self.columns:
+            return None
+        return str(self.columns[key][row])
+
+    def find(self, tag, value):
+        '''
+        Relative paths of the files whose tag has the given value
+        '''
+        return [str(path) for path in self.columns['path'][self.get_column(tag) == str(value)]]
+
+    def save(self, index_path):
+        '''
+        Save the index to a .npz file
+        '''
+        np.savez_compressed(index_path, root=np.array(self.root), tags=np.array(self.tags, dtype=np.int64).reshape(-1, 2),
+                            **self.columns)
+
+
+def load_index(index_path):
+    '''
+    Load an index saved by HeaderIndex.save
+
+    Parameters
+    ----------
+    index_path : string
+        /.../index.npz
+
+    Returns
+    -------
+    index : HeaderIndex
+    '''
+    with np.load(index_path, allow_pickle=False) as data:
+        columns = {key: data[key] for key in data.files if key not in ('root', 'tags')}
+        return HeaderIndex(str(data['root']), [tuple(int(x) for x in tag) for tag in data['tags']], columns)
+
+
+def build_index(folder, index_path=None, tags=None, jobs=None):
+    '''
+    Build or refresh the header index of a folder. Only new or modified files are parsed,
+    in parallel, the rows of the unchanged files are taken from the existing index.
+
+    Parameters
+    ----------
+    folder : string
+        /.../dicoms/
+    index_path : string, optional
+        /.../index.npz, read if it exists and written. The default is None (not saved).
+    tags : list, optional
+        Tags to index, tuples of two elements. The default is DEFAULT_TAGS. The tags
+        of an existing index are kept.
+    jobs : int, optional
+        Number of processes parsing the files. The default is the number of CPUs.
+
+    Returns
+    -------
+    index : HeaderIndex
+    '''
+    tags = [tuple(tag) for tag in (tags if tags is not None else DEFAULT_TAGS)]
+
+    previous = None
+    if index_path is not None and os.path.exists(index_path):
+        previous = load_index(index_path)
+        if previous.root != os.path.abspath(folder):
+            previous = None
+        else:
+            tags = previous.tags + [tag for tag in tags if tag not in previous.tags]
+
+    files = list(iter_indexable_files(folder))
+    paths = np.array([relative_path for relative_path, _ in files], dtype=str)
+    stats = [entry.stat() for _, entry in files]
+    sizes = np.array([stat.st_size for stat in stats], dtype=np.int64)
+    mtimes = np.array([stat.st_mtime_ns for stat in stats], dtype=np.int64)
+    values = [[''] * len(files) for _ in tags]
+
+    # Reuse the rows of the unchanged files, for the tags already indexed
+    to_parse = []
+    for row, (relative_path, entry) in enumerate(files):
+        previous_row = previous.get_row(relative_path) if previous is not None else None
+        if (previous_row is None or previous.columns['size'][previous_row] != sizes[row]
+                or previous.columns['mtime'][previous_row] != mtimes[row]
+                or any(tag_key(tag) not in previous.columns for tag in tags)):
+            to_parse.append(row)
+            continue
+        for column, tag in enumerate(tags):
+            values[column][row] = str(previous.columns[tag_key(tag)][previous_row])
+
+    tasks = [(files[row][1].path, tags) for row in to_parse]
+    if jobs == 1 or len(tasks) < 2:
+        parsed = [read_header(task) for task in tasks]
+    else:
+        with Pool(jobs) as pool:
+            parsed = pool.map(read_header, tasks, chunksize=max(1, len(tasks) // (4 * (jobs or os.cpu_count()))))
+    for row, row_values in zip(to_parse, parsed):
+        for column, value in enumerate(row_values):
+            values[column][row] = value
+
+    columns = {'path': paths, 'size': sizes, 'mtime': mtimes}
+    for tag, tag_values in zip(tags, values):
+        columns[tag_key(tag)] = np.array(tag_values, dtype=str)
+
+    index = HeaderIndex(folder, tags, columns)
+    if index_path is not None:
+        index.save(index_path)
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('inputFolder', help = 'Path to the folder of .dcm and .json files to index')
+    parser.add_argument('indexPath', help = 'Path to the .npz index, refreshed if it exists')
+    parser.add_argument('--tag', action='append', help = 'Additional tag to index. ex: "(0x0014,0x2016)"')
+    parser.add_argument('--jobs', type=int, default=None, help = 'Number of processes')
+    args = parser.parse_args()
+
+    tags = DEFAULT_TAGS + [eval(tag) for tag in args.tag or []]
+    index = build_index(args.inputFolder, args.indexPath, tags, args.jobs)
+    print(len(index), 'files indexed')
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-bounded access to very large DICOM files (multi-frame tomosynthesis, cine...).
+
+A large file is read without its pixel data (the other elements are small), then:
+    - the frames of uncompressed pixel data are read one at a time from a memory map
+      of the file, so that only the current frame is in memory,
+    - the pixel data can be copied by blocks from the file, when only the header is
+      modified (e.g. add_label_in_dcm).
+Compressed (encapsulated) pixel data and unusual layouts fall back to the full read.
+"""
+
+import os
+import struct
+
+import numpy as np
+import pydicom
+from pydicom.pixel_data_handlers.util import pixel_dtype
+
+# Files from this size (in bytes) are handled by the large file path
+LARGE_FILE_SIZE = 256 * 1024 * 1024
+
+# Size of the blocks of pixel data copied
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+PIXEL_DATA_TAG = 0x7FE00010
+
+
+def is_large_file(file_path,largeFileSize=LARGE_FILE_SIZE):
+    '''
+    Whether a file must be handled by the large file path
+
+    Parameters
+    ----------
+    file_path : string
+        /.../filename.dcm
+    largeFileSize : int, optional
+        Size in bytes from which a file is large, None to never use the large file
+        path. The default is LARGE_FILE_SIZE.
+
+    Returns
+    -------
+    b : True/False
+    '''
+    return largeFileSize is not None and os.path.getsize(file_path)>=largeFileSize
+
+def read_header(fp):
+    '''
+    Read a DICOM file up to its pixel data
+
+    Parameters
+    ----------
+    fp : file object
+        DICOM file opened in binary mode
+
+    Returns
+    -------
+    ds : FileDataset object of pydicom.dataset module
+        Dataset without PixelData
+    pixel_data : tuple or None
+        (offset of the pixel data element, offset of its value, length of the value)
+        in the file, the length being 0xFFFFFFFF for encapsulated pixel data. None if
+        there is no pixel data or if the file cannot be read in place (deflated file).
+    '''
+    ds = pydicom.dcmread(fp,force=True,stop_before_pixels=True)
+    transfer_syntax = getattr(getattr(ds,'file_meta',None),'TransferSyntaxUID',None)
+    if transfer_syntax==pydicom.uid.DeflatedExplicitVRLittleEndian:
+        return ds,None
+
+    start=fp.tell()
+    header=fp.read(12)
+    if len(header)<8:
+        return ds,None
+    endian='<' if ds.is_little_endian else '>'
+    group,element=struct.unpack(endian+'HH',header[:4])
+    if (group<<16)|element!=PIXEL_DATA_TAG:
+        return ds,None
+    if ds.is_implicit_VR:
+        length=struct.unpack(endian+'L',header[4:8])[0]
+        value_offset=start+8
+    else:
+        length=struct.unpack(endian+'L',header[8:12])[0]
+        value_offset=start+12
+    return ds,(start,value_offset,length)
+
+def get_frame_shape(ds):
+    '''
+    Shape of the frames of an uncompressed greyscale dataset, None if the frames cannot
+    be read directly from the file (compressed, colour or 1-bit pixel data)
+    '''
+    if ds.file_meta.TransferSyntaxUID.is_compressed:
+        return None
+    if ds.get('SamplesPerPixel',1)!=1 or ds.BitsAllocated not in (8,16,32):
+        return None
+    return (int(ds.get('NumberOfFrames',1) or 1),ds.Rows,ds.Columns)
+
+def sign_extend(ds,data):
+    '''
+    Extend the sign of signed pixel values stored on fewer bits than allocated, so that
+    the unused high bits are ignored: the values are the same whether they are read
+    from a memory map or by pixel_array, whatever the version of pydicom (values already
+    extended are unchanged)
+
+    Parameters
+    ----------
+    ds : FileDataset object of pydicom.dataset module
+    data : array
+        Pixel values of ds, of its pixel type
+
+    Returns
+    -------
+    data : array
+        data itself if there is nothing to extend, a new array otherwise
+    '''
+    if ds.get('PixelRepresentation',0)!=1 or data.dtype.kind!='i':
+        return data
+    shift=data.dtype.itemsize*8-int(ds.BitsStored)
+    if shift<=0:
+        return data
+    return np.right_shift(np.left_shift(data,shift),shift)
+
+def iter_frames(file_path,largeFileSize=LARGE_FILE_SIZE):
+    '''
+    Generate the frames of a DICOM file one at a time, as the rows of pixel_array.
+
+    Parameters
+    ----------
+    file_path : string
+        /.../filename.dcm
+    largeFileSize : int, optional
+        Size in bytes from which the frames are read from a memory map. Smaller files
+        are read entirely. The default is LARGE_FILE_SIZE.
+
+    Returns
+    -------
+    ds : FileDataset object of pydicom.dataset module
+        Dataset, without PixelData when the frames are read from a memory map
+    frames : generator
+        Arrays of shape (rows, columns), (rows, columns, samples) for colour images
+    '''
+    if is_large_file(file_path,largeFileSize):
+        with open(file_path,'rb') as fp:
+            ds,pixel_data=read_header(fp)
+        shape=get_frame_shape(ds) if pixel_data is not None else None
+        if shape is not None and pixel_data[2]!=0xFFFFFFFF:
+            frames=np.memmap(file_path,dtype=pixel_dtype(ds),mode='r',offset=pixel_data[1],shape=shape)
+            return ds,(sign_extend(ds,frames[i]) for i in range(shape[0]))
+
+    ds=pydicom.dcmread(file_path,force=True)
+    data=sign_extend(ds,ds.pixel_array)
+    if int(ds.get('NumberOfFrames',1) or 1)==1:
+        data=data[np.newaxis]
+    return ds,iter(data)
+
+def save_with_pixel_data_of(ds,file_path,pixelDataOffset,out_path):
+    '''
+    Write a dataset read by read_header, copying the pixel data (and the elements after
+    it) by blocks from the original file instead of loading it.
+
+    Parameters
+    ----------
+    ds : FileDataset object of pydicom.dataset module
+        Dataset without PixelData, may have been modified with elements before PixelData
+    file_path : string
+        /.../filename.dcm, the original file
+    pixelDataOffset : int
+        Offset of the pixel data element in the original file, cf read_header
+    out_path : string
+        /.../filename.dcm, can be file_path: the file is replaced once written
+
+    Returns
+    -------
+    None.
+    '''
+    tmp_path=out_path+'.tmp'
+    with open(file_path,'rb') as fp, open(tmp_path,'wb') as out_fp:
+        ds.save_as(out_fp)
+        fp.seek(pixelDataOffset)
+        while True:
+            chunk=fp.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            out_fp.write(chunk)
+    os.replace(tmp_path,out_path)
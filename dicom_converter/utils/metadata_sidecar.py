@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Compact binary sidecar of the DICOM metadata, alternative to the .json file of
+decompose_dicom.
+
+The sidecar is a compressed numpy file (.npz) with the members:
+    - 'tags': the tags of the elements, sorted, as uint32,
+    - 'elements': the DICOM JSON of each element ({"vr": ..., "Value": [...]}),
+      encoded in UTF-8 and concatenated, as uint8,
+    - 'offsets': the offset of the JSON of each element in 'elements', and its end,
+    - for the binary elements (OB, OW, UN... e.g. PixelData when it is kept), the raw
+      bytes as a uint8 array named by the tag as in DICOM JSON and the VR, ex:
+      '7FE00010_OW', instead of base64.
+A single tag is read by a binary search in 'tags', only the JSON of its element
+being decoded (cf get_tag_from_sidecar), and the binary members are only read when
+they are requested (an .npz file is a zip file).
+"""
+
+import json
+
+import numpy as np
+import pydicom
+
+# VRs whose values are stored as raw bytes
+BINARY_VRS=('OB','OD','OF','OL','OV','OW','UN')
+
+def tag_key(tag):
+    '''
+    Name of the member of a tag, as in DICOM JSON. ex: '00100020'
+    '''
+    return '{:08X}'.format(int(pydicom.tag.Tag(tag)))
+
+def save_sidecar(ds,sidecar_path):
+    '''
+    Write the metadata of a dataset to a sidecar file, cf module documentation
+
+    Parameters
+    ----------
+    ds : FileDataset object of pydicom.dataset module
+    sidecar_path : string
+        /.../filename.npz
+
+    Returns
+    -------
+    None.
+    '''
+    members={}
+    tags,elements=[],[]
+    for element in ds:
+        if element.VR in BINARY_VRS and isinstance(element.value,bytes):
+            members[tag_key(element.tag)+'_'+element.VR]=np.frombuffer(element.value,dtype='uint8')
+        else:
+            tags.append(int(element.tag))
+            elements.append(json.dumps(element.to_json_dict(None,1024)).encode())
+    members['tags']=np.array(tags,dtype='uint32')
+    members['offsets']=np.cumsum([0]+[len(element) for element in elements],dtype='uint64')
+    members['elements']=np.frombuffer(b''.join(elements),dtype='uint8')
+    np.savez_compressed(sidecar_path,**members)
+
+def add_element(ds,tag,elements,offsets,index):
+    '''
+    Add the element of index 'index' of the 'elements' member of a sidecar to a dataset
+    '''
+    element=json.loads(elements[int(offsets[index]):int(offsets[index+1])].tobytes())
+    ds.update(pydicom.dataset.Dataset.from_json({tag_key(tag):element}))
+
+def load_sidecar(sidecar_path):
+    '''
+    Read all the metadata of a sidecar file
+
+    Parameters
+    ----------
+    sidecar_path : string
+        /.../filename.npz
+
+    Returns
+    -------
+    ds : Dataset object of pydicom.dataset module
+    '''
+    ds=pydicom.dataset.Dataset()
+    with np.load(sidecar_path,allow_pickle=False) as sidecar:
+        tags,offsets,elements=sidecar['tags'],sidecar['offsets'],sidecar['elements']
+        for index,tag in enumerate(tags):
+            add_element(ds,int(tag),elements,offsets,index)
+        for name in sidecar.files:
+            if '_' in name:
+                key,vr=name.split('_')
+                ds.add_new(int(key,16),vr,sidecar[name].tobytes())
+    return ds
+
+def get_tag_from_sidecar(sidecar_path,tag):
+    '''
+    Get the value of a single tag of a sidecar file, without decoding the other tags
+
+    Parameters
+    ----------
+    sidecar_path : string
+        /.../filename.npz
+    tag : tuple of two elements
+        DICOM tag, must be in hexagonal format. ex: (0x10,0x20)
+
+    Returns
+    -------
+    value : Value stored in tag
+
+    Raises
+    ------
+    KeyError
+        If the tag is not in the sidecar.
+    '''
+    tag=int(pydicom.tag.Tag(tag))
+    key=tag_key(tag)
+    with np.load(sidecar_path,allow_pickle=False) as sidecar:
+        tags=sidecar['tags']
+        index=int(np.searchsorted(tags,tag))
+        if index<len(tags) and tags[index]==tag:
+            ds=pydicom.dataset.Dataset()
+            add_element(ds,tag,sidecar['elements'],sidecar['offsets'],index)
+            return ds[tag].value
+        for name in sidecar.files:
+            if name.startswith(key+'_'):
+                return sidecar[name].tobytes()
+    raise KeyError(key)
@@ -3,32 +3,246 @@
 import argparse
 import ast
 import json
+import multiprocessing
 import os
 import sys
 import tqdm
 
 from utils.simple_dicomanonymizer import *
+from utils.lookup_table import LookupTableManager
+from utils.file_discovery import Manifest, file_sha256, iter_files
+from utils.sqlite_store import SQLiteStore
+from utils.pipeline import anonymize_pipeline, print_pipeline_stats
+from utils.profiler import Profiler
+from utils.archive import anonymize_archive, is_archive
+from utils.watch_folder import watch_folder
+from utils.memory_budget import MemoryBudget, estimate_file_memory
+from utils.pixel_masking import load_mask_templates
+from utils.transcoding import TranscodingReport, get_available_transfer_syntaxes, get_transfer_syntax
+
+# Arguments given to each worker process by init_worker
+worker_arguments = None
+
+
+def init_worker(shared_dictionary, shared_lock, shared_lookup_table, uid_key: bytes, store_path: str, lookup_path: str,
+                anonymization_actions: dict, delete_private_tags: bool, rename_files: bool, header_only: bool,
+                profile_sample: int = None, large_file_size: int = None, transfer_syntax=None) -> None:
+    '''
+    Initialize a worker process of the pool used by anonymize when jobs > 1.
+
+    Parameters
+    ----------
+    shared_dictionary : dict-like
+        UIDs correspondence shared by all workers.
+    shared_lock : Lock
+        Lock protecting the output folder when renaming files.
+    shared_lookup_table : LookupTable proxy
+        Lookup table shared by all workers, None if there is no lookup table.
+    uid_key : bytes
+        Secret key used to derive the UIDs, None for random UIDs.
+    store_path : str
+        Path to the SQLite store opened by the worker, None if there is no store.
+    lookup_path : str
+        Path to lookup table csv path.
+    anonymization_actions : AnonymizationPlan
+        Plan of the actions that will be applied on tags.
+    delete_private_tags : bool
+        Whether to delete private tags.
+    rename_files : bool
+        Whether to remane output files with pseudo.
+    header_only : bool
+        Whether to only read the header and copy the pixel data as is.
+    profile_sample : int
+        Sampling of the traces of the worker profiler, None to disable the profiling.
+    large_file_size : int
+        Size in bytes from which files are read header only, None to disable.
+    transfer_syntax : pydicom.uid.UID
+        Transfer syntax the pixel data is compressed to, None to disable.
+
+    Returns
+    -------
+    None.
+    '''
+    global worker_arguments
+    set_shared_state(shared_dictionary, shared_lock, shared_lookup_table)
+    set_uid_key(uid_key)
+    set_large_file_size(large_file_size)
+    if transfer_syntax is not None:
+        set_transcoding(transfer_syntax, TranscodingReport())
+    if store_path is not None:
+        # Each worker has its own connection, SQLite serializes the writes
+        set_store(SQLiteStore(store_path))
+    if profile_sample is not None:
+        set_profiler(Profiler(profile_sample))
+    worker_arguments = (lookup_path, anonymization_actions, delete_private_tags, rename_files, header_only)
+
+
+def anonymize_worker(task: tuple) -> tuple:
+    '''
+    Anonymize one file in a worker process, cf anonymize_task.
+
+    Returns
+    -------
+    t : tuple
+        The input file, the result of anonymize_task, the profile of the file (cf
+        Profiler.pop_report), None if the profiling is disabled, and the transcoding
+        rows of the file (cf TranscodingReport.pop_rows), None if the transcoding is disabled.
+    '''
+    record = anonymize_task(task, *worker_arguments)
+    profiler = get_profiler()
+    report = get_transcoding_report()
+    return (task[0], record, profiler.pop_report() if profiler is not None else None,
+            report.pop_rows() if report is not None else None)
+
+
+def anonymize_task(task: tuple, lookup_path: str, anonymization_actions: dict, delete_private_tags: bool,
+                   rename_files: bool, header_only: bool):
+    '''
+    Anonymize one file generated by iter_input_files.
+
+    Parameters
+    ----------
+    task : tuple
+        (input file, output file, manifest record) tuple.
+    others :
+        Cf anonymize.
+
+    Returns
+    -------
+    r : dict or None
+        The manifest record of the input file, with its SHA-256 if requested, or None if
+        there is no manifest or if the file vanished since it was discovered (it is then
+        left to the next run).
+    '''
+    in_file, out_file, record = task
+    if not os.path.isfile(in_file):
+        return None
+    try:
+        anonymize_dicom_file(in_file, out_file, lookup_path, anonymization_actions, delete_private_tags, rename_files, header_only)
+        if record is not None and record['sha256'] is None:
+            record['sha256'] = file_sha256(in_file)
+    except FileNotFoundError:
+        if os.path.exists(in_file):
+            raise
+        return None
+    return record
+
+
+def iter_input_files(input_folder: str, output_folder: str, manifest: Manifest = None):
+    '''
+    Lazily generate the files to anonymize from an input tree, mirrored in the output folder.
+    The output folder is not crossed when it is inside the input folder.
+
+    Parameters
+    ----------
+    input_folder : str
+        Folder crossed recursively.
+    output_folder : str
+        Folder where the sub-folders of the input folder are created.
+    manifest : Manifest
+        Manifest of the files already anonymized, which are skipped.
+
+    Returns
+    -------
+    g : generator
+        (input file, output file, manifest record) tuples, the record is None without manifest.
+    '''
+    created_folders = set()
+    for entry, relative_path in iter_files(input_folder, exclude=(output_folder,)):
+        record = None
+        if manifest is not None:
+            try:
+                record = manifest.get_record(relative_path, entry.path, entry.stat())
+            except FileNotFoundError:
+                # Vanished since the folder was listed
+                continue
+            if record is None:
+                continue
+            if manifest.hash_files:
+                record['sha256'] = None
+
+        out_file = output_folder + '/' + relative_path
+        out_folder = os.path.dirname(out_file)
+        if out_folder not in created_folders:
+            os.makedirs(out_folder, exist_ok=True)
+            created_folders.add(out_folder)
+
+        yield entry.path, out_file, record
+
 
 def anonymize(input_path: str, output_path: str,  lookup_path: str, anonymization_actions: dict,
-                delete_private_tags: bool, rename_files: bool) -> None:
+                delete_private_tags: bool, rename_files: bool, jobs: int = 1, header_only: bool = False,
+                manifest_path: str = None, hash_files: bool = False, uid_key: bytes = None,
+                store_path: str = None, pipeline: bool = False, read_workers: int = 4, write_workers: int = 2,
+                queue_size: int = 16, profile_path: str = None, profile_sample: int = 100,
+                large_file_size: int = None, memory_limit: int = None, mask_templates: tuple = (),
+                transfer_syntax=None, transcoding_report_path: str = None) -> None:
     '''
-    Read data from input path (folder or file) and launch the anonymization.
+    Read data from input path (folder, file or archive) and launch the anonymization.
 
     Parameters
     ----------
     input_path : str
         Path to a folder or to a file. If set to a folder, 
-        then cross all over subfiles and apply anonymization.
+        then cross all over subfiles (recursively) and apply anonymization.
+        If set to a zip or tar archive (.zip, .tar, .tar.gz, .tgz, .tar.bz2, .tar.xz),
+        its members are anonymized one at a time, without being extracted.
     output_path : str
-        Path to a folder or to a file.
-    csv_path : str
-        Path to lookup table csv path.
+        Path to a folder or to a file. If set to a zip or tar archive, it is created
+        and the anonymized files are written directly to it. With an input or output
+        archive, the files are entirely read and anonymized by the current process
+        (jobs, header_only, pipeline and manifest are ignored).
+    lookup_path : str
+        Path to lookup table csv path. If a store is used, the lookup table of the
+        store is exported to this path at the end.
     anonymization_actions : dict
         List of actions that will be applied on tags.
     delete_private_tags : bool
         Whether to delete private tags.
     rename_files : bool
         Whether to remane output files with pseudo.
+    jobs : int
+        Number of processes anonymizing files in parallel.
+    header_only : bool
+        Whether to only read the header and copy the pixel data as is.
+    manifest_path : str
+        Path to the manifest csv file of the input files already anonymized, which
+        are skipped. Only used when input_path is a folder.
+    hash_files : bool
+        Whether to record the SHA-256 of the input files in the manifest.
+    uid_key : bytes
+        Secret key used to derive the replacement UIDs. The same key always gives the
+        same UIDs, whatever the run. If None, random UIDs are kept in memory during the run.
+    store_path : str
+        Path to a SQLite store keeping the pseudonyms and the UIDs between runs, used
+        instead of the lookup table csv file and of the in-memory UIDs.
+    pipeline : bool
+        Whether to read, anonymize and write the files in a pipeline of threads (only if jobs = 1).
+    read_workers : int
+        Number of threads reading the input files in pipeline mode.
+    write_workers : int
+        Number of threads writing the output files in pipeline mode.
+    queue_size : int
+        Maximum number of files waiting between two stages in pipeline mode.
+    profile_path : str
+        Path to the JSON profile of the run, cf utils.profiler. If set, the profiling is
+        enabled and its summary is printed at the end.
+    profile_sample : int
+        A file out of profile_sample is traced in the profile.
+    large_file_size : int
+        Size in bytes from which files are read header only (their pixel data is copied
+        by blocks), whatever header_only. None to disable.
+    memory_limit : int
+        Estimated memory in bytes of the files anonymized at the same time by the
+        processes, cf utils.memory_budget. Only used when jobs > 1, None for no limit.
+    mask_templates : tuple
+        Templates of the burned-in annotations masked in the pixel data, cf
+        utils.pixel_masking. The files they match are entirely read, even if header_only.
+    transfer_syntax : pydicom.uid.UID
+        Lossless transfer syntax the pixel data is compressed to, cf utils.transcoding.
+        If set, a summary of the compression is printed at the end. None to disable.
+    transcoding_report_path : str
+        Path to the csv file where the compression ratio and encoding time of each file are written.
 
     Returns
     -------
@@ -37,37 +251,208 @@ def anonymize(input_path: str, output_path: str,  lookup_path: str, anonymizatio
     # Get input arguments
     input_folder = ''
     output_folder = ''
+    archive = is_archive(input_path) or is_archive(output_path)
 
     if os.path.isdir(input_path):
         input_folder = input_path
 
     if os.path.isdir(output_path):
         output_folder = output_path
-        if input_folder == '':
+        if input_folder == '' and not archive:
             output_path = output_folder + os.path.basename(input_path)
 
-    if input_folder != '' and output_folder == '':
+    if input_folder != '' and output_folder == '' and not archive:
         print('Error, please set a correct output folder path')
         sys.exit()
 
-    # Generate list of input file if a folder has been set
-    input_files_list = []
-    output_files_list = []
-    if input_folder == '':
-        input_files_list.append(input_path)
-        output_files_list.append(output_path)
+    # Generate the input files lazily if a folder has been set
+    manifest = None
+    if archive:
+        tasks = None
+    elif input_folder == '':
+        tasks = iter([(input_path, output_path, None)])
     else:
-        files = os.listdir(input_folder)
-        for fileName in files:
-            input_files_list.append(input_folder + '/' + fileName)
-            output_files_list.append(output_folder + '/' + fileName)
-
-    progress_bar = tqdm.tqdm(total=len(input_files_list))
-    for cpt in range(len(input_files_list)):
-        anonymize_dicom_file(input_files_list[cpt], output_files_list[cpt], lookup_path, anonymization_actions, delete_private_tags, rename_files)
-        progress_bar.update(1)
+        if manifest_path is not None:
+            manifest = Manifest(manifest_path, hash_files)
+        tasks = iter_input_files(input_folder, output_folder, manifest)
+
+    # The rules are compiled once for all the files
+    anonymization_actions = compile_actions(anonymization_actions, mask_templates)
+
+    # With a store, the lookup table csv file is only written at the end
+    task_lookup_path = lookup_path if store_path is None else None
+
+    profiler = Profiler(profile_sample) if profile_path is not None else None
+    transcoding_report = TranscodingReport() if transfer_syntax is not None else None
+
+    pipeline_stats = None
+    memory_budget = None
+    progress_bar = tqdm.tqdm()
+    if jobs > 1 and not archive:
+        # UIDs and lookup table are owned by a manager process so that every worker sees the same state
+        with LookupTableManager() as manager:
+            shared_lookup_table = None
+            if lookup_path is not None and store_path is None:
+                shared_lookup_table = manager.LookupTable(lookup_path)
+            # Keyed UIDs or UIDs in a store need no shared dictionary
+            shared_dictionary = manager.dict() if uid_key is None and store_path is None else {}
+            initargs = (shared_dictionary, manager.Lock(), shared_lookup_table, uid_key, store_path, task_lookup_path,
+                        anonymization_actions, delete_private_tags, rename_files, header_only,
+                        profile_sample if profiler is not None else None, large_file_size, transfer_syntax)
+            chunk_size = 16
+            if memory_limit is not None:
+                # Input file -> estimated memory, released when the file is done
+                costs = {}
+
+                def get_cost(task):
+                    try:
+                        size = os.path.getsize(task[0])
+                    except OSError:
+                        # Vanished since its discovery, the worker skips it as in the other modes
+                        size = 0
+                    cost = costs[task[0]] = estimate_file_memory(size, header_only, large_file_size)
+                    return cost
+
+                memory_budget = MemoryBudget(memory_limit)
+                tasks = memory_budget.iter_tasks(tasks, get_cost)
+                # Chunks would hold back the tasks already admitted
+                chunk_size = 1
+            try:
+                with multiprocessing.Pool(jobs, initializer=init_worker, initargs=initargs) as pool:
+                    for in_file, record, profile, transcoding_rows in pool.imap_unordered(anonymize_worker, tasks, chunk_size):
+                        if memory_limit is not None:
+                            memory_budget.release(costs.pop(in_file))
+                        if record is not None:
+                            manifest.add(record)
+                        if profile is not None:
+                            profiler.merge(profile)
+                        if transcoding_rows is not None:
+                            transcoding_report.extend(transcoding_rows)
+                        progress_bar.update(1)
+            finally:
+                # The files already written use the pending pseudonyms, even if a worker failed
+                # or the run was interrupted (the manager process ignores Ctrl+C)
+                if shared_lookup_table is not None:
+                    shared_lookup_table.close()
+    else:
+        set_uid_key(uid_key)
+        store = SQLiteStore(store_path) if store_path is not None else None
+        set_store(store)
+        set_profiler(profiler)
+        set_large_file_size(large_file_size)
+        set_transcoding(transfer_syntax, transcoding_report)
+        try:
+            if archive:
+                anonymize_archive(input_path, output_path, task_lookup_path, anonymization_actions, delete_private_tags,
+                                  rename_files, lambda: progress_bar.update(1))
+            elif pipeline:
+                def on_done(record):
+                    if record is not None and record['sha256'] is None:
+                        try:
+                            record['sha256'] = file_sha256(input_folder + '/' + record['path'])
+                        except FileNotFoundError:
+                            # Not marked as anonymized, the next run retries it
+                            record = None
+                    if record is not None:
+                        manifest.add(record)
+                    progress_bar.update(1)
+
+                pipeline_stats = anonymize_pipeline(tasks, task_lookup_path, anonymization_actions, delete_private_tags,
+                                                    rename_files, header_only, read_workers, write_workers, queue_size, on_done)
+            else:
+                for task in tasks:
+                    record = anonymize_task(task, task_lookup_path, anonymization_actions, delete_private_tags, rename_files, header_only)
+                    if record is not None:
+                        manifest.add(record)
+                    progress_bar.update(1)
+        finally:
+            # The pending rows of the lookup table are written even if the run fails
+            set_store(None)
+            set_profiler(None)
+            set_large_file_size(None)
+            set_transcoding(None)
+            if store is not None:
+                store.close()
+            close_lookup_table()
+
+    if store_path is not None and lookup_path is not None:
+        store = SQLiteStore(store_path)
+        store.export_csv(lookup_path)
+        store.close()
 
     progress_bar.close()
+    if manifest is not None:
+        manifest.close()
+    if pipeline_stats is not None:
+        print_pipeline_stats(pipeline_stats)
+    if memory_budget is not None:
+        print('Memory limit: {:.0f} MB, max estimated in flight: {:.0f} MB, {} waits'.format(
+            memory_limit / (1024 * 1024), memory_budget.max_used / (1024 * 1024), memory_budget.waits))
+    if profiler is not None:
+        profiler.print_summary()
+        profiler.write_json(profile_path)
+    if transcoding_report is not None:
+        transcoding_report.print_summary()
+        if transcoding_report_path is not None:
+            transcoding_report.write_csv(transcoding_report_path)
+
+
+def watch(input_folder: str, output_folder: str, done_folder: str, lookup_path: str, anonymization_actions: dict,
+          delete_private_tags: bool, rename_files: bool, header_only: bool = False, uid_key: bytes = None,
+          store_path: str = None, poll_interval: float = 1.0, settle_time: float = 2.0, report_every: float = 60.0,
+          large_file_size: int = None, mask_templates: tuple = (), transfer_syntax=None) -> None:
+    '''
+    Anonymize continuously the files dropped in the input folder, until interrupted (Ctrl+C),
+    cf utils.watch_folder.
+
+    Parameters
+    ----------
+    input_folder : str
+        Spool folder watched recursively.
+    output_folder : str
+        Folder where the anonymized files are written.
+    done_folder : str
+        Folder where the input files are moved once anonymized, outside of the input folder.
+    poll_interval : float
+        Number of seconds between two scans of the input folder.
+    settle_time : float
+        Number of seconds without change after which a file is considered complete.
+    report_every : float
+        Number of seconds between two reports of the latency and of the queue depth.
+    large_file_size : int
+        Size in bytes from which files are read header only, None to disable.
+    mask_templates : tuple
+        Templates of the burned-in annotations masked in the pixel data, cf utils.pixel_masking.
+    transfer_syntax : pydicom.uid.UID
+        Lossless transfer syntax the pixel data is compressed to, cf utils.transcoding.
+    others :
+        Cf anonymize.
+
+    Returns
+    -------
+    None.
+    '''
+    anonymization_actions = compile_actions(anonymization_actions, mask_templates)
+    set_uid_key(uid_key)
+    set_large_file_size(large_file_size)
+    transcoding_report = TranscodingReport() if transfer_syntax is not None else None
+    set_transcoding(transfer_syntax, transcoding_report)
+    store = SQLiteStore(store_path) if store_path is not None else None
+    set_store(store)
+    try:
+        watch_folder(input_folder, output_folder, done_folder, lookup_path if store is None else None,
+                     anonymization_actions, delete_private_tags, rename_files, header_only, poll_interval,
+                     settle_time, report_every)
+    finally:
+        set_store(None)
+        set_large_file_size(None)
+        set_transcoding(None)
+        if transcoding_report is not None:
+            transcoding_report.print_summary()
+        if store is not None:
+            if lookup_path is not None:
+                store.export_csv(lookup_path)
+            store.close()
 
 
 def generate_actions_dictionary(map_action_tag, defined_action_map = {}) -> dict:
@@ -110,8 +495,8 @@ def generate_actions_dictionary(map_action_tag, defined_action_map = {}) -> dict
 
 def main(defined_action_map = {}):
     parser = argparse.ArgumentParser(add_help=True)
-    parser.add_argument('input', help='Path to the input dicom file or input directory which contains dicom files')
-    parser.add_argument('output', help='Path to the output dicom file or output directory which will contains dicom files')
+    parser.add_argument('input', help='Path to the input dicom file, input directory which contains dicom files or zip/tar archive of dicom files')
+    parser.add_argument('output', help='Path to the output dicom file, output directory which will contains dicom files or zip/tar archive to create')
     parser.add_argument('-t', action='append', nargs='*', help='tags action : Defines a new action to apply on the tag.'\
     '\'regexp\' action takes two arguments: '\
         '1. regexp to find substring '\
@@ -122,6 +507,30 @@ def main(defined_action_map = {}):
     parser.set_defaults(keepPrivateTags=False)
     parser.add_argument('--renameFiles', action='store_true', dest='renameFiles', help="If used, rename output files using PaitentID + AccessionNumber")
     parser.set_defaults(renameFiles=False)
+    parser.add_argument('--jobs', action='store', type=int, default=1, help='Number of processes anonymizing files in parallel')
+    parser.add_argument('--headerOnly', action='store_true', dest='headerOnly', help='If used, only the header is loaded in memory, the pixel data is copied as is')
+    parser.set_defaults(headerOnly=False)
+    parser.add_argument('--manifest', action='store', help='Path to the manifest of the input files already anonymized, which are skipped')
+    parser.add_argument('--manifestHash', action='store_true', dest='manifestHash', help='If used, the SHA-256 of the input files is kept in the manifest')
+    parser.set_defaults(manifestHash=False)
+    parser.add_argument('--store', action='store', help='Path to a SQLite store keeping the pseudonyms and the UIDs between runs. If --lookup is also set, the lookup table is exported to it at the end')
+    parser.add_argument('--largeFileSize', action='store', type=int, help='Size in MB from which files are read header only, their pixel data being copied by blocks instead of loaded')
+    parser.add_argument('--memoryLimit', action='store', type=int, help='With --jobs, memory in MB of the files anonymized at the same time: files are only dispatched to the processes while their estimated memory fits')
+    parser.add_argument('--pixelMasks', action='store', help='JSON file of rectangle templates (per modality, manufacturer...) of the burned-in annotations to mask in the pixel data')
+    parser.add_argument('--transcode', action='store', choices=get_available_transfer_syntaxes(), help='Compress losslessly the uncompressed pixel data of the output files (rle is always available, jpegls and jpeg2000 are only offered if pydicom can encode them with pylibjpeg or gdcm), a summary is printed at the end')
+    parser.add_argument('--transcodeReport', action='store', help='With --transcode, path to a csv file where the compression ratio and encoding time of each file are written')
+    parser.add_argument('--pipeline', action='store_true', dest='pipeline', help='If used, files are read, anonymized and written by a pipeline of threads, and the queue statistics are printed at the end')
+    parser.set_defaults(pipeline=False)
+    parser.add_argument('--readers', action='store', type=int, default=4, help='Number of threads reading the files in pipeline mode')
+    parser.add_argument('--writers', action='store', type=int, default=2, help='Number of threads writing the files in pipeline mode')
+    parser.add_argument('--queueSize', action='store', type=int, default=16, help='Maximum number of files waiting between two stages in pipeline mode')
+    parser.add_argument('--profile', action='store', help='Path to a JSON file where the timings of the anonymization stages and actions are written, a summary is also printed')
+    parser.add_argument('--profileSample', action='store', type=int, default=100, help='With --profile, the stages and actions of one file out of profileSample are traced')
+    parser.add_argument('--watch', action='store', dest='doneFolder', help='Path to a done folder: the input folder is watched and each new file is anonymized once complete, then moved to the done folder, until Ctrl+C')
+    parser.add_argument('--pollInterval', action='store', type=float, default=1.0, help='With --watch, number of seconds between two scans of the input folder')
+    parser.add_argument('--settleTime', action='store', type=float, default=2.0, help='With --watch, number of seconds without change after which a file is considered complete')
+    parser.add_argument('--reportEvery', action='store', type=float, default=60.0, help='With --watch, number of seconds between two reports of the ingest latency and of the queue depth')
+    parser.add_argument('--uidKey', action='store', help='Path to a file containing a secret key: UIDs are then derived from the key (HMAC) instead of being random, and are the same for every run using the key')
     args = parser.parse_args()
 
     input_path = args.input
@@ -186,8 +595,62 @@ def main(defined_action_map = {}):
                     new_anonymization_actions.update(generate_actions(l, action, options))
                 cpt += 1
 
+    if args.pipeline and args.jobs > 1:
+        print('Error, --pipeline cannot be used with --jobs')
+        sys.exit()
+
+    if (is_archive(input_path) or is_archive(output_path)) and (args.pipeline or args.jobs > 1):
+        print('Error, archives cannot be used with --pipeline or --jobs')
+        sys.exit()
+
+    if args.doneFolder is not None:
+        if not os.path.isdir(input_path) or not os.path.isdir(output_path):
+            print('Error, --watch needs an input folder and an output folder')
+            sys.exit()
+        if os.path.abspath(args.doneFolder).startswith(os.path.abspath(input_path) + os.sep):
+            print('Error, the done folder cannot be inside the input folder')
+            sys.exit()
+        if args.pipeline or args.jobs > 1 or args.manifest:
+            print('Error, --watch cannot be used with --pipeline, --jobs or --manifest')
+            sys.exit()
+
+    mask_templates = ()
+    if args.pixelMasks:
+        try:
+            mask_templates = load_mask_templates(args.pixelMasks)
+        except (OSError, ValueError, KeyError) as e:
+            print('Error, invalid pixel masks file:', e)
+            sys.exit()
+
+    transfer_syntax = None
+    if args.transcode:
+        try:
+            transfer_syntax = get_transfer_syntax(args.transcode)
+        except ValueError as e:
+            print('Error,', e)
+            sys.exit()
+
+    uid_key = None
+    if args.uidKey:
+        with open(args.uidKey, 'rb') as key_file:
+            uid_key = key_file.read().strip()
+        if not uid_key:
+            print('Error, the UID key file is empty')
+            sys.exit()
+
+    if args.doneFolder is not None:
+        watch(input_path, output_path, args.doneFolder, args.lookup, new_anonymization_actions, not args.keepPrivateTags,
+              args.renameFiles, args.headerOnly, uid_key, args.store, args.pollInterval, args.settleTime, args.reportEvery,
+              args.largeFileSize * 1024 * 1024 if args.largeFileSize is not None else None, mask_templates, transfer_syntax)
+        return
+
     # Launch the anonymization
-    anonymize(input_path, output_path, args.lookup, new_anonymization_actions, not args.keepPrivateTags, args.renameFiles)
+    anonymize(input_path, output_path, args.lookup, new_anonymization_actions, not args.keepPrivateTags, args.renameFiles, args.jobs, args.headerOnly,
+              args.manifest, args.manifestHash, uid_key, args.store, args.pipeline, args.readers, args.writers, args.queueSize,
+              args.profile, args.profileSample,
+              args.largeFileSize * 1024 * 1024 if args.largeFileSize is not None else None,
+              args.memoryLimit * 1024 * 1024 if args.memoryLimit is not None else None, mask_templates,
+              transfer_syntax, args.transcodeReport)
 
 if __name__ == "__main__":
     main()
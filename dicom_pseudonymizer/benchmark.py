@@ -0,0 +1,282 @@
+'''
+Benchmark of the pseudonymizer on a synthetic corpus.
+
+Each mode runs in a new process on the same corpus and reports the throughput
+(files/s, MB/s of input files), the peak resident memory and, for the modes
+anonymizing file by file, the percentiles of the per-file latency. The report is
+written as JSON so that the results can be compared between commits.
+
+Usage, from the dicom_pseudonymizer folder:
+    python benchmark.py report.json --files 200 --modes file,file_header_only,batch_jobs
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pydicom
+
+from utils.simple_dicomanonymizer import *
+from utils.file_discovery import iter_files
+from utils.sqlite_store import SQLiteStore
+from utils.synthetic_dicom import generate_corpus
+import anonymizer
+
+# Mode -> (description, whether the files are anonymized one by one with anonymize_dicom_file)
+MODES = {
+    'file': ('anonymize_dicom_file, default options', True),
+    'file_header_only': ('anonymize_dicom_file, header only', True),
+    'file_keyed_uids': ('anonymize_dicom_file, keyed UIDs', True),
+    'file_store': ('anonymize_dicom_file, SQLite store', True),
+    'batch': ('anonymize, one process', False),
+    'batch_header_only': ('anonymize, one process, header only', False),
+    'batch_pipeline': ('anonymize, pipeline of threads', False),
+    'batch_jobs': ('anonymize, pool of processes', False),
+}
+
+LATENCY_PERCENTILES = [50, 90, 99]
+
+
+def get_peak_rss() -> dict:
+    '''
+    Get the peak resident memory (MB) of the current process and of its terminated children.
+    '''
+    try:
+        import resource
+    except ImportError: # Not available on Windows
+        return {'peak_rss_mb': None, 'peak_rss_children_mb': None}
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+        'peak_rss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit,
+    }
+
+
+def run_files(mode: str, tasks: list, work_folder: str) -> list:
+    '''
+    Anonymize the files one by one with anonymize_dicom_file.
+
+    Parameters
+    ----------
+    mode : str
+        Key of MODES.
+    tasks : list
+        (input file, output file, None) tuples generated by iter_input_files.
+    work_folder : str
+        Folder of the lookup table and of the store.
+
+    Returns
+    -------
+    l : list
+        Latency of each file, in seconds.
+    '''
+    lookup_path = os.path.join(work_folder, 'lookup_table.csv')
+    if mode == 'file_keyed_uids':
+        set_uid_key(b'benchmark')
+    store = None
+    if mode == 'file_store':
+        store = SQLiteStore(os.path.join(work_folder, 'store.sqlite'))
+        set_store(store)
+        lookup_path = None
+    plan = compile_actions({})
+
+    latencies = []
+    try:
+        for in_file, out_file, _ in tasks:
+            start = time.perf_counter()
+            anonymize_dicom_file(in_file, out_file, lookup_path, plan, header_only=mode == 'file_header_only')
+            latencies.append(time.perf_counter() - start)
+    finally:
+        set_store(None)
+        if store is not None:
+            store.close()
+        close_lookup_table()
+    return latencies
+
+
+def run_mode(mode: str, input_folder: str, output_folder: str, work_folder: str, jobs: int, results) -> None:
+    '''
+    Run a benchmark mode, in its own process, and put its measures in the results queue.
+
+    Parameters
+    ----------
+    mode : str
+        Key of MODES.
+    input_folder : str
+        Folder of the corpus.
+    output_folder : str
+        Folder of the anonymized files.
+    work_folder : str
+        Folder of the lookup table and of the store.
+    jobs : int
+        Number of processes of the 'batch_jobs' mode.
+    results : Queue
+        Queue receiving the dict of measures.
+
+    Returns
+    -------
+    None.
+    '''
+    tasks = list(anonymizer.iter_input_files(input_folder, output_folder))
+    lookup_path = os.path.join(work_folder, 'lookup_table.csv')
+
+    latencies = None
+    start = time.perf_counter()
+    if MODES[mode][1]:
+        latencies = run_files(mode, tasks, work_folder)
+    else:
+        anonymizer.anonymize(input_folder, output_folder, lookup_path, {}, True, False,
+                             jobs=jobs if mode == 'batch_jobs' else 1,
+                             header_only=mode == 'batch_header_only',
+                             pipeline=mode == 'batch_pipeline')
+    duration = time.perf_counter() - start
+
+    size = sum(os.path.getsize(task[0]) for task in tasks)
+    measures = {
+        'description': MODES[mode][0],
+        'files': len(tasks),
+        'seconds': duration,
+        'files_per_second': len(tasks) / duration,
+        'mb_per_second': size / duration / (1024 * 1024),
+    }
+    if mode == 'batch_jobs':
+        measures['jobs'] = jobs
+    measures.update(get_peak_rss())
+    if latencies:
+        latencies = np.array(latencies) * 1000
+        measures['latency_ms'] = {'mean': float(latencies.mean()), 'max': float(latencies.max())}
+        for percentile in LATENCY_PERCENTILES:
+            measures['latency_ms']['p{}'.format(percentile)] = float(np.percentile(latencies, percentile))
+    results.put(measures)
+
+
+def get_commit() -> str:
+    '''
+    Get the current git commit, None if it is unknown.
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(corpus_folder: str, modes: list, jobs: int, work_root: str) -> dict:
+    '''
+    Run the benchmark modes on a corpus.
+
+    Parameters
+    ----------
+    corpus_folder : str
+        Folder of the DICOM files to anonymize.
+    modes : list
+        Keys of MODES to run.
+    jobs : int
+        Number of processes of the 'batch_jobs' mode.
+    work_root : str
+        Folder where the outputs of each mode are written, then deleted.
+
+    Returns
+    -------
+    d : dict
+        Measures of each mode.
+    '''
+    # A fresh interpreter per mode, so that the peak memory and the module state are not shared
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for mode in modes:
+        work_folder = os.path.join(work_root, mode)
+        output_folder = os.path.join(work_folder, 'output')
+        os.makedirs(output_folder)
+
+        measures_queue = context.Queue()
+        process = context.Process(target=run_mode, args=(mode, corpus_folder, output_folder, work_folder, jobs, measures_queue))
+        process.start()
+        # The measures are read before joining: a process exits only once its queue is flushed
+        measures = None
+        while measures is None and (process.is_alive() or not measures_queue.empty()):
+            try:
+                measures = measures_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+        process.join()
+        shutil.rmtree(work_folder)
+        if measures is None or process.exitcode != 0:
+            print('Error, the mode {} failed'.format(mode))
+            sys.exit()
+
+        results[mode] = measures
+        print('{:<18} {:>8.1f} files/s {:>8.1f} MB/s {:>8.1f} MB peak'.format(
+            mode, measures['files_per_second'], measures['mb_per_second'], measures['peak_rss_mb'] or 0))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('report', help='Path to the JSON report to write')
+    parser.add_argument('--corpus', action='store', help='Folder of an existing corpus, a synthetic corpus is generated otherwise')
+    parser.add_argument('--modes', action='store', default=','.join(MODES), help='Comma separated modes among: ' + ', '.join(MODES))
+    parser.add_argument('--jobs', action='store', type=int, default=os.cpu_count(), help='Number of processes of the batch_jobs mode')
+    parser.add_argument('--files', action='store', type=int, default=200, help='Number of synthetic files')
+    parser.add_argument('--rows', action='store', type=int, default=256, help='Rows of the synthetic images')
+    parser.add_argument('--columns', action='store', type=int, default=256, help='Columns of the synthetic images')
+    parser.add_argument('--frames', action='store', type=int, default=1, help='Frames of the synthetic images')
+    parser.add_argument('--privateTags', action='store', type=int, default=8, help='Private tags per synthetic file')
+    parser.add_argument('--sequenceDepth', action='store', type=int, default=2, help='Nesting depth of the sequences of the synthetic files')
+    parser.add_argument('--overlayGroups', action='store', type=int, default=1, help='Overlay groups per synthetic file')
+    parser.add_argument('--patients', action='store', type=int, default=10, help='Number of synthetic patients')
+    parser.add_argument('--accessionsPerPatient', action='store', type=int, default=2, help='Accession numbers per synthetic patient')
+    parser.add_argument('--seed', action='store', type=int, default=0, help='Seed of the synthetic pixel data')
+    args = parser.parse_args()
+
+    modes = args.modes.split(',')
+    for mode in modes:
+        if mode not in MODES:
+            print('Error, unknown mode: ' + mode)
+            sys.exit()
+
+    corpus = {}
+    with tempfile.TemporaryDirectory() as work_root:
+        corpus_folder = args.corpus
+        if corpus_folder is None:
+            corpus_folder = os.path.join(work_root, 'corpus')
+            corpus = {
+                'files': args.files, 'rows': args.rows, 'columns': args.columns, 'frames': args.frames,
+                'private_tags': args.privateTags, 'sequence_depth': args.sequenceDepth,
+                'overlay_groups': args.overlayGroups, 'patients': args.patients,
+                'accessions_per_patient': args.accessionsPerPatient, 'seed': args.seed,
+            }
+            generate_corpus(corpus_folder, args.files, rows=args.rows, columns=args.columns, frames=args.frames,
+                            private_tags=args.privateTags, sequence_depth=args.sequenceDepth,
+                            overlay_groups=args.overlayGroups, patients=args.patients,
+                            accessions_per_patient=args.accessionsPerPatient, seed=args.seed)
+        corpus['folder'] = args.corpus
+        corpus['size_mb'] = sum(entry.stat().st_size for entry, _ in iter_files(corpus_folder)) / (1024 * 1024)
+
+        results = benchmark(corpus_folder, modes, args.jobs, work_root)
+
+    report = {
+        'commit': get_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pydicom': pydicom.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'corpus': corpus,
+        'modes': results,
+    }
+    with open(args.report, 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
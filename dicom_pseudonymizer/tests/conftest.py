@@ -0,0 +1,36 @@
+'''
+Fixtures of the tests of the pseudonymizer, run from the repository root with:
+    python -m pytest dicom_pseudonymizer/tests
+'''
+
+import os
+import sys
+
+import pytest
+
+# The modules are imported as in the scripts of the dicom_pseudonymizer folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.simple_dicomanonymizer import close_lookup_table, set_large_file_size, set_lookup_path, set_store, set_uid_key
+from utils.synthetic_dicom import generate_corpus
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    '''
+    Four small synthetic DICOM files, of two patients.
+    '''
+    return generate_corpus(str(tmp_path / 'input'), 4, patients=2, rows=32, columns=32, overlay_groups=0)
+
+
+@pytest.fixture(autouse=True)
+def module_state():
+    '''
+    Reset the module state of simple_dicomanonymizer after each test.
+    '''
+    yield
+    set_large_file_size(None)
+    set_uid_key(None)
+    set_store(None)
+    close_lookup_table()
+    set_lookup_path(None)
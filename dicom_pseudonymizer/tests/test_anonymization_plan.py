@@ -0,0 +1,38 @@
+from utils.simple_dicomanonymizer import apply_masked_actions, compile_actions, initialize_actions
+from utils.synthetic_dicom import generate_dataset
+
+
+def apply_masked_actions_one_walk_per_rule(dataset):
+    '''
+    Repeating group rules applied as before the plan: one walk of the dataset per rule, in order.
+    '''
+    for tag, action in initialize_actions().items():
+        if len(tag) > 2:
+            def callback(dataset, data_element):
+                if data_element.tag.group & tag[2] == tag[0] and data_element.tag.element & tag[3] == tag[1]:
+                    action(dataset, data_element.tag)
+            dataset.walk(callback)
+
+
+def make_dataset(path):
+    dataset = generate_dataset(path, 0, rows=16, columns=16, overlay_groups=4)
+    dataset.add_new((0x5000, 0x0000), 'UL', 0)
+    dataset.add_new((0x5002, 0x3000), 'OB', b'\x00\x01')
+    dataset.add_new((0x6004, 0x4000), 'LT', 'Overlay comment')
+    # Repeating groups in nested sequence items
+    item = dataset.ReferencedImageSequence[0]
+    item.add_new((0x6000, 0x3000), 'OW', b'\x00\x01')
+    item.ReferencedImageSequence[0].add_new((0x6002, 0x4000), 'LT', 'Nested overlay comment')
+    return dataset
+
+
+def test_single_walk_same_as_one_walk_per_rule(tmp_path):
+    dataset = make_dataset(str(tmp_path / 'image.dcm'))
+    expected = make_dataset(str(tmp_path / 'image.dcm'))
+    assert dataset == expected
+    apply_masked_actions_one_walk_per_rule(expected)
+    apply_masked_actions(compile_actions().masked_actions, dataset)
+
+    assert dataset == expected
+    assert (0x5000, 0x0000) not in dataset
+    assert (0x6000, 0x3000) not in dataset.ReferencedImageSequence[0]
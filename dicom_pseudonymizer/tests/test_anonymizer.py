@@ -0,0 +1,38 @@
+import os
+
+import anonymizer
+
+
+def test_file_vanished_before_admission(tmp_path, corpus, monkeypatch):
+    iter_input_files = anonymizer.iter_input_files
+
+    def iter_and_remove(*args):
+        for task in iter_input_files(*args):
+            if task[0] == corpus[1]:
+                os.remove(task[0])
+            yield task
+
+    monkeypatch.setattr(anonymizer, 'iter_input_files', iter_and_remove)
+    output_folder = tmp_path / 'output'
+    output_folder.mkdir()
+    manifest_path = str(tmp_path / 'manifest.csv')
+    anonymizer.anonymize(os.path.dirname(corpus[0]), str(output_folder), str(tmp_path / 'lookup.csv'), {}, True, False,
+                         jobs=2, memory_limit=1 << 30, manifest_path=manifest_path)
+
+    assert sorted(os.listdir(output_folder)) == sorted(os.path.basename(path) for path in corpus if path != corpus[1])
+    with open(manifest_path) as manifest_file:
+        assert os.path.basename(corpus[1]) not in manifest_file.read()
+
+
+def test_output_folder_inside_input_folder(tmp_path, corpus):
+    input_folder = os.path.dirname(corpus[0])
+    output_folder = os.path.join(input_folder, 'output')
+    os.mkdir(output_folder)
+    manifest_path = str(tmp_path / 'manifest.csv')
+    for _ in range(2):
+        anonymizer.anonymize(input_folder, output_folder, str(tmp_path / 'lookup.csv'), {}, True, False,
+                             manifest_path=manifest_path)
+
+    assert sorted(os.listdir(output_folder)) == sorted(os.path.basename(path) for path in corpus)
+    with open(manifest_path) as manifest_file:
+        assert len(manifest_file.read().splitlines()) == 1 + len(corpus)
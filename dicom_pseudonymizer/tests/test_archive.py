@@ -0,0 +1,106 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pydicom
+import pytest
+
+import utils.archive as archive
+from utils.archive import MemberWriter, anonymize_archive, get_safe_name
+from utils.simple_dicomanonymizer import compile_actions, set_large_file_size
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('a.dcm', 'a.dcm'),
+    ('./dir/./a.dcm', 'dir/a.dcm'),
+    ('dir/../a.dcm', 'a.dcm'),
+    ('dir\\a.dcm', 'dir/a.dcm'),
+    ('../a.dcm', None),
+    ('dir/../../a.dcm', None),
+    ('/etc/a.dcm', None),
+    ('.', None),
+])
+def test_get_safe_name(name, expected):
+    assert get_safe_name(name) == expected
+
+
+def test_member_writer_rejects_unsafe_names(tmp_path):
+    with MemberWriter(str(tmp_path / 'output')) as writer:
+        for name in ('../escaped.dcm', '/absolute.dcm', 'dir/../../escaped.dcm'):
+            with pytest.raises(ValueError):
+                writer.write(name, b'data')
+    assert not (tmp_path / 'escaped.dcm').exists()
+
+
+def test_unsafe_members_are_skipped(tmp_path, corpus):
+    data = open(corpus[0], 'rb').read()
+    input_path = str(tmp_path / 'input.zip')
+    with zipfile.ZipFile(input_path, 'w') as input_archive:
+        for name in ('../escaped.dcm', '/absolute.dcm', 'dir/ok.dcm'):
+            input_archive.writestr(name, data)
+    output_folder = tmp_path / 'output'
+    output_folder.mkdir()
+
+    anonymize_archive(input_path, str(output_folder), str(tmp_path / 'lookup.csv'), compile_actions({}), True, False)
+
+    assert sorted(str(path.relative_to(tmp_path)) for path in tmp_path.rglob('*.dcm')
+                  if 'input' not in str(path)) == ['output/dir/ok.dcm']
+
+
+@pytest.mark.parametrize('extension', ['.zip', '.tar.gz'])
+def test_folder_to_archive(tmp_path, corpus, extension):
+    output_path = str(tmp_path / ('output' + extension))
+    anonymize_archive(os.path.dirname(corpus[0]), output_path, str(tmp_path / 'lookup.csv'), compile_actions({}), True, False)
+
+    if extension == '.zip':
+        with zipfile.ZipFile(output_path) as output_archive:
+            members = {name: output_archive.read(name) for name in output_archive.namelist()}
+    else:
+        with tarfile.open(output_path) as output_archive:
+            members = {info.name: output_archive.extractfile(info).read() for info in output_archive}
+    assert sorted(members) == sorted(os.path.basename(path) for path in corpus)
+    for path in corpus:
+        original = pydicom.dcmread(path)
+        anonymized = pydicom.dcmread(io.BytesIO(members[os.path.basename(path)]))
+        assert anonymized.PatientID != original.PatientID
+        assert anonymized.PixelData == original.PixelData
+
+
+def test_single_file_to_archive(tmp_path, corpus):
+    output_path = str(tmp_path / 'output.zip')
+    anonymize_archive(corpus[0], output_path, str(tmp_path / 'lookup.csv'), compile_actions({}), True, False)
+    with zipfile.ZipFile(output_path) as output_archive:
+        assert output_archive.namelist() == [os.path.basename(corpus[0])]
+
+
+@pytest.mark.parametrize('extension', ['.zip', '.tar'])
+def test_large_member_is_read_header_only(tmp_path, corpus, monkeypatch, extension):
+    input_path = str(tmp_path / ('input' + extension))
+    if extension == '.zip':
+        with zipfile.ZipFile(input_path, 'w') as input_archive:
+            input_archive.write(corpus[0], 'large.dcm')
+    else:
+        with tarfile.open(input_path, 'w') as input_archive:
+            input_archive.add(corpus[0], 'large.dcm')
+
+    # The pixel data must not be loaded, only copied to the output
+    loaded = []
+    read_dicom_file = archive.read_dicom_file
+
+    def spy(fp, header_only=False):
+        dataset, pixel_data_range = read_dicom_file(fp, header_only)
+        loaded.append('PixelData' in dataset)
+        return dataset, pixel_data_range
+
+    monkeypatch.setattr(archive, 'read_dicom_file', spy)
+    set_large_file_size(os.path.getsize(corpus[0]))
+    output_folder = tmp_path / 'output'
+    output_folder.mkdir()
+    anonymize_archive(input_path, str(output_folder), str(tmp_path / 'lookup.csv'), compile_actions({}), True, False)
+
+    assert loaded == [False]
+    anonymized = pydicom.dcmread(str(output_folder / 'large.dcm'))
+    original = pydicom.dcmread(corpus[0])
+    assert anonymized.PatientID != original.PatientID
+    assert anonymized.PixelData == original.PixelData
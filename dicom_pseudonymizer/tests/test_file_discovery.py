@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from utils.file_discovery import iter_files
+
+
+def make_tree(root):
+    for relative_path in ('b.dcm', 'a/c.dcm', 'a/d/e.dcm', 'output/f.dcm'):
+        path = root / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'')
+
+
+def test_iter_files_sorted(tmp_path):
+    make_tree(tmp_path)
+    assert [relative_path for _, relative_path in iter_files(str(tmp_path))] == [
+        'a/c.dcm', 'a/d/e.dcm', 'b.dcm', 'output/f.dcm']
+
+
+def test_iter_files_excludes_folders(tmp_path):
+    make_tree(tmp_path)
+    relative_paths = [relative_path for _, relative_path in iter_files(str(tmp_path), exclude=(str(tmp_path / 'output'),))]
+    assert relative_paths == ['a/c.dcm', 'a/d/e.dcm', 'b.dcm']
+
+
+def test_iter_files_symlink_loop(tmp_path):
+    make_tree(tmp_path)
+    try:
+        os.symlink(str(tmp_path), str(tmp_path / 'a' / 'd' / 'loop'), target_is_directory=True)
+        os.symlink(str(tmp_path / 'a'), str(tmp_path / 'z'), target_is_directory=True)
+    except (OSError, NotImplementedError):
+        pytest.skip('symbolic links not supported')
+    assert [relative_path for _, relative_path in iter_files(str(tmp_path))] == [
+        'a/c.dcm', 'a/d/e.dcm', 'b.dcm', 'output/f.dcm']
@@ -0,0 +1,30 @@
+import pydicom
+import pytest
+
+from utils.simple_dicomanonymizer import anonymize_dicom_file, compile_actions, set_large_file_size, set_uid_key
+
+
+def anonymize(in_file, out_file, lookup_file, header_only=False):
+    set_uid_key(b'test key')
+    anonymize_dicom_file(in_file, out_file, lookup_file, compile_actions(), header_only=header_only)
+
+
+@pytest.mark.parametrize('mode', ['header_only', 'large_file_size'])
+def test_header_only_same_output(tmp_path, corpus, mode):
+    lookup_file = str(tmp_path / 'lookup.csv')
+    for index, in_file in enumerate(corpus):
+        full_file = str(tmp_path / 'full{}.dcm'.format(index))
+        header_file = str(tmp_path / 'header{}.dcm'.format(index))
+        anonymize(in_file, full_file, lookup_file)
+        if mode == 'large_file_size':
+            set_large_file_size(1)
+        anonymize(in_file, header_file, lookup_file, header_only=mode == 'header_only')
+        set_large_file_size(None)
+
+        with open(full_file, 'rb') as full_fp, open(header_file, 'rb') as header_fp:
+            assert full_fp.read() == header_fp.read()
+        original = pydicom.dcmread(in_file)
+        anonymized = pydicom.dcmread(header_file)
+        assert anonymized.PixelData == original.PixelData
+        assert anonymized.PatientID != original.PatientID
+        assert anonymized.SOPInstanceUID != original.SOPInstanceUID
@@ -0,0 +1,99 @@
+import csv
+import os
+
+from utils.lookup_merge import compact_lookup_table, finish_compaction, merge_lookup_tables
+from utils.lookup_table import LOOKUP_TABLE_HEADER, LookupTable, ShardedLookupTable, get_shard_paths
+
+
+def write_table(path, rows):
+    with open(path, 'w', newline='') as csvfile:
+        csv.writer(csvfile, lineterminator='\n').writerows([LOOKUP_TABLE_HEADER] + rows)
+    return path
+
+
+def read_rows(path):
+    with open(path, newline='') as csvfile:
+        return list(csv.reader(csvfile))[1:]
+
+
+def read_sharded_rows(path):
+    return sorted(row for shard_path in get_shard_paths(path)[1] for row in read_rows(shard_path))
+
+
+def test_merge_keeps_the_first_pseudonyms(tmp_path):
+    site1 = write_table(str(tmp_path / 'site1.csv'), [['P1', 'NP1', 'A1', 'NA1'], ['P2', 'NP2', 'A2', 'NA2']])
+    site2 = write_table(str(tmp_path / 'site2.csv'), [['P1', 'XP1', 'A1', 'XA1'], ['P1', 'XP1', 'A3', 'NA3'],
+                                                      ['P2', 'NP2', 'A2', 'NA2']])
+    conflicts_path = str(tmp_path / 'conflicts.csv')
+
+    stats = merge_lookup_tables([site1, site2], str(tmp_path / 'merged.csv'), shards=4, conflicts_path=conflicts_path,
+                                chunk_rows=2)
+
+    assert sorted(read_rows(str(tmp_path / 'merged.csv'))) == [
+        ['P1', 'NP1', 'A1', 'NA1'], ['P1', 'NP1', 'A3', 'NA3'], ['P2', 'NP2', 'A2', 'NA2']]
+    assert stats['rows'] == 3
+    assert stats['patients'] == 2
+    assert stats['patient_conflicts'] == 1
+    assert stats['accession_conflicts'] == 1
+    assert len(read_rows(conflicts_path)) == 2
+
+
+def test_merge_to_sharded_table(tmp_path):
+    rows = [['P{}'.format(i), 'NP{}'.format(i), 'A{}'.format(i), 'NA{}'.format(i)] for i in range(30)]
+    site = write_table(str(tmp_path / 'site.csv'), rows)
+    output_path = str(tmp_path / 'merged')
+
+    merge_lookup_tables([site], output_path, shards=4, chunk_rows=7)
+
+    assert get_shard_paths(output_path)[0] == 4
+    assert read_sharded_rows(output_path) == sorted(rows)
+    with ShardedLookupTable(output_path) as table:
+        assert table.get_pseudonyms('P3', 'A3', 'X', 'Y') == ('NP3', 'NA3')
+
+
+def test_compact_csv_table(tmp_path):
+    path = write_table(str(tmp_path / 'lookup.csv'), [['P2', 'NP2', 'A2', 'NA2'], ['P1', 'NP1', 'A1', 'NA1'],
+                                                      ['P2', 'NP2', 'A2', 'NA2']])
+
+    stats = compact_lookup_table(path)
+
+    assert stats['duplicates'] == 1
+    assert read_rows(path) == [['P1', 'NP1', 'A1', 'NA1'], ['P2', 'NP2', 'A2', 'NA2']]
+    with LookupTable(path) as table:
+        assert table.get_pseudonyms('P2', 'A2', 'X', 'Y') == ('NP2', 'NA2')
+
+
+def test_compact_sharded_table(tmp_path):
+    path = str(tmp_path / 'lookup')
+    with ShardedLookupTable(path, shards=4) as table:
+        for i in range(10):
+            table.get_pseudonyms('P{}'.format(i), 'A{}'.format(i), 'NP{}'.format(i), 'NA{}'.format(i))
+    rows = read_sharded_rows(path)
+
+    compact_lookup_table(path + '/', shards=2)
+
+    assert get_shard_paths(path)[0] == 2
+    assert read_sharded_rows(path) == rows
+    assert sorted(os.listdir(str(tmp_path))) == ['lookup']
+
+
+def test_finish_interrupted_compaction(tmp_path):
+    path = str(tmp_path / 'lookup')
+    with ShardedLookupTable(path, shards=4) as table:
+        for i in range(10):
+            table.get_pseudonyms('P{}'.format(i), 'A{}'.format(i), 'NP{}'.format(i), 'NA{}'.format(i))
+    rows = read_sharded_rows(path)
+
+    # Interrupted during the merge: the partial compacted table is removed
+    os.makedirs(path + '.compact')
+    finish_compaction(path)
+    assert sorted(os.listdir(str(tmp_path))) == ['lookup']
+    assert read_sharded_rows(path) == rows
+
+    # Interrupted during the swap: the complete compacted table is moved in place
+    merge_lookup_tables([path], path + '.compact', shards=2)
+    os.replace(path, path + '.old')
+    finish_compaction(path)
+    assert sorted(os.listdir(str(tmp_path))) == ['lookup']
+    assert get_shard_paths(path)[0] == 2
+    assert read_sharded_rows(path) == rows
@@ -0,0 +1,88 @@
+import csv
+import os
+
+from utils.lookup_table import (LOOKUP_TABLE_HEADER, SHARD_NAME, LookupTable, ShardedLookupTable, get_shard,
+                                get_shard_paths, open_lookup_table)
+
+
+def read_rows(path):
+    with open(path, newline='') as csvfile:
+        return list(csv.reader(csvfile))
+
+
+def test_pseudonyms_of_known_patients_and_accession_numbers(tmp_path):
+    with LookupTable(str(tmp_path / 'lookup.csv')) as table:
+        assert table.get_pseudonyms('P1', 'A1', 'NP1', 'NA1') == ('NP1', 'NA1')
+        # Known accession number: its pseudonyms are kept
+        assert table.get_pseudonyms('P1', 'A1', 'NP2', 'NA2') == ('NP1', 'NA1')
+        # New accession number of a known patient: the patient pseudonym is kept
+        assert table.get_pseudonyms('P1', 'A2', 'NP3', 'NA3') == ('NP1', 'NA3')
+
+    assert read_rows(str(tmp_path / 'lookup.csv')) == [
+        LOOKUP_TABLE_HEADER, ['P1', 'NP1', 'A1', 'NA1'], ['P1', 'NP1', 'A2', 'NA3']]
+
+
+def test_first_row_wins(tmp_path):
+    path = str(tmp_path / 'lookup.csv')
+    with open(path, 'w', newline='') as csvfile:
+        csv.writer(csvfile, lineterminator='\n').writerows([
+            LOOKUP_TABLE_HEADER, ['P1', 'NP1', 'A1', 'NA1'], ['P1', 'NP2', 'A1', 'NA2'], ['P1', 'NP2', 'A2', 'NA3']])
+
+    table = LookupTable(path)
+    assert table.get_pseudonyms('P1', 'A1', 'X', 'Y') == ('NP1', 'NA1')
+    assert table.get_pseudonyms('P1', 'A3', 'X', 'Y') == ('NP1', 'Y')
+    table.close()
+
+
+def test_rows_appended_by_batches(tmp_path):
+    path = str(tmp_path / 'lookup.csv')
+    table = LookupTable(path, flush_every=2)
+    table.get_pseudonyms('P1', 'A1', 'NP1', 'NA1')
+    assert len(read_rows(path)) == 1
+    table.get_pseudonyms('P2', 'A2', 'NP2', 'NA2')
+    assert len(read_rows(path)) == 3
+    table.get_pseudonyms('P3', 'A3', 'NP3', 'NA3')
+    assert len(read_rows(path)) == 3
+    table.close()
+    assert len(read_rows(path)) == 4
+
+
+def test_reopened_table(tmp_path):
+    path = str(tmp_path / 'lookup.csv')
+    with LookupTable(path) as table:
+        table.get_pseudonyms('P1', 'A1', 'NP1', 'NA1')
+    with LookupTable(path) as table:
+        assert table.get_pseudonyms('P1', 'A2', 'NP2', 'NA2') == ('NP1', 'NA2')
+
+    rows = read_rows(path)
+    assert rows.count(LOOKUP_TABLE_HEADER) == 1
+    assert rows[1:] == [['P1', 'NP1', 'A1', 'NA1'], ['P1', 'NP1', 'A2', 'NA2']]
+
+
+def test_in_memory_table():
+    table = LookupTable(None)
+    assert table.get_pseudonyms('P1', 'A1', 'NP1', 'NA1') == ('NP1', 'NA1')
+    assert table.get_pseudonyms('P1', 'A2', 'NP2', 'NA2') == ('NP1', 'NA2')
+    table.close()
+
+
+def test_sharded_table(tmp_path):
+    path = str(tmp_path / 'lookup') + '/'
+    table = open_lookup_table(path)
+    assert isinstance(table, ShardedLookupTable)
+    patients = ['P{}'.format(i) for i in range(20)]
+    with table:
+        for patient in patients:
+            table.get_pseudonyms(patient, 'A' + patient, 'N' + patient, 'NA' + patient)
+
+    shard_count, shard_paths = get_shard_paths(path)
+    assert shard_count == table.shard_count
+    for patient in patients:
+        shard_path = os.path.join(path, SHARD_NAME.format(get_shard(patient, shard_count), shard_count))
+        assert [patient, 'N' + patient, 'A' + patient, 'NA' + patient] in read_rows(shard_path)
+    assert sum(len(read_rows(shard_path)) - 1 for shard_path in shard_paths) == len(patients)
+
+    # The shards are found again, with the number of shards of the table
+    with ShardedLookupTable(path, shards=3) as table:
+        assert table.shard_count == shard_count
+        assert table.get_pseudonyms('P1', 'B', 'X', 'Y') == ('NP1', 'Y')
@@ -0,0 +1,59 @@
+import errno
+import os
+import shutil
+import threading
+
+import utils.watch_folder as watch_folder_module
+from utils.simple_dicomanonymizer import compile_actions
+from utils.watch_folder import watch_folder
+
+
+def run_watch(tmp_path, corpus, **kwargs):
+    input_folder = os.path.dirname(corpus[0])
+    output_folder, done_folder = str(tmp_path / 'output'), str(tmp_path / 'done')
+    return watch_folder(input_folder, output_folder, done_folder, str(tmp_path / 'lookup.csv'), compile_actions({}),
+                        True, False, poll_interval=0.0, settle_time=0.0, report_every=0, **kwargs)
+
+
+def test_files_are_anonymized_and_moved(tmp_path, corpus):
+    report = run_watch(tmp_path, corpus, max_files=len(corpus))
+    assert report['files'] == len(corpus) and report['failed'] == 0
+    for path in corpus:
+        name = os.path.basename(path)
+        assert not os.path.exists(path)
+        assert (tmp_path / 'done' / name).exists() and (tmp_path / 'output' / name).exists()
+
+
+def test_done_folder_on_another_file_system(tmp_path, corpus, monkeypatch):
+    rename = os.rename
+
+    def cross_device_rename(source, destination, *args, **kwargs):
+        if os.path.dirname(source) == os.path.dirname(corpus[0]):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        return rename(source, destination, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'rename', cross_device_rename)
+    monkeypatch.setattr(os, 'replace', cross_device_rename)
+    report = run_watch(tmp_path, corpus, max_files=len(corpus))
+    assert report['files'] == len(corpus) and report['failed'] == 0
+    assert sorted(os.listdir(tmp_path / 'done')) == sorted(os.path.basename(path) for path in corpus)
+
+
+def test_failed_move_does_not_stop_the_run(tmp_path, corpus, monkeypatch):
+    move = shutil.move
+    stop = threading.Event()
+    moved = []
+
+    def failing_move(source, destination):
+        if source == corpus[0]:
+            raise PermissionError(errno.EACCES, 'locked')
+        moved.append(source)
+        if len(moved) == len(corpus) - 1:
+            stop.set()
+        return move(source, destination)
+
+    monkeypatch.setattr(watch_folder_module.shutil, 'move', failing_move)
+    report = run_watch(tmp_path, corpus, stop=stop)
+    assert report['files'] == len(corpus) - 1 and report['failed'] == 1
+    # Kept in the input folder, not retried until modified
+    assert os.path.exists(corpus[0])
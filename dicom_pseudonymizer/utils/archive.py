@@ -0,0 +1,261 @@
+'''
+Anonymization from and to zip and tar archives, without extracting them.
+
+The members of the input archive (or the files of the input folder) are read one at
+a time, anonymized and written directly to the output archive (or folder). A member
+smaller than the large file size (cf set_large_file_size) is read in memory. A larger
+one is copied to a temporary file and read header only, its pixel data being copied
+by blocks, and the output files are written to a spooled temporary file which only
+stays in memory up to SPOOL_SIZE bytes, so that the memory used is bounded by the
+large file size. Tar archives are read as a stream, compressed ones included.
+'''
+
+import io
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from utils.simple_dicomanonymizer import *
+from utils.file_discovery import iter_files
+
+# Extension -> tarfile write mode
+TAR_WRITE_MODES = {
+    '.tar': 'w',
+    '.tar.gz': 'w:gz',
+    '.tgz': 'w:gz',
+    '.tar.bz2': 'w:bz2',
+    '.tar.xz': 'w:xz',
+}
+ARCHIVE_EXTENSIONS = ('.zip',) + tuple(TAR_WRITE_MODES)
+
+# Size in bytes up to which an anonymized file is kept in memory before being written
+SPOOL_SIZE = 16 * 1024 * 1024
+
+
+def is_archive(path: str) -> bool:
+    '''
+    Whether a path is a zip or tar archive, from its extension.
+    '''
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def get_safe_name(name: str):
+    '''
+    Normalize the name of a member, relative to the archive root or to the folder.
+
+    Returns
+    -------
+    s : str
+        The name with '/' separators and without '.' components, or None if it is
+        absolute or goes up with '..', which would write outside of the output.
+    '''
+    name = posixpath.normpath(name.replace('\\', '/'))
+    if name.startswith('/') or os.path.splitdrive(name)[0] or name == '.' or '..' in name.split('/'):
+        return None
+    return name
+
+
+def iter_members(path: str):
+    '''
+    Generate the files of an archive, of a folder (recursively) or a single file, one at a time.
+
+    The members whose name is not safe (cf get_safe_name) are skipped.
+
+    Parameters
+    ----------
+    path : str
+        Path to a zip or tar archive, to a folder or to a file.
+
+    Returns
+    -------
+    g : generator
+        (relative path, binary file-like object, size in bytes) tuples. The file-like
+        object is only valid until the next member is generated.
+    '''
+    if not is_archive(path):
+        if os.path.isfile(path):
+            files = [(path, os.path.basename(path))]
+        else:
+            files = ((entry.path, relative_path) for entry, relative_path in iter_files(path))
+        for file_path, relative_path in files:
+            with open(file_path, 'rb') as fp:
+                yield relative_path, fp, os.fstat(fp.fileno()).st_size
+        return
+
+    if path.lower().endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        members = ((info.filename, info, info.file_size) for info in archive.infolist() if not info.is_dir())
+        open_member = archive.open
+    else:
+        # Stream mode: the members are read in order, without seeking
+        archive = tarfile.open(path, 'r|*')
+        members = ((info.name, info, info.size) for info in archive if info.isfile())
+        open_member = archive.extractfile
+    with archive:
+        for name, info, size in members:
+            safe_name = get_safe_name(name)
+            if safe_name is None:
+                print('Warning, member skipped, its name is absolute or outside of the archive:', name)
+                continue
+            with open_member(info) as fp:
+                yield safe_name, fp, size
+
+
+class MemberWriter:
+    '''
+    Writer of the anonymized files to a zip or tar archive, or to a folder.
+
+    Parameters
+    ----------
+    path : str
+        Path to the archive, whose type is given by its extension, or to the folder.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        # Folder -> number of files written in it, to number the renamed files
+        self.folder_counts = {}
+        self.zip_archive = None
+        self.tar_archive = None
+        lower_path = path.lower()
+        if lower_path.endswith('.zip'):
+            self.zip_archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        elif is_archive(path):
+            mode = next(mode for extension, mode in TAR_WRITE_MODES.items() if lower_path.endswith(extension))
+            self.tar_archive = tarfile.open(path, mode)
+
+    def get_file_number(self, name: str) -> int:
+        '''
+        Get the number of files already written in the folder of a member.
+        '''
+        return self.folder_counts.get(os.path.dirname(name), 0)
+
+    def write(self, name: str, data) -> None:
+        '''
+        Write a file.
+
+        Parameters
+        ----------
+        name : str
+            Path of the file relative to the archive root or to the folder, with '/' separators.
+        data : bytes-like or binary file-like object
+            Content of the file, or seekable file positioned at its start, copied by blocks.
+
+        Returns
+        -------
+        None.
+
+        Raises
+        ------
+        ValueError
+            If the name is absolute or outside of the archive or folder, cf get_safe_name.
+        '''
+        safe_name = get_safe_name(name)
+        if safe_name is None:
+            raise ValueError('Unsafe member name: ' + name)
+        name = safe_name
+        folder = os.path.dirname(name)
+        self.folder_counts[folder] = self.folder_counts.get(folder, 0) + 1
+        if not hasattr(data, 'read'):
+            data = io.BytesIO(data)
+        if self.zip_archive is not None:
+            # The size is unknown until the end of the copy
+            with self.zip_archive.open(name, 'w', force_zip64=True) as out_fp:
+                shutil.copyfileobj(data, out_fp, PIXEL_DATA_CHUNK_SIZE)
+        elif self.tar_archive is not None:
+            info = tarfile.TarInfo(name)
+            start = data.tell()
+            info.size = data.seek(0, io.SEEK_END) - start
+            data.seek(start)
+            info.mtime = time.time()
+            self.tar_archive.addfile(info, data)
+        else:
+            out_file = os.path.join(self.path, name)
+            # A symbolic link of the folder could still lead outside of it
+            root = os.path.realpath(self.path)
+            if os.path.commonpath([root, os.path.realpath(out_file)]) != root:
+                raise ValueError('Member outside of the output folder: ' + name)
+            os.makedirs(os.path.dirname(out_file), exist_ok=True)
+            with open(out_file, 'wb') as out_fp:
+                shutil.copyfileobj(data, out_fp, PIXEL_DATA_CHUNK_SIZE)
+
+    def close(self) -> None:
+        '''
+        Finish the archive.
+        '''
+        if self.zip_archive is not None:
+            self.zip_archive.close()
+        if self.tar_archive is not None:
+            self.tar_archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def anonymize_archive(input_path: str, output_path: str, lookup_path: str, anonymization_actions: AnonymizationPlan,
+                      delete_private_tags: bool, rename_files: bool, on_done=None) -> None:
+    '''
+    Anonymize the members of an archive, of a folder or a single file into an archive
+    or a folder, at least one of them being an archive.
+
+    Parameters
+    ----------
+    input_path : str
+        Path to the input zip or tar archive, folder or file. The members with an absolute
+        name or a name going up with '..' are skipped.
+    output_path : str
+        Path to the output zip or tar archive, created, or folder.
+    lookup_path : str
+        Path to lookup table csv path.
+    anonymization_actions : AnonymizationPlan
+        Plan of the actions that will be applied on tags.
+    delete_private_tags : bool
+        Whether to delete private tags.
+    rename_files : bool
+        Whether to remane output files with pseudo.
+    on_done : callable
+        Function called without argument after each file.
+
+    Returns
+    -------
+    None.
+    '''
+    set_lookup_path(lookup_path)
+    profiler = get_profiler()
+    with MemberWriter(output_path) as writer:
+        for name, fp, size in iter_members(input_path):
+            if profiler is not None:
+                profiler.begin_file(input_path + '/' + name)
+            # A large member is read header only from a temporary file, its pixel data
+            # being copied by blocks, the others are read in memory
+            large = is_large_size(size)
+            with tempfile.TemporaryFile() if large else io.BytesIO() as member_fp:
+                shutil.copyfileobj(fp, member_fp, PIXEL_DATA_CHUNK_SIZE)
+                member_fp.seek(0)
+                dataset, pixel_data_range = read_dicom_file(member_fp, large)
+                dataset, pixel_data_range = load_pixel_data_to_mask(dataset, member_fp, pixel_data_range,
+                                                                    anonymization_actions)
+                anonymize_dataset(dataset, anonymization_actions, delete_private_tags)
+
+                if rename_files:
+                    folder = name[:name.rfind('/') + 1]
+                    pseudo = str(dataset.PatientID) + '-' + str(dataset.AccessionNumber)
+                    name = folder + str(writer.get_file_number(name)) + '_' + pseudo
+                with profile_stage('write'), tempfile.SpooledTemporaryFile(SPOOL_SIZE) as out_fp:
+                    transcode_pixel_data(dataset, name, pixel_data_range)
+                    write_dicom_file(dataset, out_fp, member_fp, pixel_data_range)
+                    out_fp.seek(0)
+                    writer.write(name, out_fp)
+                    commit_store()
+
+            if profiler is not None:
+                profiler.end_file()
+            if on_done is not None:
+                on_done()
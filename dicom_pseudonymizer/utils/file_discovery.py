@@ -0,0 +1,150 @@
+'''
+Lazy discovery of the files of an input tree and manifest of the files already
+anonymized, so that an interrupted or repeated run only processes new files.
+
+The manifest is a csv file with the columns: 'path', 'size', 'mtime', 'sha256'
+where path is relative to the input folder and mtime is in nanoseconds.
+'''
+
+import csv
+import hashlib
+import os
+
+MANIFEST_HEADER = ['path', 'size', 'mtime', 'sha256']
+
+
+def get_folder_key(path: str) -> tuple:
+    '''
+    Identify a folder whatever the path (symbolic links, relative path...) it is reached by.
+    '''
+    # os.stat rather than DirEntry.stat, whose st_ino is 0 on Windows
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino
+
+
+def iter_files(folder: str, relative_folder: str = '', exclude=(), visited: set = None):
+    '''
+    Recursively generate the files of a folder, sorted by name in each folder.
+
+    The symbolic links to folders are followed, but each folder is crossed once, so that
+    a link to one of its parent folders does not make the recursion endless.
+
+    Parameters
+    ----------
+    folder : str
+        Path to the folder to cross.
+    relative_folder : str
+        Path of folder relative to the root of the tree, used in the recursion.
+    exclude : iterable of str
+        Folders not to cross, e.g. the output folder when it is inside the input folder.
+    visited : set
+        Keys of the folders already crossed (cf get_folder_key), used in the recursion.
+
+    Returns
+    -------
+    g : generator
+        (os.DirEntry, relative path) couples, where the relative path uses '/' as separator.
+    '''
+    if visited is None:
+        visited = {get_folder_key(path) for path in exclude if os.path.isdir(path)}
+        visited.add(get_folder_key(folder))
+    with os.scandir(folder) as iterator:
+        entries = sorted(iterator, key=lambda entry: entry.name)
+    for entry in entries:
+        relative_path = relative_folder + entry.name
+        if entry.is_dir():
+            try:
+                key = get_folder_key(entry.path)
+            except OSError: # Removed since the folder was listed
+                continue
+            if key in visited:
+                continue
+            visited.add(key)
+            yield from iter_files(entry.path, relative_path + '/', visited=visited)
+        elif entry.is_file():
+            yield entry, relative_path
+
+
+def file_sha256(path: str) -> str:
+    '''
+    Compute the SHA-256 of a file content, read by blocks.
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class Manifest:
+    '''
+    Checkpoint of the input files already anonymized.
+
+    Each completed file is appended to the csv file as soon as it is added, so that
+    the manifest is up to date whenever the run is interrupted.
+
+    Parameters
+    ----------
+    path : str
+        Path to the manifest csv file. Created if it does not exist.
+    hash_files : bool
+        Whether to record the SHA-256 of the files. A file whose size is unchanged but
+        whose modification time changed is then only processed again if its content changed.
+    '''
+
+    def __init__(self, path: str, hash_files: bool = False):
+        self.path = path
+        self.hash_files = hash_files
+        # Relative path -> (size, mtime, sha256)
+        self.entries = {}
+
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not is_new:
+            with open(path, 'r', newline='') as csvfile:
+                for row in csv.DictReader(csvfile):
+                    self.entries[row['path']] = (int(row['size']), int(row['mtime']), row['sha256'])
+
+        self.file = open(path, 'a', newline='', buffering=1)
+        self.writer = csv.writer(self.file, lineterminator='\n')
+        if is_new:
+            self.writer.writerow(MANIFEST_HEADER)
+
+    def get_record(self, relative_path: str, path: str, stat: os.stat_result):
+        '''
+        Check whether a file was already anonymized.
+
+        Parameters
+        ----------
+        relative_path : str
+            Path of the file relative to the input folder.
+        path : str
+            Path of the file.
+        stat : os.stat_result
+            Current status of the file.
+
+        Returns
+        -------
+        r : dict or None
+            None if the file was already anonymized, else the record to give to add
+            once it is. The 'sha256' field of the record is to be filled if hash_files is set.
+        '''
+        entry = self.entries.get(relative_path)
+        if entry is not None and entry[0] == stat.st_size:
+            if entry[1] == stat.st_mtime_ns:
+                return None
+            if self.hash_files and entry[2] and file_sha256(path) == entry[2]:
+                return None
+        return {'path': relative_path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': ''}
+
+    def add(self, record: dict) -> None:
+        '''
+        Mark a file as anonymized.
+        '''
+        self.entries[record['path']] = (record['size'], record['mtime'], record['sha256'])
+        self.writer.writerow([record[column] for column in MANIFEST_HEADER])
+
+    def close(self) -> None:
+        '''
+        Close the manifest file.
+        '''
+        self.file.close()
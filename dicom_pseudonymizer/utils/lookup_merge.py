@@ -0,0 +1,252 @@
+'''
+Merge of lookup tables (e.g. one per site) and compaction of a lookup table, with a
+bounded memory whatever the number of rows.
+
+The input tables (csv files or sharded folders, cf ShardedLookupTable) are read as a
+stream and their rows partitioned by shard into sorted runs of at most `chunk_rows` rows
+written to a temporary folder. The runs of each shard are then merged in order of
+original patient ID, so that the rows of a patient are consecutive:
+- a patient pseudonymized differently by several inputs keeps the pseudonym of the first
+  input (in the order of the inputs, then of the rows), the other rows are rewritten with it,
+- a duplicated accession number of a patient is only kept once, with its first pseudonym.
+The discarded pseudonyms are reported in an optional conflicts csv file.
+
+Usage, from the dicom_pseudonymizer folder:
+    python -m utils.lookup_merge merge path/to/merged/ path/to/site1.csv path/to/site2/ --conflicts conflicts.csv
+    python -m utils.lookup_merge compact path/to/lookup/
+'''
+
+import argparse
+import csv
+import heapq
+import os
+import shutil
+import tempfile
+
+from utils.lookup_table import DEFAULT_SHARDS, LOOKUP_TABLE_HEADER, SHARD_NAME, get_shard, get_shard_paths, is_sharded
+
+CONFLICTS_HEADER = ['type', 'old_value', 'kept_pseudonym', 'discarded_pseudonym', 'source']
+
+
+def iter_table_rows(path: str):
+    '''
+    Generate the rows of a lookup table csv file or sharded folder, without the header.
+    '''
+    paths = get_shard_paths(path)[1] if is_sharded(path) else [path]
+    for table_path in paths:
+        with open(table_path, 'r', newline='') as csvfile:
+            for row in csv.reader(csvfile):
+                if row and row != LOOKUP_TABLE_HEADER:
+                    yield row
+
+
+def write_runs(buffers: list, runs: list, run_folder: str) -> None:
+    '''
+    Sort the buffered rows of each shard and write them as a new run of the shard.
+    '''
+    for shard, buffer in enumerate(buffers):
+        if buffer:
+            buffer.sort()
+            run_path = os.path.join(run_folder, 'run-{}-{}.csv'.format(shard, len(runs[shard])))
+            with open(run_path, 'w', newline='') as csvfile:
+                csv.writer(csvfile, lineterminator='\n').writerows(buffer)
+            runs[shard].append(run_path)
+            buffer.clear()
+
+
+def read_run(run_path: str):
+    '''
+    Generate the rows of a run, as (old patient ID, source, row number, new patient ID,
+    old accession number, new accession number) tuples.
+    '''
+    with open(run_path, 'r', newline='') as csvfile:
+        for row in csv.reader(csvfile):
+            yield row[0], int(row[1]), int(row[2]), row[3], row[4], row[5]
+
+
+def merge_shard(runs: list, writer, conflicts_writer, sources: list, stats: dict) -> None:
+    '''
+    Merge the sorted runs of a shard, resolving the conflicts, cf module documentation.
+    '''
+    current_patient = None
+    for patient_id, source, _, new_patient_id, accession_number, new_accession_number in heapq.merge(
+            *[read_run(run_path) for run_path in runs]):
+        if patient_id != current_patient:
+            current_patient = patient_id
+            kept_patient_id = new_patient_id
+            reported = {new_patient_id}
+            accessions = {}
+            stats['patients'] += 1
+        elif new_patient_id not in reported:
+            reported.add(new_patient_id)
+            stats['patient_conflicts'] += 1
+            if conflicts_writer is not None:
+                conflicts_writer.writerow(['patient', patient_id, kept_patient_id, new_patient_id, sources[source]])
+
+        kept_accession_number = accessions.get(accession_number)
+        if kept_accession_number is not None:
+            if kept_accession_number != new_accession_number:
+                stats['accession_conflicts'] += 1
+                if conflicts_writer is not None:
+                    conflicts_writer.writerow(['accession', accession_number, kept_accession_number,
+                                               new_accession_number, sources[source]])
+            else:
+                stats['duplicates'] += 1
+            continue
+        accessions[accession_number] = new_accession_number
+        writer.writerow([patient_id, kept_patient_id, accession_number, new_accession_number])
+        stats['rows'] += 1
+
+
+def merge_lookup_tables(inputs: list, output_path: str, shards: int = DEFAULT_SHARDS, conflicts_path: str = None,
+                        chunk_rows: int = 1000000) -> dict:
+    '''
+    Merge lookup tables, cf module documentation.
+
+    Parameters
+    ----------
+    inputs : list
+        Paths to the lookup table csv files or sharded folders, by decreasing priority.
+    output_path : str
+        Path to the merged table: a csv file if it ends with '.csv', a sharded folder otherwise.
+        Must not be one of the inputs.
+    shards : int
+        Number of shards of the merged table (the rows of a csv output are grouped by shard).
+    conflicts_path : str
+        Path to the csv file reporting the discarded pseudonyms, None to not report them.
+    chunk_rows : int
+        Maximum number of rows held in memory.
+
+    Returns
+    -------
+    d : dict
+        Number of rows written, patients, removed duplicates and conflicts.
+    '''
+    stats = {'rows': 0, 'patients': 0, 'duplicates': 0, 'patient_conflicts': 0, 'accession_conflicts': 0}
+    with tempfile.TemporaryDirectory() as run_folder:
+        # Partition the rows by shard, in sorted runs
+        buffers = [[] for _ in range(shards)]
+        runs = [[] for _ in range(shards)]
+        buffered_rows = 0
+        for source, path in enumerate(inputs):
+            for row_number, row in enumerate(iter_table_rows(path)):
+                buffers[get_shard(row[0], shards)].append((row[0], source, row_number, row[1], row[2], row[3]))
+                buffered_rows += 1
+                if buffered_rows >= chunk_rows:
+                    write_runs(buffers, runs, run_folder)
+                    buffered_rows = 0
+        write_runs(buffers, runs, run_folder)
+
+        # Merge the runs of each shard
+        single_file = output_path.endswith('.csv')
+        if not single_file:
+            os.makedirs(output_path, exist_ok=True)
+            if get_shard_paths(output_path)[0]:
+                raise ValueError('The output folder already contains a lookup table: ' + output_path)
+        conflicts_file = open(conflicts_path, 'w', newline='') if conflicts_path is not None else None
+        conflicts_writer = None
+        if conflicts_file is not None:
+            conflicts_writer = csv.writer(conflicts_file, lineterminator='\n')
+            conflicts_writer.writerow(CONFLICTS_HEADER)
+        out_file = None
+        try:
+            for shard in range(shards):
+                if out_file is None or not single_file:
+                    shard_path = output_path if single_file else os.path.join(output_path, SHARD_NAME.format(shard, shards))
+                    out_file = open(shard_path, 'w', newline='')
+                    writer = csv.writer(out_file, lineterminator='\n')
+                    writer.writerow(LOOKUP_TABLE_HEADER)
+                merge_shard(runs[shard], writer, conflicts_writer, inputs, stats)
+                if not single_file:
+                    out_file.close()
+        finally:
+            if out_file is not None:
+                out_file.close()
+            if conflicts_file is not None:
+                conflicts_file.close()
+    return stats
+
+
+def finish_compaction(path: str) -> None:
+    '''
+    Clean up after a compaction of a sharded table interrupted by a crash, cf compact_lookup_table:
+    - during the merge: the partial compacted table is removed, the table is unchanged,
+    - during the swap: the compacted table, which is complete, replaces the table.
+
+    Parameters
+    ----------
+    path : str
+        Path to the sharded folder, without trailing separator.
+
+    Returns
+    -------
+    None.
+    '''
+    compact_path, old_path = path + '.compact', path + '.old'
+    if os.path.isdir(old_path):
+        if os.path.isdir(compact_path):
+            # The table was moved aside, but the compacted table not moved in its place
+            if os.path.isdir(path) and not os.listdir(path):
+                os.rmdir(path)
+            os.replace(compact_path, path)
+        shutil.rmtree(old_path)
+    elif os.path.isdir(compact_path):
+        shutil.rmtree(compact_path)
+
+
+def compact_lookup_table(path: str, shards: int = None, conflicts_path: str = None, chunk_rows: int = 1000000) -> dict:
+    '''
+    Remove the duplicated rows of a lookup table and sort it, cf merge_lookup_tables.
+    The table is replaced once the compacted table is complete: a csv file by os.replace,
+    a sharded folder by two renames of folders (the table to 'path.old', then the
+    compacted table from 'path.compact' to path), so that after a crash the folder holds
+    either all the old shards or all the new ones, cf finish_compaction.
+
+    Parameters
+    ----------
+    path : str
+        Path to the lookup table csv file or sharded folder.
+    shards : int
+        Number of shards of the compacted sharded table, the current number if None.
+    others :
+        Cf merge_lookup_tables.
+
+    Returns
+    -------
+    d : dict
+        Cf merge_lookup_tables.
+    '''
+    if not is_sharded(path):
+        temporary_path = path + '.compact.csv'
+        stats = merge_lookup_tables([path], temporary_path, 1, conflicts_path, chunk_rows)
+        os.replace(temporary_path, path)
+        return stats
+
+    path = path.rstrip('/' + os.sep)
+    finish_compaction(path)
+    shard_count = get_shard_paths(path)[0]
+    stats = merge_lookup_tables([path], path + '.compact', shards or shard_count or DEFAULT_SHARDS,
+                                conflicts_path, chunk_rows)
+    os.replace(path, path + '.old')
+    os.replace(path + '.compact', path)
+    shutil.rmtree(path + '.old')
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('command', choices=['merge', 'compact'], help='merge: merge the input tables into the output table, compact: compact a table in place')
+    parser.add_argument('output', help='Path to the merged (csv file if it ends with .csv, sharded folder otherwise) or compacted table')
+    parser.add_argument('inputs', nargs='*', help='Paths to the lookup tables to merge (csv files or sharded folders), by decreasing priority')
+    parser.add_argument('--shards', action='store', type=int, help='Number of shards of the output table')
+    parser.add_argument('--conflicts', action='store', help='Path to a csv file reporting the discarded pseudonyms')
+    parser.add_argument('--chunkRows', action='store', type=int, default=1000000, help='Maximum number of rows held in memory')
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        if not args.inputs:
+            parser.error('merge needs at least one input table')
+        stats = merge_lookup_tables(args.inputs, args.output, args.shards or DEFAULT_SHARDS, args.conflicts, args.chunkRows)
+    else:
+        stats = compact_lookup_table(args.output, args.shards, args.conflicts, args.chunkRows)
+    print(stats)
@@ -0,0 +1,270 @@
+'''
+Lookup table keeping the correspondence between original and pseudonymized
+patient IDs and accession numbers.
+
+The csv file has the columns:
+'old_patient_id', 'new_patient_id', 'old_accession_number', 'new_accession_number'
+
+A lookup table can also be sharded: it is then a folder of csv files in the same
+format, each one holding the rows of the patients whose hashed ID falls in it, cf
+ShardedLookupTable. Sharded tables are merged with utils.lookup_merge.
+'''
+
+import csv
+import hashlib
+import os
+import re
+import threading
+from multiprocessing.managers import SyncManager
+
+LOOKUP_TABLE_HEADER = ['old_patient_id', 'new_patient_id', 'old_accession_number', 'new_accession_number']
+
+# Number of shards of a new sharded lookup table
+DEFAULT_SHARDS = 16
+SHARD_NAME = 'lookup-{:04d}-of-{:04d}.csv'
+SHARD_PATTERN = re.compile(r'lookup-(\d{4})-of-(\d{4})\.csv$')
+
+
+class LookupTable:
+    '''
+    Lookup table loaded once in memory and indexed by patient ID and accession number.
+
+    The csv file is only read when the table is opened. New rows are kept in memory
+    and appended to the end of the file by batches of `flush_every` rows and when the
+    table is flushed or closed, so the file is never rewritten as a whole. The owner of
+    the table must close it, including when a run fails: nothing is written at exit,
+    the atexit handlers not being run by the manager and worker processes.
+
+    Parameters
+    ----------
+    path : str
+        Path to the lookup table csv file. Created if it does not exist. If None, the
+        table is only kept in memory.
+    flush_every : int
+        Number of new rows kept in memory before being appended to the file.
+    '''
+
+    def __init__(self, path: str, flush_every: int = 1000):
+        self.path = path
+        self.flush_every = flush_every
+        # Old patient ID -> new patient ID
+        self.patients = {}
+        # Old accession number -> (new patient ID, new accession number)
+        self.accessions = {}
+        self.pending_rows = []
+        self.lock = threading.Lock()
+
+        if path is None:
+            return
+        if os.path.exists(path):
+            with open(path, 'r') as csvfile:
+                for row in csv.reader(csvfile):
+                    if row == LOOKUP_TABLE_HEADER:
+                        continue
+                    self.index_row(row)
+        else:
+            with open(path, 'w', newline='') as csvfile:
+                csv.writer(csvfile, lineterminator='\n').writerow(LOOKUP_TABLE_HEADER)
+
+    def index_row(self, row: list) -> None:
+        '''
+        Add a row to the indexes. The first row of a patient or an accession number wins.
+        '''
+        self.patients.setdefault(row[0], row[1])
+        self.accessions.setdefault(row[2], (row[1], row[3]))
+
+    def add_row(self, row: list) -> None:
+        '''
+        Index a new row and schedule it to be written in the csv file.
+        '''
+        self.index_row(row)
+        if self.path is None:
+            return
+        self.pending_rows.append(row)
+        if len(self.pending_rows) >= self.flush_every:
+            self.flush_rows()
+
+    def get_pseudonyms(self, patient_id: str, accession_number: str,
+                       new_patient_id: str, new_accession_number: str) -> tuple:
+        '''
+        Get the pseudonyms of a patient ID and an accession number, registering the
+        proposed new values if they are not in the table yet.
+
+        Parameters
+        ----------
+        patient_id : str
+            Original patient ID.
+        accession_number : str
+            Original accession number.
+        new_patient_id : str
+            Pseudonym used if the patient is not in the table.
+        new_accession_number : str
+            Pseudonym used if the accession number is not in the table.
+
+        Returns
+        -------
+        t : tuple
+            The pseudonymized patient ID and accession number.
+        '''
+        with self.lock:
+            if patient_id not in self.patients: # Patient not in csv
+                self.add_row([patient_id, new_patient_id, accession_number, new_accession_number])
+                return new_patient_id, new_accession_number
+            if accession_number in self.accessions: # AccessNumber in csv
+                return self.accessions[accession_number]
+            # AccessNumber not in csv
+            known_patient_id = self.patients[patient_id]
+            self.add_row([patient_id, known_patient_id, accession_number, new_accession_number])
+            return known_patient_id, new_accession_number
+
+    def flush_rows(self) -> None:
+        '''
+        Append the pending rows to the csv file. The caller must hold the lock.
+        '''
+        if self.pending_rows:
+            with open(self.path, 'a', newline='') as csvfile:
+                csv.writer(csvfile, lineterminator='\n').writerows(self.pending_rows)
+            self.pending_rows = []
+
+    def flush(self) -> None:
+        '''
+        Append the pending rows to the csv file.
+        '''
+        with self.lock:
+            self.flush_rows()
+
+    def close(self) -> None:
+        '''
+        Write the pending rows, the table can still be used afterwards.
+        '''
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_shard(patient_id: str, shards: int) -> int:
+    '''
+    Get the shard of a patient ID, from a hash which is the same on every platform and run.
+    '''
+    return int.from_bytes(hashlib.sha256(patient_id.encode()).digest()[:8], 'big') % shards
+
+
+def get_shard_paths(path: str) -> tuple:
+    '''
+    Get the shards of a sharded lookup table. The shards without rows are not created.
+
+    Returns
+    -------
+    t : tuple
+        The number of shards of the table (0 if the folder does not exist or holds no
+        shard) and the paths of the existing shards, in shard order.
+    '''
+    if not os.path.isdir(path):
+        return 0, []
+    shards = {}
+    counts = set()
+    for name in os.listdir(path):
+        match = SHARD_PATTERN.match(name)
+        if match:
+            shards[int(match.group(1))] = os.path.join(path, name)
+            counts.add(int(match.group(2)))
+    if len(counts) > 1:
+        raise ValueError('Shards of different tables in ' + path)
+    return (counts.pop() if counts else 0), [shards[shard] for shard in sorted(shards)]
+
+
+def is_sharded(path: str) -> bool:
+    '''
+    Whether a lookup table path is a sharded table: an existing folder or a path ending with a separator.
+    '''
+    return os.path.isdir(path) or path.endswith(('/', os.sep))
+
+
+class ShardedLookupTable:
+    '''
+    Lookup table partitioned in a folder of csv files by a hash of the original patient ID.
+
+    All the rows of a patient are in the same shard, which is a LookupTable opened when
+    the first patient of the shard is looked up. The accession numbers are therefore
+    looked up among the accession numbers of the patient's shard only.
+
+    Parameters
+    ----------
+    path : str
+        Path to the folder of the shards. Created if it does not exist.
+    shards : int
+        Number of shards of a new table. The number of an existing table is kept.
+    flush_every : int
+        Number of new rows kept in memory by each shard before being appended to its file.
+    '''
+
+    def __init__(self, path: str, shards: int = DEFAULT_SHARDS, flush_every: int = 1000):
+        self.path = path
+        self.flush_every = flush_every
+        self.shard_count = get_shard_paths(path)[0] or shards
+        self.shard_tables = [None] * self.shard_count
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def get_shard_table(self, patient_id: str) -> LookupTable:
+        '''
+        Get the lookup table of the shard of a patient, opening it the first time.
+        '''
+        shard = get_shard(patient_id, self.shard_count)
+        with self.lock:
+            if self.shard_tables[shard] is None:
+                shard_path = os.path.join(self.path, SHARD_NAME.format(shard, self.shard_count))
+                self.shard_tables[shard] = LookupTable(shard_path, self.flush_every)
+            return self.shard_tables[shard]
+
+    def get_pseudonyms(self, patient_id: str, accession_number: str,
+                       new_patient_id: str, new_accession_number: str) -> tuple:
+        '''
+        Get the pseudonyms of a patient ID and an accession number, cf LookupTable.get_pseudonyms.
+        '''
+        return self.get_shard_table(patient_id).get_pseudonyms(
+            patient_id, accession_number, new_patient_id, new_accession_number)
+
+    def flush(self) -> None:
+        '''
+        Append the pending rows of the opened shards to their csv file.
+        '''
+        for table in self.shard_tables:
+            if table is not None:
+                table.flush()
+
+    def close(self) -> None:
+        '''
+        Write the pending rows of the opened shards, the table can still be used afterwards.
+        '''
+        for table in self.shard_tables:
+            if table is not None:
+                table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_lookup_table(path: str):
+    '''
+    Open a lookup table: a ShardedLookupTable if path is sharded (cf is_sharded), a LookupTable otherwise.
+    '''
+    if path is not None and is_sharded(path):
+        return ShardedLookupTable(path)
+    return LookupTable(path)
+
+
+class LookupTableManager(SyncManager):
+    '''
+    Manager hosting a single LookupTable shared by several processes.
+    '''
+
+
+LookupTableManager.register('LookupTable', open_lookup_table, exposed=('get_pseudonyms', 'flush', 'close'))
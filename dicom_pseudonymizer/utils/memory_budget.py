@@ -0,0 +1,99 @@
+'''
+Throttling of the files dispatched to the worker processes by their estimated memory.
+
+Each worker holds the dataset of the file it anonymizes: about the size of the file
+for a file entirely read (the raw bytes are released once parsed, but the written
+copy is built in memory), only the header for a file read header only. With a memory
+limit, a file is only dispatched once the estimated memory of the files in flight plus
+its own fits in the limit, so that several large files are not anonymized at the
+same time. A file larger than the limit is anonymized alone.
+'''
+
+import threading
+
+# Estimated memory of a file read header only, in bytes
+HEADER_MEMORY = 1024 * 1024
+
+# Estimated memory of a file entirely read, as a multiple of its size
+FILE_MEMORY_FACTOR = 2
+
+
+def estimate_file_memory(size: int, header_only: bool = False, large_file_size: int = None) -> int:
+    '''
+    Estimate the memory needed to anonymize a file, cf module documentation.
+
+    Parameters
+    ----------
+    size : int
+        Size of the file in bytes.
+    header_only : bool
+        Whether the file is read header only.
+    large_file_size : int
+        Size from which files are read header only, cf set_large_file_size.
+
+    Returns
+    -------
+    i : int
+        Number of bytes.
+    '''
+    if header_only or (large_file_size is not None and size >= large_file_size):
+        return min(size, HEADER_MEMORY)
+    return FILE_MEMORY_FACTOR * size + HEADER_MEMORY
+
+
+class MemoryBudget:
+    '''
+    Memory shared by the files in flight, cf module documentation.
+
+    Parameters
+    ----------
+    limit : int
+        Number of bytes.
+    '''
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.max_used = 0
+        self.waits = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, cost: int) -> None:
+        '''
+        Wait until `cost` bytes fit in the budget (or nothing else is in flight), then reserve them.
+        '''
+        with self.condition:
+            if self.used > 0 and self.used + cost > self.limit:
+                self.waits += 1
+                self.condition.wait_for(lambda: self.used == 0 or self.used + cost <= self.limit)
+            self.used += cost
+            self.max_used = max(self.max_used, self.used)
+
+    def release(self, cost: int) -> None:
+        '''
+        Give back the bytes reserved by acquire.
+        '''
+        with self.condition:
+            self.used -= cost
+            self.condition.notify_all()
+
+    def iter_tasks(self, tasks, get_cost):
+        '''
+        Generate the tasks once their cost fits in the budget. The cost of a task must
+        be released once it is done.
+
+        Parameters
+        ----------
+        tasks : iterable
+            Tasks to dispatch.
+        get_cost : callable
+            Function giving the cost of a task in bytes.
+
+        Returns
+        -------
+        g : generator
+            The tasks, in order.
+        '''
+        for task in tasks:
+            self.acquire(get_cost(task))
+            yield task
@@ -0,0 +1,427 @@
+'''
+Verification that anonymized files contain no residual identifying information.
+
+The files of a folder are read header only (the pixel data is neither read nor parsed)
+by a pool of processes, and each file is checked against the rules compiled by
+compile_actions (the DICOM standard rules of dicom_fields.py plus the extra rules of a
+dictionary file, as given to the anonymizer):
+- X: the element must be absent (or the dummy date 00010101 for a date),
+- Z: the element must be empty (or the dummy value of its VR for a date or time),
+- D: the element must have the dummy value of its VR,
+- P: the PatientID and AccessionNumber must be SHA-256 pseudonyms,
+- private tags must be absent, unless kept by a rule or allowed (--keepPrivateTags).
+The U rules (UIDs replaced) cannot be checked without the original files, and the
+elements kept or changed by a regular expression are not checked.
+
+In addition, the original patient IDs and accession numbers of the lookup table are
+loaded in a set, and every text element (including the elements of the sequences and
+the private elements of VR UN) and the path of every file are split into tokens by
+regular expressions, each token being looked up in the set.
+
+The violations are written to a csv file with one row per file: 'file', 'violations',
+'details' where details lists the '(gggg,eeee) keyword: problem' of the file.
+
+Usage, from the dicom_pseudonymizer folder:
+    python -m utils.phi_verifier path/to/anonymized/ --lookup path/to/lookup.csv --report violations.csv --jobs 8
+'''
+
+import argparse
+import ast
+import csv
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import pydicom
+
+from utils.simple_dicomanonymizer import *
+from utils.file_discovery import iter_files
+from utils.lookup_merge import iter_table_rows
+
+REPORT_HEADER = ['file', 'violations', 'details']
+
+# Action of a rule -> check of the elements it applies to
+ACTION_CHECKS = {
+    replace: 'D',
+    empty_or_replace: 'D',
+    delete_or_replace: 'D',
+    delete_or_empty_or_replace: 'D',
+    empty: 'Z',
+    delete_or_empty: 'Z',
+    delete: 'X',
+    replace_UID: 'U',
+    delete_or_empty_or_replace_UID: 'U*',
+    replace_and_keep_correspondence: 'P',
+}
+
+# Values written by replace_element and empty_element
+REPLACED_VALUES = {
+    'DA': '00010101',
+    'TM': '000000.00',
+    'LO': 'Anonymized',
+    'SH': 'Anonymized',
+    'PN': 'Anonymized',
+    'CS': 'Anonymized',
+    'IS': '0',
+    'ST': '',
+    'DT': '00010101010101.000000+0000',
+}
+EMPTY_VALUES = {'DA': '00010101', 'TM': '000000.00'}
+
+TEXT_VRS = {'AE', 'AS', 'CS', 'DA', 'DS', 'DT', 'IS', 'LO', 'LT', 'PN', 'SH', 'ST', 'TM', 'UC', 'UI', 'UR', 'UT'}
+
+# Tokens looked up in the identifiers: runs of ID characters, then runs of alphanumerics
+TOKEN_PATTERNS = (re.compile(r'[A-Za-z0-9._\-]+'), re.compile(r'[A-Za-z0-9]+'))
+PSEUDONYM_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+# State of the worker processes, cf init_worker
+tag_checks = {}
+masked_checks = ()
+allowed_private_tags = frozenset()
+keep_private_tags = False
+identifiers = {}
+
+
+def read_rules(dictionary_path: str = None) -> AnonymizationPlan:
+    '''
+    Compile the rules the files were anonymized with.
+
+    Parameters
+    ----------
+    dictionary_path : str
+        JSON file of extra rules, in the format of the --dictionary option of the anonymizer.
+
+    Returns
+    -------
+    p : AnonymizationPlan
+        cf compile_actions
+    '''
+    extra_rules = {}
+    if dictionary_path is not None:
+        with open(dictionary_path) as json_file:
+            for key, value in json.load(json_file).items():
+                options = None
+                if type(value) is dict:
+                    options = {'find': value['find'], 'replace': value['replace']}
+                    value = value['action']
+                extra_rules.update(generate_actions([ast.literal_eval(key)], value, options))
+    return compile_actions(extra_rules)
+
+
+def get_checks(plan: AnonymizationPlan) -> tuple:
+    '''
+    Get the checks of the rules of a plan, cf ACTION_CHECKS.
+
+    Returns
+    -------
+    t : tuple
+        (Tag -> check of the individual tags, masked checks as (group mask, element mask,
+        (group, element) -> check) tuples, private tags kept by the rules with their
+        private creators)
+    '''
+    checks = {}
+    private_tags = set()
+    for tag, (position, rule_tag, action, is_private) in plan.tag_actions.items():
+        check = ACTION_CHECKS.get(action)
+        if check is not None:
+            checks[tag] = check
+        if is_private:
+            private_tags.add(tag)
+            private_tags.add(pydicom.tag.Tag(tag.group, tag.element >> 8))
+
+    masked = []
+    for group_mask, element_mask, rules in plan.masked_actions:
+        rules = {key: ACTION_CHECKS[action] for key, (position, action) in rules.items() if action in ACTION_CHECKS}
+        if rules:
+            masked.append((group_mask, element_mask, rules))
+    return checks, tuple(masked), frozenset(private_tags)
+
+
+def load_identifiers(lookup_path: str, min_length: int = 4) -> dict:
+    '''
+    Load the original identifiers of a lookup table (csv file or sharded folder).
+
+    Parameters
+    ----------
+    lookup_path : str
+        Path to the lookup table.
+    min_length : int
+        Identifiers shorter than this are ignored, they would match unrelated values.
+
+    Returns
+    -------
+    d : dict
+        Original identifier -> 'PatientID' or 'AccessionNumber'.
+    '''
+    found = {}
+    for row in iter_table_rows(lookup_path):
+        for value, name in ((row[2], 'AccessionNumber'), (row[0], 'PatientID')):
+            value = value.strip()
+            if len(value) >= min_length:
+                found[value] = name
+    return found
+
+
+def init_worker(checks: dict, masked: tuple, private_tags: frozenset, keep_private: bool, original_identifiers: dict) -> None:
+    '''
+    Set the state of a process verifying files, cf verify_file.
+    '''
+    global tag_checks, masked_checks, allowed_private_tags, keep_private_tags, identifiers
+    tag_checks = checks
+    masked_checks = masked
+    allowed_private_tags = private_tags
+    keep_private_tags = keep_private
+    identifiers = original_identifiers
+
+
+def find_identifier(text: str):
+    '''
+    Get the kind of the first original identifier found in a text, None if there is none.
+    '''
+    text = text.strip()
+    if not text:
+        return None
+    if text in identifiers:
+        return identifiers[text]
+    for pattern in TOKEN_PATTERNS:
+        for token in pattern.findall(text):
+            if token in identifiers:
+                return identifiers[token]
+    return None
+
+
+def as_text(value) -> str:
+    '''
+    Get the text of an element value, the values of a multi-valued element being joined by a backslash.
+    '''
+    if value is None:
+        return ''
+    if isinstance(value, (list, pydicom.multival.MultiValue)):
+        return '\\'.join(as_text(item) for item in value)
+    return str(value)
+
+
+def check_element(element, check: str):
+    '''
+    Check an element against the check of its rule.
+
+    Returns
+    -------
+    s : str
+        The problem, None if the element is anonymized.
+    '''
+    vr = element.VR
+    if check == 'U' or (check == 'U*' and vr == 'UI'):
+        return None
+    if check == 'X':
+        if vr == 'DA' and as_text(element.value) == '00010101':
+            return None
+        return 'not deleted (X)'
+    if check == 'P':
+        if element.tag == 0x00100020 and not PSEUDONYM_PATTERN.fullmatch(as_text(element.value)):
+            return 'not pseudonymized (P)'
+        return None
+
+    if vr == 'SQ':
+        for sub_dataset in element.value:
+            for sub_element in sub_dataset:
+                problem = check_element(sub_element, check)
+                if problem is not None:
+                    return problem
+        return None
+    if check == 'D':
+        if vr in ('UI', 'UL'):
+            return None
+        if vr in ('FD', 'FL', 'SS', 'US'):
+            return None if element.value == 0 else 'not replaced (D)'
+        if vr not in REPLACED_VALUES:
+            return 'VR {} not anonymized (D)'.format(vr)
+        return None if as_text(element.value) == REPLACED_VALUES[vr] else 'not replaced (D)'
+    # Z and non UID U*
+    if vr == 'UL':
+        return None if element.value in (0, None) else 'not empty (Z)'
+    return None if as_text(element.value) == EMPTY_VALUES.get(vr, '') else 'not empty (Z)'
+
+
+def find_dataset_violations(dataset: pydicom.Dataset, violations: list, top_level: bool = True) -> None:
+    '''
+    Add the violations of the elements of a dataset and of its sequences, cf module documentation.
+
+    Parameters
+    ----------
+    dataset : pydicom Dataset
+        Dataset read header only.
+    violations : list
+        List where the (tag, keyword, problem) tuples are added.
+    top_level : bool
+        Whether the dataset is the file dataset, the individual tag rules only apply to it.
+    '''
+    for element in dataset:
+        tag = element.tag
+        problem = None
+        if tag.is_private and not keep_private_tags and tag not in allowed_private_tags:
+            problem = 'private tag'
+        if problem is None and top_level and tag in tag_checks:
+            problem = check_element(element, tag_checks[tag])
+        if problem is None and masked_checks:
+            for group_mask, element_mask, rules in masked_checks:
+                check = rules.get((tag.group & group_mask, tag.element & element_mask))
+                if check is not None:
+                    problem = check_element(element, check)
+                    if problem is not None:
+                        break
+        if problem is None:
+            text = None
+            if element.VR in TEXT_VRS:
+                text = as_text(element.value)
+            elif element.VR == 'UN' and isinstance(element.value, bytes):
+                text = element.value.decode('latin-1')
+            kind = find_identifier(text) if text and identifiers else None
+            if kind is not None:
+                problem = 'original ' + kind
+        if problem is not None:
+            violations.append((tag, element.keyword, problem))
+
+        if element.VR == 'SQ' and element.value is not None:
+            for sub_dataset in element.value:
+                find_dataset_violations(sub_dataset, violations, False)
+
+
+def verify_file(path: str, relative_path: str) -> list:
+    '''
+    Verify an anonymized file, cf module documentation.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+    relative_path : str
+        Path of the file relative to the verified folder, also checked for identifiers.
+
+    Returns
+    -------
+    l : list
+        The violations, as (location, problem) couples where location is '(gggg,eeee) keyword'.
+    '''
+    violations = []
+    kind = find_identifier(relative_path) if identifiers else None
+    if kind is not None:
+        violations.append(('file name', 'original ' + kind))
+    try:
+        dataset = pydicom.dcmread(path, force=True, stop_before_pixels=True)
+        element_violations = []
+        if hasattr(dataset, 'file_meta'):
+            find_dataset_violations(dataset.file_meta, element_violations, False)
+        find_dataset_violations(dataset, element_violations)
+    except Exception as e:
+        violations.append(('file', 'unreadable ({})'.format(e)))
+        return violations
+    for tag, keyword, problem in element_violations:
+        violations.append(('({:04X},{:04X}) {}'.format(tag.group, tag.element, keyword).rstrip(), problem))
+    return violations
+
+
+def verify_worker(task: tuple) -> tuple:
+    '''
+    Verify a (path, relative path) task in a worker process, cf verify_file.
+    '''
+    return task[1], verify_file(task[0], task[1])
+
+
+def verify_folder(folder: str, report_path: str = None, lookup_path: str = None, dictionary_path: str = None,
+                  keep_private: bool = False, jobs: int = 1, min_length: int = 4) -> dict:
+    '''
+    Verify the anonymized files of a folder, cf module documentation.
+
+    Parameters
+    ----------
+    folder : str
+        Folder of anonymized files, crossed recursively.
+    report_path : str
+        Path to the csv file of the files with violations, None to print them.
+    lookup_path : str
+        Lookup table whose original identifiers are looked for, None to skip this check.
+    dictionary_path : str
+        JSON file of extra rules given to the anonymizer.
+    keep_private : bool
+        Whether the private tags were kept (--keepPrivateTags).
+    jobs : int
+        Number of processes verifying files.
+    min_length : int
+        Minimum length of the identifiers looked for, cf load_identifiers.
+
+    Returns
+    -------
+    d : dict
+        Numbers of files, files with violations and violations by problem, time in seconds.
+    '''
+    start = time.time()
+    checks, masked, private_tags = get_checks(read_rules(dictionary_path))
+    original_identifiers = load_identifiers(lookup_path, min_length) if lookup_path is not None else {}
+    initargs = (checks, masked, private_tags, keep_private, original_identifiers)
+    tasks = ((entry.path, relative_path) for entry, relative_path in iter_files(folder))
+
+    summary = {'files': 0, 'files_with_violations': 0, 'problems': {}}
+    report_file = open(report_path, 'w', newline='') if report_path is not None else None
+    try:
+        writer = csv.writer(report_file if report_file is not None else sys.stdout)
+        writer.writerow(REPORT_HEADER)
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs, init_worker, initargs)
+            results = pool.imap_unordered(verify_worker, tasks, chunksize=32)
+        else:
+            pool = None
+            init_worker(*initargs)
+            results = map(verify_worker, tasks)
+        try:
+            for relative_path, violations in results:
+                summary['files'] += 1
+                if violations:
+                    summary['files_with_violations'] += 1
+                    for location, problem in violations:
+                        problem = problem.split(' (')[0]
+                        summary['problems'][problem] = summary['problems'].get(problem, 0) + 1
+                    writer.writerow([relative_path, len(violations),
+                                     '; '.join('{}: {}'.format(location, problem) for location, problem in violations)])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    finally:
+        if report_file is not None:
+            report_file.close()
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('folder', help='Folder of the anonymized files to verify')
+    parser.add_argument('--lookup', action='store', help='Lookup table of the run (csv file or sharded folder): the original patient IDs and accession numbers are looked for in the files')
+    parser.add_argument('--report', action='store', help='Path to the csv report of the files with violations, printed otherwise')
+    parser.add_argument('--dictionary', action='store', help='File which contains the dictionary given to the anonymizer')
+    parser.add_argument('--keepPrivateTags', action='store_true', dest='keepPrivateTags', help='If used, private tags are allowed')
+    parser.add_argument('--jobs', action='store', type=int, default=os.cpu_count(), help='Number of processes verifying files')
+    parser.add_argument('--minIdLength', action='store', type=int, default=4, help='Original identifiers shorter than this are not looked for')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        print('Error, the folder to verify does not exist')
+        sys.exit()
+
+    summary = verify_folder(args.folder, args.report, args.lookup, args.dictionary, args.keepPrivateTags,
+                            args.jobs, args.minIdLength)
+    print('{} files verified in {:.1f} s ({:.1f} files/s), {} with violations'.format(
+        summary['files'], summary['seconds'], summary['files'] / summary['seconds'] if summary['seconds'] else 0.0,
+        summary['files_with_violations']))
+    for problem, count in sorted(summary['problems'].items()):
+        print('  {}: {}'.format(problem, count))
+    if summary['files_with_violations']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
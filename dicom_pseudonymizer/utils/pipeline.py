@@ -0,0 +1,295 @@
+'''
+Pipelined anonymization: input files are read ahead by a pool of reader threads,
+anonymized by the calling thread and written by a pool of writer threads.
+
+The stages are connected by bounded queues, so that the number of datasets in
+memory is limited whatever the speed of the storage. The queues record their depth
+and the time spent waiting on them, to tune the number of threads and the queue
+size, e.g. for network storage:
+- a full queue blocks the stage before it (backpressure, 'put_wait'),
+- an empty queue starves the stage after it ('get_wait').
+'''
+
+import io
+import os
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
+from utils.simple_dicomanonymizer import *
+
+# Sentinel sent through the queues when a stage has no more items
+END_OF_STAGE = None
+
+
+class PipelineAborted(Exception):
+    '''
+    Raised in a stage when another stage failed.
+    '''
+
+
+class MonitoredQueue(queue.Queue):
+    '''
+    Bounded queue recording its depth and the time spent waiting to put and get items.
+
+    Parameters
+    ----------
+    name : str
+        Name of the queue in the statistics.
+    maxsize : int
+        Maximum number of items in the queue.
+    abort : threading.Event
+        Event set when the pipeline is aborted, which stops the waiting stages.
+    '''
+
+    def __init__(self, name: str, maxsize: int, abort: threading.Event):
+        super().__init__(maxsize)
+        self.name = name
+        self.abort = abort
+        self.puts = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    def put_item(self, item) -> None:
+        '''
+        Put an item, waiting while the queue is full.
+        '''
+        start = time.perf_counter()
+        while True:
+            if self.abort.is_set():
+                raise PipelineAborted()
+            try:
+                self.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        depth = self.qsize()
+        with self.mutex:
+            self.put_wait += time.perf_counter() - start
+            self.puts += 1
+            self.depth_sum += depth
+            self.max_depth = max(self.max_depth, depth)
+
+    def get_item(self):
+        '''
+        Get an item, waiting while the queue is empty.
+        '''
+        start = time.perf_counter()
+        while True:
+            if self.abort.is_set():
+                raise PipelineAborted()
+            try:
+                item = self.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        with self.mutex:
+            self.get_wait += time.perf_counter() - start
+        return item
+
+    def get_stats(self) -> dict:
+        '''
+        Get the statistics of the queue.
+
+        Returns
+        -------
+        d : dict
+            Capacity, mean and maximum depth, and total time (s) spent waiting to put and get items.
+        '''
+        return {
+            'capacity': self.maxsize,
+            'mean_depth': self.depth_sum / self.puts if self.puts else 0.0,
+            'max_depth': self.max_depth,
+            'put_wait': self.put_wait,
+            'get_wait': self.get_wait,
+        }
+
+
+def read_file(in_file: str, header_only: bool) -> tuple:
+    '''
+    Read an input file for the anonymization stage.
+
+    Parameters
+    ----------
+    in_file : str
+        Path to the DICOM file.
+    header_only : bool
+        Whether to only read the header, the file is then kept open for the writer.
+        Large files are read header only too, cf set_large_file_size.
+
+    Returns
+    -------
+    t : tuple
+        The dataset, the file it was read from and the pixel data range, cf read_dicom_file.
+    '''
+    fp = open(in_file, 'rb')
+    if not header_only and not is_large_file(fp):
+        # Read the file at once, then parse it from memory
+        with fp:
+            fp = io.BytesIO(fp.read())
+    try:
+        dataset, pixel_data_range = read_dicom_file(fp, header_only)
+    except BaseException:
+        fp.close()
+        raise
+    if pixel_data_range is None:
+        fp.close()
+        fp = None
+    return dataset, fp, pixel_data_range
+
+
+def anonymize_pipeline(tasks, lookup_path: str, anonymization_actions: AnonymizationPlan,
+                       delete_private_tags: bool, rename_files: bool, header_only: bool = False,
+                       read_workers: int = 4, write_workers: int = 2, queue_size: int = 16,
+                       on_done=None) -> dict:
+    '''
+    Anonymize files with reader threads, the calling thread and writer threads
+    connected by bounded queues.
+
+    Parameters
+    ----------
+    tasks : iterable
+        (input file, output file, result) tuples, e.g. generated by iter_input_files.
+    lookup_path : str
+        Path to lookup table csv path.
+    anonymization_actions : AnonymizationPlan
+        Plan of the actions that will be applied on tags.
+    delete_private_tags : bool
+        Whether to delete private tags.
+    rename_files : bool
+        Whether to remane output files with pseudo.
+    header_only : bool
+        Whether to only read the header and copy the pixel data as is.
+    read_workers : int
+        Number of threads reading the input files.
+    write_workers : int
+        Number of threads writing the output files.
+    queue_size : int
+        Capacity of each queue between two stages.
+    on_done : callable
+        Function called by the calling thread with the result of each task once written,
+        or with None if its file vanished before being read.
+
+    Returns
+    -------
+    d : dict
+        Statistics of the queues, cf MonitoredQueue.get_stats.
+    '''
+    abort = threading.Event()
+    errors = []
+    task_queue = MonitoredQueue('tasks', queue_size, abort)
+    read_queue = MonitoredQueue('read', queue_size, abort)
+    write_queue = MonitoredQueue('write', queue_size, abort)
+    done_queue = queue.Queue()
+    rename_lock = threading.Lock()
+
+    def run_stage(stage):
+        # Stop the whole pipeline on the first error, it is raised by the calling thread
+        def run():
+            try:
+                stage()
+            except PipelineAborted:
+                pass
+            except BaseException as error:
+                errors.append(error)
+                abort.set()
+        return run
+
+    def feed():
+        for task in tasks:
+            task_queue.put_item(task)
+        for _ in range(read_workers):
+            task_queue.put_item(END_OF_STAGE)
+
+    def read():
+        while True:
+            task = task_queue.get_item()
+            if task is END_OF_STAGE:
+                read_queue.put_item(END_OF_STAGE)
+                return
+            try:
+                read_queue.put_item((task, read_file(task[0], header_only)))
+            except FileNotFoundError:
+                # The file vanished since it was discovered: done without result, so
+                # that it is not recorded as anonymized
+                done_queue.put(None)
+
+    def write():
+        while True:
+            item = write_queue.get_item()
+            if item is END_OF_STAGE:
+                return
+            (in_file, out_file, result), (dataset, fp, pixel_data_range) = item
+            try:
+                with rename_lock if rename_files else nullcontext():
+                    save_anonymized_file(dataset, out_file, fp, pixel_data_range, rename_files)
+            finally:
+                if fp is not None:
+                    fp.close()
+            done_queue.put(result)
+
+    def drain_done():
+        while True:
+            try:
+                result = done_queue.get_nowait()
+            except queue.Empty:
+                return
+            if on_done is not None:
+                on_done(result)
+
+    threads = [threading.Thread(target=run_stage(feed), daemon=True)]
+    threads += [threading.Thread(target=run_stage(read), daemon=True) for _ in range(read_workers)]
+    threads += [threading.Thread(target=run_stage(write), daemon=True) for _ in range(write_workers)]
+    for thread in threads:
+        thread.start()
+
+    set_lookup_path(lookup_path)
+    profiler = get_profiler()
+    try:
+        # Anonymization stage, in the calling thread as it uses the module state
+        finished_readers = 0
+        while finished_readers < read_workers:
+            item = read_queue.get_item()
+            if item is END_OF_STAGE:
+                finished_readers += 1
+                continue
+            if profiler is not None:
+                profiler.begin_file(item[0][0])
+            dataset, fp, pixel_data_range = item[1]
+            dataset, pixel_data_range = load_pixel_data_to_mask(dataset, fp, pixel_data_range, anonymization_actions)
+            item = (item[0], (dataset, fp, pixel_data_range))
+            anonymize_dataset(dataset, anonymization_actions, delete_private_tags)
+            if profiler is not None:
+                profiler.end_file()
+            write_queue.put_item(item)
+            drain_done()
+
+        for _ in range(write_workers):
+            write_queue.put_item(END_OF_STAGE)
+    except PipelineAborted:
+        pass
+    except BaseException:
+        abort.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    drain_done()
+
+    return {stage_queue.name: stage_queue.get_stats() for stage_queue in (task_queue, read_queue, write_queue)}
+
+
+def print_pipeline_stats(stats: dict) -> None:
+    '''
+    Print the statistics returned by anonymize_pipeline.
+    '''
+    print('Pipeline queues (capacity, mean depth, max depth, put wait (s), get wait (s)):')
+    for name, queue_stats in stats.items():
+        print('  {:<6} {:>4} {:>8.1f} {:>4} {:>10.2f} {:>10.2f}'.format(
+            name, queue_stats['capacity'], queue_stats['mean_depth'], queue_stats['max_depth'],
+            queue_stats['put_wait'], queue_stats['get_wait']))
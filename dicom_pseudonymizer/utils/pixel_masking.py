@@ -0,0 +1,140 @@
+'''
+Masking of the burned-in annotations (e.g. patient name on ultrasound or secondary
+capture images) by rectangle templates.
+
+A template gives the rectangles to mask for the images of a modality, manufacturer,
+model or size. Templates are read from a JSON file containing a list of objects, e.g.:
+    [
+        {"Modality": "US", "Manufacturer": "GE Healthcare", "Rows": 600, "Columns": 800,
+         "rectangles": [[0, 0, 800, 40], [600, 560, 200, 40]]},
+        {"Modality": "OT", "rectangles": [[0, 0, 512, 30]], "value": 0}
+    ]
+Every key other than "rectangles" and "value" is a DICOM keyword whose value must be
+equal to the one of the dataset (case-insensitive for strings) for the template to
+apply, the first matching template is used. A rectangle is [x, y, width, height] in
+pixels, "value" is the value written in the rectangles (0 by default).
+
+The rectangles are applied to all the frames at once by slicing the pixel_array in
+its native dtype, then the array is written back to PixelData.
+'''
+
+import json
+
+import pydicom
+
+TEMPLATE_KEYS = ('rectangles', 'value')
+
+
+class MaskTemplate:
+    '''
+    Rectangles to mask for the datasets matching some attributes.
+
+    Parameters
+    ----------
+    attributes : dict
+        DICOM keyword -> value the dataset must have.
+    rectangles : list
+        [x, y, width, height] rectangles.
+    value : int
+        Value written in the rectangles.
+    '''
+
+    def __init__(self, attributes: dict, rectangles: list, value: int = 0):
+        self.attributes = {keyword: self.normalize(value) for keyword, value in attributes.items()}
+        for keyword in self.attributes:
+            if pydicom.datadict.tag_for_keyword(keyword) is None:
+                raise ValueError('Unknown DICOM keyword in mask template: ' + keyword)
+        self.rectangles = [tuple(int(coordinate) for coordinate in rectangle) for rectangle in rectangles]
+        for rectangle in self.rectangles:
+            if len(rectangle) != 4 or min(rectangle) < 0:
+                raise ValueError('Invalid mask rectangle, expected [x, y, width, height]: ' + str(rectangle))
+        self.value = value
+
+    @staticmethod
+    def normalize(value):
+        '''
+        Normalize a value for the comparison of the attributes.
+        '''
+        if isinstance(value, (str, pydicom.valuerep.PersonName)):
+            return str(value).strip().lower()
+        return value
+
+    def matches(self, dataset: pydicom.Dataset) -> bool:
+        '''
+        Whether the template applies to a dataset.
+        '''
+        for keyword, value in self.attributes.items():
+            attribute = dataset.get(keyword)
+            if attribute is None or self.normalize(attribute) != value:
+                return False
+        return True
+
+
+def load_mask_templates(path: str) -> tuple:
+    '''
+    Load the mask templates of a JSON file, cf module documentation.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON file.
+
+    Returns
+    -------
+    t : tuple
+        MaskTemplate objects, in the order of the file.
+    '''
+    with open(path) as json_file:
+        data = json.load(json_file)
+    templates = []
+    for item in data:
+        attributes = {key: value for key, value in item.items() if key not in TEMPLATE_KEYS}
+        templates.append(MaskTemplate(attributes, item['rectangles'], item.get('value', 0)))
+    return tuple(templates)
+
+
+def find_mask_template(templates: tuple, dataset: pydicom.Dataset):
+    '''
+    Get the first template matching a dataset, None if there is none.
+    '''
+    for template in templates:
+        if template.matches(dataset):
+            return template
+    return None
+
+
+def mask_pixel_data(dataset: pydicom.Dataset, template: MaskTemplate) -> None:
+    '''
+    Mask the rectangles of a template in all the frames of a dataset.
+
+    Compressed pixel data is decompressed first (cf pydicom Dataset.decompress), the
+    masked dataset is then written uncompressed.
+
+    Parameters
+    ----------
+    dataset : FileDataset object of pydicom.dataset module
+        Dataset with pixel data, modified in place.
+    template : MaskTemplate
+        Template giving the rectangles.
+
+    Returns
+    -------
+    None.
+    '''
+    if dataset.file_meta.TransferSyntaxUID.is_compressed:
+        dataset.decompress()
+    if dataset.BitsAllocated == 1:
+        raise ValueError('Cannot mask 1 bit pixel data')
+
+    # Native dtype (and byte order) of the pixel data, without float conversion
+    pixels = dataset.pixel_array
+    if not pixels.flags.writeable:
+        pixels = pixels.copy()
+    # The (rows, columns) axes are the last ones, or are followed by the samples axis
+    samples = (slice(None),) if dataset.get('SamplesPerPixel', 1) > 1 else ()
+    for x, y, width, height in template.rectangles:
+        pixels[(Ellipsis, slice(y, y + height), slice(x, x + width)) + samples] = template.value
+    dataset.PixelData = pixels.tobytes()
+    if samples:
+        # The samples of a pixel are now consecutive
+        dataset.PlanarConfiguration = 0
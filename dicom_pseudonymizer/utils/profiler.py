@@ -0,0 +1,174 @@
+'''
+Opt-in profiling of the anonymization, enabled by simple_dicomanonymizer.set_profiler.
+
+The profiler accumulates the time and the number of calls of each stage of the
+processing of a file and of each anonymization action. Stages are nested:
+- 'read' and 'write' (with the renaming of the file, the commit of the store and
+  'encode', the compression of the pixel data when transcoding),
+- 'anonymize', which contains 'pixel_mask' (burned-in annotations), 'rules'
+  (individual tags), 'walk' (repeating groups) and 'private_tags' (removal and
+  restoration of the private tags),
+- 'lookup', the lookup table or store accesses of replace_and_keep_correspondence,
+  which are part of 'rules'.
+Actions are named after their function, their time includes the recursion in sequences.
+
+Every `sample_every` files, the stages and actions of the file are also kept as a
+trace. In pipeline mode, the trace only contains the stages run by the anonymization
+thread, i.e. not 'read' and 'write'.
+'''
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+def get_action_name(action) -> str:
+    '''
+    Get the name of an action function, also for functools.partial (e.g. regexp actions).
+    '''
+    action = getattr(action, 'func', action)
+    return getattr(action, '__name__', repr(action))
+
+
+class Profiler:
+    '''
+    Cumulative timings of the stages and of the actions, cf the module documentation.
+
+    Parameters
+    ----------
+    sample_every : int
+        A file out of sample_every is traced, 0 to disable the traces.
+    '''
+
+    def __init__(self, sample_every: int = 100):
+        self.sample_every = sample_every
+        self.lock = threading.RLock()
+        self.current = threading.local()
+        # Files seen since the creation, for the sampling of the traces
+        self.file_index = 0
+        self.reset()
+
+    def reset(self) -> None:
+        '''
+        Forget the timings and traces recorded so far.
+        '''
+        self.files = 0
+        # Name -> [calls, seconds]
+        self.stages = {}
+        self.actions = {}
+        self.traces = []
+
+    def record(self, kind: str, name: str, seconds: float) -> None:
+        '''
+        Add a call of a stage (kind 'stages') or of an action (kind 'actions').
+        '''
+        with self.lock:
+            timing = getattr(self, kind).setdefault(name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+        trace = getattr(self.current, 'trace', None)
+        if trace is not None:
+            trace[kind][name] = trace[kind].get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        '''
+        Context manager timing a stage.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record('stages', name, time.perf_counter() - start)
+
+    def call_action(self, action, dataset, tag) -> None:
+        '''
+        Apply and time an anonymization action.
+        '''
+        start = time.perf_counter()
+        try:
+            action(dataset, tag)
+        finally:
+            self.record('actions', get_action_name(action), time.perf_counter() - start)
+
+    def begin_file(self, path: str) -> None:
+        '''
+        Count a file processed by the current thread, and start its trace if it is sampled.
+        '''
+        with self.lock:
+            sampled = self.sample_every > 0 and self.file_index % self.sample_every == 0
+            self.file_index += 1
+            self.files += 1
+        self.current.trace = {'file': path, 'stages': {}, 'actions': {}} if sampled else None
+
+    def end_file(self) -> None:
+        '''
+        End the file processed by the current thread, keeping its trace if it is sampled.
+        '''
+        trace = getattr(self.current, 'trace', None)
+        self.current.trace = None
+        if trace is not None:
+            with self.lock:
+                self.traces.append(trace)
+
+    def get_report(self) -> dict:
+        '''
+        Get the timings and traces recorded so far.
+
+        Returns
+        -------
+        d : dict
+            'files' count, 'stages' and 'actions' dicts of {'calls', 'seconds'} and 'traces' list.
+        '''
+        with self.lock:
+            return {
+                'files': self.files,
+                'stages': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in self.stages.items()},
+                'actions': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in self.actions.items()},
+                'traces': list(self.traces),
+            }
+
+    def pop_report(self) -> dict:
+        '''
+        Get the report and reset the profiler, e.g. to send the timings of a worker
+        process to the main process after each file.
+        '''
+        with self.lock:
+            report = self.get_report()
+            self.reset()
+        return report
+
+    def merge(self, report: dict) -> None:
+        '''
+        Add a report of another profiler, e.g. of a worker process.
+        '''
+        with self.lock:
+            self.files += report['files']
+            for kind in ('stages', 'actions'):
+                timings = getattr(self, kind)
+                for name, timing in report[kind].items():
+                    total = timings.setdefault(name, [0, 0.0])
+                    total[0] += timing['calls']
+                    total[1] += timing['seconds']
+            self.traces.extend(report['traces'])
+
+    def print_summary(self) -> None:
+        '''
+        Print the timings of the stages and of the actions, by decreasing total time.
+        '''
+        report = self.get_report()
+        print('Profile of {} files:'.format(report['files']))
+        for kind in ('stages', 'actions'):
+            print('  {:<34} {:>10} {:>12} {:>12}'.format(kind, 'calls', 'total (s)', 'mean (ms)'))
+            timings = sorted(report[kind].items(), key=lambda item: item[1]['seconds'], reverse=True)
+            for name, timing in timings:
+                print('  {:<34} {:>10} {:>12.3f} {:>12.4f}'.format(
+                    name, timing['calls'], timing['seconds'], 1000 * timing['seconds'] / timing['calls']))
+
+    def write_json(self, path: str) -> None:
+        '''
+        Write the report to a JSON file.
+        '''
+        with open(path, 'w') as json_file:
+            json.dump(self.get_report(), json_file, indent=4)
@@ -1,21 +1,273 @@
 # This code was taken and adapted from https://github.com/KitwareMedical/dicom-anonymizer
 
+import contextvars
 import os
 import re
-from typing import List, NewType
+import struct
+from contextlib import nullcontext
+from functools import partial
+from operator import itemgetter
+from typing import List, NamedTuple, NewType
 
 import pydicom
 from random import randint
 
 from utils.dicom_fields import *
 from utils.format_tag import *
+from utils.lookup_table import open_lookup_table
+from utils.pixel_masking import find_mask_template, mask_pixel_data
+from utils.transcoding import transcode_dataset
 
 import hashlib
-import csv
-import numpy as np
+import hmac
+
+# Size of the blocks used to copy the pixel data in header only mode
+PIXEL_DATA_CHUNK_SIZE = 1024 * 1024
 
 dictionary = {}
+uid_key = None
+uid_store = None
 lookup_path = None
+lookup_table = None
+output_lock = None
+profiler = None
+large_file_size = None
+transfer_syntax = None
+transcoding_report = None
+
+# StreamAnonymizer whose UIDs and lookup table replace the module state in the current
+# context (thread), cf utils.stream_anonymizer
+current_anonymizer = contextvars.ContextVar('current_anonymizer', default=None)
+
+
+def set_shared_state(shared_dictionary, shared_lock, shared_lookup_table=None) -> None:
+    '''
+    Replace the module state by objects shared between several processes.
+
+    Used by the workers of a process pool so that all of them produce the same
+    replacement UIDs and write to the same lookup table.
+
+    Parameters
+    ----------
+    shared_dictionary : dict-like
+        Dictionary (e.g. multiprocessing.Manager().dict()) linking original UIDs to
+        their replacement.
+    shared_lock : Lock
+        Lock (e.g. multiprocessing.Manager().Lock()) serializing the accesses to the
+        output folder when renaming files.
+    shared_lookup_table : LookupTable proxy, optional
+        Lookup table hosted by a LookupTableManager.
+
+    Returns
+    -------
+    None.
+    '''
+    global dictionary, output_lock, lookup_table
+    dictionary = shared_dictionary
+    output_lock = shared_lock
+    if shared_lookup_table is not None:
+        lookup_table = shared_lookup_table
+
+
+def set_uid_key(key: bytes) -> None:
+    '''
+    Set the secret key used to derive the replacement UIDs, see generate_keyed_UID.
+
+    Parameters
+    ----------
+    key : bytes
+        Secret key, None to go back to random UIDs kept in memory.
+
+    Returns
+    -------
+    None.
+    '''
+    global uid_key
+    uid_key = key
+
+
+def set_store(store) -> None:
+    '''
+    Use a persistent store (e.g. SQLiteStore) for the lookup table and the UIDs
+    instead of the lookup table csv file and the in-memory UID dictionary.
+
+    Parameters
+    ----------
+    store : SQLiteStore
+        The store, None to stop using it.
+
+    Returns
+    -------
+    None.
+    '''
+    global uid_store, lookup_table
+    # A lookup table csv file opened meanwhile is kept, to be closed by close_lookup_table
+    if store is not None or lookup_table is uid_store:
+        lookup_table = store
+    uid_store = store
+
+
+def set_profiler(new_profiler) -> None:
+    '''
+    Enable the profiling of the anonymization, cf utils.profiler.
+
+    Parameters
+    ----------
+    new_profiler : Profiler
+        Profiler recording the timings, None to disable the profiling.
+
+    Returns
+    -------
+    None.
+    '''
+    global profiler
+    profiler = new_profiler
+
+
+def set_large_file_size(size: int) -> None:
+    '''
+    Read the files of at least `size` bytes header only, whatever the header_only
+    argument of read_dicom_file, so that their pixel data is copied by blocks instead
+    of being loaded in memory.
+
+    Parameters
+    ----------
+    size : int
+        Size in bytes, None to read the files as requested by header_only.
+
+    Returns
+    -------
+    None.
+    '''
+    global large_file_size
+    large_file_size = size
+
+
+def set_transcoding(new_transfer_syntax, report=None) -> None:
+    '''
+    Compress the pixel data of the anonymized files before writing them, cf utils.transcoding.
+
+    Parameters
+    ----------
+    new_transfer_syntax : pydicom.uid.UID
+        Lossless compressed transfer syntax (cf transcoding.get_transfer_syntax), None to
+        write the pixel data as read.
+    report : TranscodingReport
+        Report the result of each file is added to, None for no report.
+
+    Returns
+    -------
+    None.
+    '''
+    global transfer_syntax, transcoding_report
+    transfer_syntax = new_transfer_syntax
+    transcoding_report = report
+
+
+def get_transcoding_report():
+    '''
+    Get the report set by set_transcoding, None if there is none.
+    '''
+    return transcoding_report
+
+
+def transcode_pixel_data(dataset: pydicom.Dataset, path: str, pixel_data_range: tuple = None) -> None:
+    '''
+    Compress the pixel data of a dataset about to be written, if set_transcoding was called.
+
+    Parameters
+    ----------
+    dataset : FileDataset object of pydicom.dataset module
+        Anonymized dataset.
+    path : str
+        Name of the file in the report.
+    pixel_data_range : tuple
+        Offsets of the pixel data not read, cf read_dicom_file. The pixel data is then
+        copied as is.
+
+    Returns
+    -------
+    None.
+    '''
+    if transfer_syntax is None:
+        return
+    if pixel_data_range is not None:
+        size = pixel_data_range[1] - pixel_data_range[0]
+        result = ('header_only', size, size, 0.0)
+    else:
+        with profile_stage('encode'):
+            result = transcode_dataset(dataset, transfer_syntax)
+    if transcoding_report is not None:
+        transcoding_report.add(path, result)
+
+
+def is_large_size(size: int) -> bool:
+    '''
+    Whether a file of `size` bytes must be read header only, see set_large_file_size.
+    '''
+    return large_file_size is not None and size >= large_file_size
+
+
+def is_large_file(fp) -> bool:
+    '''
+    Whether a file opened in binary mode must be read header only, see set_large_file_size.
+    In-memory files are never large: the size of an archive member is checked by the
+    caller with is_large_size.
+    '''
+    if large_file_size is None:
+        return False
+    try:
+        return is_large_size(os.fstat(fp.fileno()).st_size)
+    except OSError: # In-memory file
+        return False
+
+
+def get_profiler():
+    '''
+    Get the profiler set by set_profiler, None if the profiling is disabled.
+    '''
+    return profiler
+
+
+def profile_stage(name: str):
+    '''
+    Context manager timing a stage if the profiling is enabled, see set_profiler.
+    '''
+    return nullcontext() if profiler is None else profiler.stage(name)
+
+
+def commit_store() -> None:
+    '''
+    Commit the store set by set_store, if any. Called after each file, the SQLiteStore commits
+    each new correspondence itself so that no write lock is held while the file is written.
+    '''
+    if uid_store is not None:
+        uid_store.commit()
+
+
+def get_lookup_table():
+    '''
+    Get the lookup table of the current lookup path, opening it the first time.
+
+    Returns
+    -------
+    t : LookupTable or ShardedLookupTable
+        The lookup table (or its proxy when shared between processes).
+    '''
+    global lookup_table
+    if lookup_table is None:
+        lookup_table = open_lookup_table(lookup_path)
+    return lookup_table
+
+
+def close_lookup_table() -> None:
+    '''
+    Write the pending rows of the lookup table and forget it.
+    '''
+    global lookup_table
+    if lookup_table is not None:
+        lookup_table.close()
+        lookup_table = None
 
 
 # Regexp function
@@ -38,28 +290,89 @@ def regexp(options: dict):
 
     '''
 
-    def apply_regexp(dataset, tag):
-        '''
-        Apply a regexp to the dataset
-        '''
-        element = dataset.get(tag)
-        if element is not None:
-            element.value = re.sub(options['find'], options['replace'], str(element.value))
+    # A partial (rather than a closure) can be sent to the worker processes
+    return partial(apply_regexp, re.compile(options['find']), options['replace'])
 
-    return apply_regexp
+
+def apply_regexp(pattern: re.Pattern, replace: str, dataset, tag):
+    '''
+    Apply a compiled regexp to the dataset
+    '''
+    element = dataset.get(tag)
+    if element is not None:
+        element.value = pattern.sub(replace, str(element.value))
 
 
 # Default anonymization functions
 
+def generate_keyed_UID(uid: str, key: bytes) -> str:
+    '''
+    Derive a UID from an original UID and a secret key.
+
+    The same UID and key always give the same UID, so that runs, processes or sites
+    sharing the key replace UIDs consistently without keeping any correspondence.
+    The result is a UUID derived UID (2.25.<128 bits integer>), at most 44 characters long.
+
+    Parameters
+    ----------
+    uid : str
+        Original UID.
+    key : bytes
+        Secret key.
+
+    Returns
+    -------
+    s : str
+        The derived UID, '' if uid is empty.
+    '''
+    if not uid:
+        return uid
+    digest = hmac.new(key, uid.encode(), hashlib.sha256).digest()
+    return '2.25.' + str(int.from_bytes(digest[:16], 'big'))
+
+
+def generate_random_UID(uid: str) -> str:
+    '''
+    Keep char value but replace char number with random number
+    '''
+    new_chars = [str(randint(0, 9)) if char.isalnum() else char for char in uid]
+    return ''.join(new_chars)
+
+
 def replace_element_UID(element):
     '''
     Keep char value but replace char number with random number
     The replaced value is kept in a dictionary link to the initial element.value in order to automatically
     apply the same replaced value if we have an other UID with the same value
+    If a UID key is set (cf set_uid_key), the UID is derived from the key instead, cf generate_keyed_UID
+    If a store is set (cf set_store), the replaced value is kept in the store instead of the dictionary
+    Inside StreamAnonymizer.anonymize_dataset, the UIDs of the StreamAnonymizer are used instead
     '''
+    anonymizer = current_anonymizer.get()
+    if anonymizer is not None:
+        if element.VM > 1:
+            element.value = [anonymizer.get_UID(uid) for uid in element.value]
+        else:
+            element.value = anonymizer.get_UID(element.value)
+        return
+
+    if uid_key is not None:
+        if element.VM > 1:
+            element.value = [generate_keyed_UID(uid, uid_key) for uid in element.value]
+        else:
+            element.value = generate_keyed_UID(element.value, uid_key)
+        return
+
+    if uid_store is not None:
+        if element.VM > 1:
+            element.value = [uid_store.get_UID(uid, generate_random_UID) for uid in element.value]
+        else:
+            element.value = uid_store.get_UID(element.value, generate_random_UID)
+        return
+
     if element.value not in dictionary:
-        new_chars = [str(randint(0, 9)) if char.isalnum() else char for char in element.value]
-        dictionary[element.value] = ''.join(new_chars)
+        # setdefault keeps the first value when several processes share the dictionary
+        dictionary.setdefault(element.value, generate_random_UID(element.value))
     element.value = dictionary.get(element.value)
 
 
@@ -108,7 +421,7 @@ def replace_element(element):
         element.value = ''
     elif element.VR == 'SQ':
         for sub_dataset in element.value:
-            for sub_element in sub_dataset.elements():
+            for sub_element in sub_dataset:
                 replace_element(sub_element)
     elif element.VR == 'DT':
         replace_element_date_time(element)
@@ -145,7 +458,7 @@ def empty_element(element):
         element.value = 0
     elif element.VR == 'SQ':
         for sub_dataset in element.value:
-            for sub_element in sub_dataset.elements():
+            for sub_element in sub_dataset:
                 empty_element(sub_element)
     else:
         raise NotImplementedError('Not anonymized. VR {} not yet implemented.'.format(element.VR))
@@ -170,7 +483,7 @@ def delete_element(dataset, element):
         replace_element_date(element)
     elif element.VR == 'SQ' and element.value is type(pydicom.Sequence):
         for sub_dataset in element.value:
-            for sub_element in sub_dataset.elements():
+            for sub_element in sub_dataset:
                 delete_element(sub_dataset, sub_element)
     else:
         del dataset[element.tag]
@@ -249,40 +562,21 @@ def replace_and_keep_correspondence(dataset, tag):
     It also replaces implicitly the tag (0x0008, 0x0050) (AccessionNumber).
     A lookup table (csv file) is create with columns: 
     'old_patient_id', 'new_patient_id', 'old_accession_number', 'new_accession_number'
+    Inside StreamAnonymizer.anonymize_dataset, the lookup table of the StreamAnonymizer is used.
     '''
-    if lookup_path is None:
+    anonymizer = current_anonymizer.get()
+    if anonymizer is None and lookup_path is None and lookup_table is None:
         raise ValueError("Missing path to lookup table to save correspondence")
-    if os.path.exists(lookup_path):
-        with open(lookup_path, 'r') as csvfile:
-            reader = csv.reader(csvfile)
-            data = np.array(list(reader))
-    else:
-        data = np.array([['old_patient_id', 'new_patient_id', 'old_accession_number', 'new_accession_number']])
 
-    data_changed = True
     element = dataset.get(tag)
     if element is not None:
         new_value_patient_id = hashlib.sha256((str(dataset.PatientID) + str(os.urandom(32))).encode()).hexdigest()
         new_value_accession_number = hashlib.sha256((str(dataset.AccessionNumber) + str(os.urandom(32))).encode()).hexdigest()
         if element.VR == "LO": # Patient ID
-            if element.value not in data[:,0]: # Patient not in csv
-                data = np.append(data, [[str(dataset.PatientID), new_value_patient_id, str(dataset.AccessionNumber), new_value_accession_number]], axis=0)
-                dataset.PatientID = new_value_patient_id
-                dataset.AccessionNumber = new_value_accession_number
-            else: # Patient in csv
-                if dataset.AccessionNumber in data[:,2]: # AccessNumber in csv
-                    idx = np.argwhere(data[:,2] == str(dataset.AccessionNumber))[0][0]
-                    dataset.AccessionNumber = data[idx,3]
-                    dataset.PatientID = data[idx,1]
-                    data_changed = False
-                else: # AccessNumber not in csv
-                    idx = np.argwhere(data[:,0] == str(dataset.PatientID))[0][0]
-                    data = np.append(data, [[data[idx,0], data[idx,1], str(dataset.AccessionNumber), new_value_accession_number]], axis=0)
-                    dataset.PatientID = data[idx,1]
-                    dataset.AccessionNumber = new_value_accession_number
-
-    if data_changed:
-        np.savetxt(lookup_path, data, delimiter=',', fmt="%s")
+            table = get_lookup_table() if anonymizer is None else anonymizer.lookup_table
+            with profile_stage('lookup'):
+                dataset.PatientID, dataset.AccessionNumber = table.get_pseudonyms(
+                    str(dataset.PatientID), str(dataset.AccessionNumber), new_value_patient_id, new_value_accession_number)
 
 # Generation functions
 
@@ -355,8 +649,255 @@ def initialize_actions() -> dict:
     return anonymization_actions
 
 
+class AnonymizationPlan(NamedTuple):
+    '''
+    Anonymization rules compiled once per run by compile_actions. Must not be modified.
+
+    Attributes
+    ----------
+    tag_actions : dict
+        Rules of the individual tags, indexed by pydicom Tag. Each rule is stored as a
+        (position, tag, action, is_private) tuple, where position is the order in which
+        the rule is applied.
+    masked_actions : tuple
+        Rules of the repeating groups, as (group mask, element mask, rules) tuples where
+        rules link the masked (group, element) to a (position, action) tuple.
+    mask_templates : tuple
+        Templates of the burned-in annotations to mask in the pixel data, cf utils.pixel_masking.
+    '''
+    tag_actions: dict
+    masked_actions: tuple
+    mask_templates: tuple = ()
+
+
+def compile_actions(extra_anonymization_rules: dict = None, mask_templates: tuple = ()) -> AnonymizationPlan:
+    '''
+    Compile the DICOM standard actions and the extra rules into an anonymization plan
+
+    Parameters
+    ----------
+    extra_anonymization_rules : dict
+        Rules overriding or added to the DICOM standard ones
+    mask_templates : tuple
+        Templates of the burned-in annotations to mask, cf utils.pixel_masking.load_mask_templates
+
+    Returns
+    -------
+    p : AnonymizationPlan
+        The plan to be given to anonymize_dataset for every dataset of the run.
+    '''
+    anonymization_actions = initialize_actions()
+    if extra_anonymization_rules is not None:
+        anonymization_actions.update(extra_anonymization_rules)
+
+    tag_actions = {}
+    masked_actions = {}
+    for position, (tag, action) in enumerate(anonymization_actions.items()):
+        # We are in a repeating group, e.g. (0x6000, 0x3000, 0xFF00, 0xFFFF) matches (0x60xx, 0x3000)
+        if len(tag) > 2:
+            masks = (tag[2], tag[3])
+            masked_actions.setdefault(masks, {})[(tag[0], tag[1])] = (position, action)
+        # Individual Tags
+        else:
+            tag_key = pydicom.tag.Tag(tag)
+            tag_actions[tag_key] = (position, tag, action, tag_key.is_private)
+
+    masked_actions = tuple((masks[0], masks[1], rules) for masks, rules in masked_actions.items())
+    return AnonymizationPlan(tag_actions, masked_actions, tuple(mask_templates or ()))
+
+
+def apply_masked_actions(masked_actions: tuple, dataset: pydicom.Dataset) -> None:
+    '''
+    Apply the repeating group rules to all the matching elements of the dataset,
+    including the elements of nested sequences, in a single walk.
+
+    Parameters
+    ----------
+    masked_actions : tuple
+        Rules of the repeating groups of an AnonymizationPlan.
+    dataset : FileDataset object of pydicom.dataset module
+        Dataset to be anonymized
+
+    Returns
+    -------
+    None.
+    '''
+    def masked_callback(dataset, data_element):
+        group = data_element.tag.group
+        element = data_element.tag.element
+        matching_rules = []
+        for group_mask, element_mask, rules in masked_actions:
+            rule = rules.get((group & group_mask, element & element_mask))
+            if rule is not None:
+                matching_rules.append(rule)
+
+        # Several rules can match the same element, apply them in order until the element is removed
+        matching_rules.sort(key=itemgetter(0))
+        for position, action in matching_rules:
+            if data_element.tag not in dataset:
+                break
+            if profiler is None:
+                action(dataset, data_element.tag)
+            else:
+                profiler.call_action(action, dataset, data_element.tag)
+
+    dataset.walk(masked_callback)
+
+
+def get_pixel_data_range(fp, dataset: pydicom.Dataset):
+    '''
+    Find the bytes of the pixel data element in a file read up to the pixel data
+
+    Parameters
+    ----------
+    fp : file-like object
+        File positioned on the pixel data element, e.g. just after
+        pydicom.dcmread(fp, stop_before_pixels=True).
+    dataset : FileDataset object of pydicom.dataset module
+        Dataset read from the file.
+
+    Returns
+    -------
+    r : tuple or None
+        (start, end) offsets of the pixel data element in the file, or None if the raw
+        bytes cannot be copied as is (deflated file or elements after the pixel data).
+    '''
+    transfer_syntax = getattr(getattr(dataset, 'file_meta', None), 'TransferSyntaxUID', None)
+    if transfer_syntax == pydicom.uid.DeflatedExplicitVRLittleEndian:
+        return None
+
+    start = fp.tell()
+    file_size = os.fstat(fp.fileno()).st_size
+    if start == file_size: # No pixel data
+        return start, start
+
+    endian = '<' if dataset.is_little_endian else '>'
+    fp.seek(4, os.SEEK_CUR) # Tag
+    if dataset.is_implicit_VR:
+        length = struct.unpack(endian + 'L', fp.read(4))[0]
+    else:
+        VR = fp.read(2)
+        if VR in (b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'):
+            length = struct.unpack(endian + 'xxL', fp.read(6))[0]
+        else:
+            length = struct.unpack(endian + 'H', fp.read(2))[0]
+
+    if length != 0xFFFFFFFF:
+        end = fp.tell() + length
+    else:
+        # Encapsulated pixel data: skip the items up to the sequence delimiter
+        while True:
+            item = fp.read(8)
+            if len(item) < 8:
+                return None
+            group, element, item_length = struct.unpack(endian + 'HHL', item)
+            if (group, element) == (0xFFFE, 0xE0DD):
+                break
+            fp.seek(item_length, os.SEEK_CUR)
+        end = fp.tell()
+
+    # Trailing elements must be anonymized too, they are only reachable by reading the whole file
+    if end != file_size:
+        return None
+    return start, end
+
+
+def read_dicom_file(fp, header_only: bool = False) -> tuple:
+    '''
+    Read a DICOM file, without its pixel data if header_only is set
+
+    Parameters
+    ----------
+    fp : file-like object
+        DICOM file opened in binary mode.
+    header_only : bool
+        Define if only the header should be read, the pixel data is then left in the
+        file and copied by write_dicom_file. Also set for large files, see set_large_file_size.
+
+    Returns
+    -------
+    t : tuple
+        The dataset and the (start, end) offsets of the pixel data still to be copied
+        from fp, or None if the dataset was entirely read.
+    '''
+    with profile_stage('read'):
+        if not header_only:
+            header_only = is_large_file(fp)
+        if header_only:
+            dataset = pydicom.dcmread(fp, force=True, stop_before_pixels=True)
+            pixel_data_range = get_pixel_data_range(fp, dataset)
+            if pixel_data_range is not None:
+                return dataset, pixel_data_range
+            fp.seek(0)
+        return pydicom.dcmread(fp, force=True), None
+
+
+def load_pixel_data_to_mask(dataset: pydicom.Dataset, fp, pixel_data_range: tuple, anonymization_actions) -> tuple:
+    '''
+    Read entirely a file read header only by read_dicom_file if its pixel data must be
+    masked by anonymize_dataset.
+
+    Parameters
+    ----------
+    dataset, fp, pixel_data_range :
+        Cf read_dicom_file.
+    anonymization_actions : dict or AnonymizationPlan
+        Rules that will be applied on the dataset, only a plan can have mask templates.
+
+    Returns
+    -------
+    t : tuple
+        The dataset and pixel data range, read again if needed.
+    '''
+    if (pixel_data_range is None or not isinstance(anonymization_actions, AnonymizationPlan)
+            or not anonymization_actions.mask_templates):
+        return dataset, pixel_data_range
+    if find_mask_template(anonymization_actions.mask_templates, dataset) is None:
+        return dataset, pixel_data_range
+    with profile_stage('read'):
+        fp.seek(0)
+        return pydicom.dcmread(fp, force=True), None
+
+
+def write_dicom_file(dataset: pydicom.Dataset, out_file: str, fp=None, pixel_data_range: tuple = None) -> None:
+    '''
+    Write a dataset, appending the pixel data of the input file when it was not read
+
+    Parameters
+    ----------
+    dataset : FileDataset object of pydicom.dataset module
+        Dataset to be written.
+    out_file : str
+        File path or file-like object to write to
+    fp : file-like object
+        Input file the dataset was read from by read_dicom_file.
+    pixel_data_range : tuple
+        (start, end) offsets of the pixel data in fp, as returned by read_dicom_file.
+
+    Returns
+    -------
+    None.
+    '''
+    if pixel_data_range is None:
+        dataset.save_as(out_file)
+        return
+
+    with open(out_file, 'wb') if isinstance(out_file, str) else nullcontext(out_file) as out_fp:
+        dataset.save_as(out_fp)
+        # The pixel data element is copied by blocks, the output uses the same transfer syntax
+        start, end = pixel_data_range
+        fp.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = fp.read(min(PIXEL_DATA_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise EOFError('Unexpected end of file while copying pixel data')
+            out_fp.write(chunk)
+            remaining -= len(chunk)
+
+
 def anonymize_dicom_file(in_file: str, out_file: str, lookup_file: str = None, extra_anonymization_rules: dict = None,
-                         delete_private_tags: bool = True, rename_files: bool = False) -> None:
+                         delete_private_tags: bool = True, rename_files: bool = False, header_only: bool = False) -> None:
     '''
     Anonymize a DICOM file by modifying personal tags
 
@@ -370,33 +911,82 @@ def anonymize_dicom_file(in_file: str, out_file: str, lookup_file: str = None, e
         File path or file-like object to write to
     lookup_file : str
         File path to the lookup table.
-    extra_anonymization_rules : str
-        Add more tag's actions
+    extra_anonymization_rules : dict or AnonymizationPlan
+        Add more tag's actions, or plan compiled by compile_actions
     delete_private_tags : bool
         Define if private tags should be delete or not
+    rename_files : bool
+        Define if the output file should be renamed with the pseudonymized IDs
+    header_only : bool
+        Define if only the header should be read and anonymized. The pixel data is then
+        copied from the input file by blocks, without being loaded in memory.
 
     Returns
     -------
-    d: dict
-        The generated dictionary with the action to be applied.
+    None.
     '''
     if (os.path.isfile(in_file)):
-        dataset = pydicom.dcmread(in_file, force=True)
-        
-        global lookup_path
-        lookup_path = lookup_file
+        if profiler is not None:
+            profiler.begin_file(in_file)
+        with open(in_file, 'rb') as fp:
+            dataset, pixel_data_range = read_dicom_file(fp, header_only)
+            dataset, pixel_data_range = load_pixel_data_to_mask(dataset, fp, pixel_data_range, extra_anonymization_rules)
+            set_lookup_path(lookup_file)
+            anonymize_dataset(dataset, extra_anonymization_rules, delete_private_tags)
+            save_anonymized_file(dataset, out_file, fp, pixel_data_range, rename_files)
+        if profiler is not None:
+            profiler.end_file()
+
+
+def set_lookup_path(lookup_file: str) -> None:
+    '''
+    Set the path to the lookup table used by replace_and_keep_correspondence,
+    closing the lookup table of the previous path if it changed.
+    '''
+    global lookup_path
+    if lookup_file != lookup_path and lookup_path is not None:
+        close_lookup_table()
+    lookup_path = lookup_file
 
-        anonymize_dataset(dataset, extra_anonymization_rules, delete_private_tags)
+
+def save_anonymized_file(dataset: pydicom.Dataset, out_file: str, fp=None, pixel_data_range: tuple = None,
+                         rename_files: bool = False) -> None:
+    '''
+    Write an anonymized dataset, see write_dicom_file, and commit the store if any.
+
+    Parameters
+    ----------
+    dataset : FileDataset object of pydicom.dataset module
+        Anonymized dataset.
+    out_file : str
+        File path to write to
+    fp : file-like object
+        Input file the dataset was read from by read_dicom_file.
+    pixel_data_range : tuple
+        (start, end) offsets of the pixel data in fp, as returned by read_dicom_file.
+    rename_files : bool
+        Define if the output file should be renamed with the pseudonymized IDs
+
+    Returns
+    -------
+    None.
+    '''
+    with profile_stage('write'):
+        transcode_pixel_data(dataset, out_file, pixel_data_range)
 
         # Store modified image
         if rename_files:
             start_file_name = out_file.rfind('/')
             pseudo = str(dataset.PatientID) + '-' + str(dataset.AccessionNumber)
-            num_file = str(len(os.listdir(out_file[:start_file_name])))
-            full_out_path =  out_file[:start_file_name] + num_file + '_' + pseudo
-            dataset.save_as(full_out_path)
+            # The file number is derived from the folder content, do not let another process write in between
+            with output_lock if output_lock is not None else nullcontext():
+                num_file = str(len(os.listdir(out_file[:start_file_name])))
+                full_out_path =  out_file[:start_file_name] + num_file + '_' + pseudo
+                write_dicom_file(dataset, full_out_path, fp, pixel_data_range)
         else:
-            dataset.save_as(out_file)
+            write_dicom_file(dataset, out_file, fp, pixel_data_range)
+
+        commit_store()
 
 
 def get_private_tag(dataset, tag):
@@ -490,8 +1080,9 @@ def anonymize_dataset(dataset: pydicom.Dataset, extra_anonymization_rules: dict
     ----------
     dataset : FileDataset object of pydicom.dataset module
         Dataset to be anonymized
-    extra_anonymization_rules : dict
-        Rules to be applied on the dataset
+    extra_anonymization_rules : dict or AnonymizationPlan
+        Rules to be applied on the dataset, or plan compiled by compile_actions
+        (prefer the latter when anonymizing several datasets)
     delete_private_tags : bool
         Define if private tags should be delete or not
 
@@ -499,44 +1090,52 @@ def anonymize_dataset(dataset: pydicom.Dataset, extra_anonymization_rules: dict
     -------
     None.
     '''
-    current_anonymization_actions = initialize_actions()
-
-    if extra_anonymization_rules is not None:
-        current_anonymization_actions.update(extra_anonymization_rules)
-
-    private_tags = []
+    with profile_stage('anonymize'):
+        if isinstance(extra_anonymization_rules, AnonymizationPlan):
+            plan = extra_anonymization_rules
+        else:
+            plan = compile_actions(extra_anonymization_rules)
 
-    for tag, action in current_anonymization_actions.items():
+        # Only the rules of the tags present in the dataset are applied (the actions do nothing
+        # on missing tags), in the order of the rules
+        # Burned-in annotations, before the rules change the attributes the templates are matched on
+        mask_template = find_mask_template(plan.mask_templates, dataset) if 'PixelData' in dataset else None
+        if mask_template is not None:
+            with profile_stage('pixel_mask'):
+                mask_pixel_data(dataset, mask_template)
 
-        def range_callback(dataset, data_element):
-            if data_element.tag.group & tag[2] == tag[0] and data_element.tag.element & tag[3] == tag[1]:
-                action(dataset, tag)
+        tag_actions = plan.tag_actions
+        steps = [tag_actions[tag] for tag in dataset.keys() if tag in tag_actions]
+        steps.sort(key=itemgetter(0))
 
-        element = None
+        private_tags = []
 
-        # We are in a repeating group
-        if len(tag) > 2:
-            dataset.walk(range_callback)
         # Individual Tags
-        else:
-            action(dataset, tag)
-            try:
-                element = dataset.get(tag)
-            except:
-                print("Cannot get element from tag: ", tag_to_hex_strings(tag))
-
-            # Get private tag to restore it later
-            if element and element.tag.is_private:
-                private_tags.append(get_private_tag(dataset, tag))
-
-    # X - Private tags = (0xgggg, 0xeeee) where 0xgggg is odd
-    if delete_private_tags:
-        dataset.remove_private_tags()
-
-        # Adding back private tags if specified in dictionary
-        for privateTag in private_tags:
-            creator = privateTag["creator"]
-            element = privateTag["element"]
-            block = dataset.private_block(creator["tagGroup"], creator["creatorName"], create=True)
-            if element is not None:
-                block.add_new(element["offset"], element["element"].VR, element["element"].value)
+        with profile_stage('rules'):
+            for position, tag, action, is_private in steps:
+                if profiler is None:
+                    action(dataset, tag)
+                else:
+                    profiler.call_action(action, dataset, tag)
+
+                # Get private tag to restore it later
+                if is_private and tag in dataset:
+                    private_tags.append(get_private_tag(dataset, tag))
+
+        # Repeating groups
+        if plan.masked_actions:
+            with profile_stage('walk'):
+                apply_masked_actions(plan.masked_actions, dataset)
+
+        # X - Private tags = (0xgggg, 0xeeee) where 0xgggg is odd
+        if delete_private_tags:
+            with profile_stage('private_tags'):
+                dataset.remove_private_tags()
+
+                # Adding back private tags if specified in dictionary
+                for privateTag in private_tags:
+                    creator = privateTag["creator"]
+                    element = privateTag["element"]
+                    block = dataset.private_block(creator["tagGroup"], creator["creatorName"], create=True)
+                    if element is not None:
+                        block.add_new(element["offset"], element["element"].VR, element["element"].value)
@@ -0,0 +1,199 @@
+'''
+Persistent store of the pseudonyms and of the replaced UIDs, kept in a SQLite database.
+
+The store replaces both the lookup table csv file and the in-memory UID dictionary:
+several runs (e.g. nightly batches) and several processes can use the same database
+and get consistent pseudonyms and UIDs. The lookup table can be exported to the csv
+format of LookupTable at any time.
+
+Usage to export a store, from the dicom_pseudonymizer folder:
+    python -m utils.sqlite_store path/to/store.sqlite path/to/lookup_table.csv
+'''
+
+import argparse
+import csv
+import sqlite3
+import threading
+
+from utils.lookup_table import LOOKUP_TABLE_HEADER
+
+
+class SQLiteStore:
+    '''
+    Pseudonyms and UIDs correspondence stored in a SQLite database in WAL mode.
+
+    Lookups only read the database. Each new correspondence is written and committed
+    at once in a short transaction, so that the write lock is never held while a file
+    is read or written. Several processes can open the same database: the write
+    transaction serializes them and a value missing from the database is looked up
+    again inside the transaction (or inserted with INSERT OR IGNORE), so that the
+    first process to write a correspondence wins.
+
+    Parameters
+    ----------
+    path : str
+        Path to the database file. Created if it does not exist.
+    timeout : float
+        Time to wait for another process holding the write lock, in seconds.
+    '''
+
+    def __init__(self, path: str, timeout: float = 60.0):
+        self.path = path
+        self.lock = threading.RLock()
+
+        # Transactions are handled explicitly (isolation_level=None)
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS lookup (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                old_patient_id TEXT NOT NULL,
+                new_patient_id TEXT NOT NULL,
+                old_accession_number TEXT NOT NULL,
+                new_accession_number TEXT NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS lookup_patient ON lookup (old_patient_id, id)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS lookup_accession ON lookup (old_accession_number, id)')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS uids (
+                old_uid TEXT PRIMARY KEY,
+                new_uid TEXT NOT NULL) WITHOUT ROWID''')
+
+    def commit(self) -> None:
+        '''
+        Commit the current write transaction, if any. The correspondences being
+        committed as soon as they are written, there is nothing left to commit after
+        a file: kept for the callers of a store (cf commit_store).
+        '''
+        with self.lock:
+            if self.connection.in_transaction:
+                self.connection.execute('COMMIT')
+
+    def find_pseudonyms(self, patient_id: str, accession_number: str):
+        '''
+        Find the pseudonyms of a known patient and accession number, None otherwise.
+        '''
+        execute = self.connection.execute
+        patient = execute('SELECT new_patient_id FROM lookup WHERE old_patient_id = ? ORDER BY id LIMIT 1',
+                          (patient_id,)).fetchone()
+        if patient is None:
+            return None
+        return execute('SELECT new_patient_id, new_accession_number FROM lookup '
+                       'WHERE old_accession_number = ? ORDER BY id LIMIT 1', (accession_number,)).fetchone()
+
+    def get_pseudonyms(self, patient_id: str, accession_number: str,
+                       new_patient_id: str, new_accession_number: str) -> tuple:
+        '''
+        Get the pseudonyms of a patient ID and an accession number, registering the
+        proposed new values if they are not in the store yet. Same rules as LookupTable.
+
+        Parameters
+        ----------
+        patient_id : str
+            Original patient ID.
+        accession_number : str
+            Original accession number.
+        new_patient_id : str
+            Pseudonym used if the patient is not in the store.
+        new_accession_number : str
+            Pseudonym used if the accession number is not in the store.
+
+        Returns
+        -------
+        t : tuple
+            The pseudonymized patient ID and accession number.
+        '''
+        with self.lock:
+            pseudonyms = self.find_pseudonyms(patient_id, accession_number)
+            if pseudonyms is not None:
+                return tuple(pseudonyms)
+
+            # Look again once the write lock is held, another process may have written it
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                pseudonyms = self.find_pseudonyms(patient_id, accession_number)
+                if pseudonyms is None:
+                    patient = self.connection.execute('SELECT new_patient_id FROM lookup WHERE old_patient_id = ? '
+                                                      'ORDER BY id LIMIT 1', (patient_id,)).fetchone()
+                    if patient is not None: # Patient known, new AccessNumber
+                        new_patient_id = patient[0]
+                    self.connection.execute('INSERT INTO lookup (old_patient_id, new_patient_id, old_accession_number, '
+                                            'new_accession_number) VALUES (?, ?, ?, ?)',
+                                            (patient_id, new_patient_id, accession_number, new_accession_number))
+                    pseudonyms = (new_patient_id, new_accession_number)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            return tuple(pseudonyms)
+
+    def get_UID(self, uid: str, generate_UID) -> str:
+        '''
+        Get the replacement of a UID, registering a new UID if it is not in the store yet.
+
+        Parameters
+        ----------
+        uid : str
+            Original UID.
+        generate_UID : callable
+            Function generating the replacement from the original UID, only called
+            if the UID is not in the store.
+
+        Returns
+        -------
+        s : str
+            The replacement UID.
+        '''
+        with self.lock:
+            row = self.connection.execute('SELECT new_uid FROM uids WHERE old_uid = ?', (uid,)).fetchone()
+            if row is not None:
+                return row[0]
+
+            # Committed at once (autocommit), the UID of another process wins
+            self.connection.execute('INSERT OR IGNORE INTO uids (old_uid, new_uid) VALUES (?, ?)', (uid, generate_UID(uid)))
+            return self.connection.execute('SELECT new_uid FROM uids WHERE old_uid = ?', (uid,)).fetchone()[0]
+
+    def export_csv(self, path: str) -> None:
+        '''
+        Export the lookup table to a csv file, in the format of LookupTable.
+
+        Parameters
+        ----------
+        path : str
+            Path to the csv file, overwritten.
+
+        Returns
+        -------
+        None.
+        '''
+        with self.lock:
+            self.commit()
+            rows = self.connection.execute('SELECT old_patient_id, new_patient_id, old_accession_number, '
+                                           'new_accession_number FROM lookup ORDER BY id')
+            with open(path, 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile, lineterminator='\n')
+                writer.writerow(LOOKUP_TABLE_HEADER)
+                writer.writerows(rows)
+
+    def flush(self) -> None:
+        '''
+        Commit the current write transaction, if any, cf commit.
+        '''
+        self.commit()
+
+    def close(self) -> None:
+        '''
+        Close the database.
+        '''
+        with self.lock:
+            self.commit()
+            self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('store', help='Path to the SQLite store')
+    parser.add_argument('lookup', help='Path to the lookup table csv file to write')
+    args = parser.parse_args()
+
+    store = SQLiteStore(args.store)
+    store.export_csv(args.lookup)
+    store.close()
@@ -0,0 +1,148 @@
+'''
+In-memory anonymization API, to embed the pseudonymizer in a service.
+
+Unlike anonymize_dicom_file, which uses the module state of simple_dicomanonymizer,
+a StreamAnonymizer holds its own compiled rules, lookup table and UIDs correspondence.
+Several StreamAnonymizer objects can be used at the same time, and each of them can be
+used by several threads: the state of the object is only visible to the thread
+(context) running one of its methods.
+
+Usage:
+    with StreamAnonymizer(lookup='lookup_table.csv') as anonymizer:
+        for data in anonymizer.anonymize_stream(received_files):
+            send(data)
+'''
+
+import io
+import threading
+
+import pydicom
+
+from utils.simple_dicomanonymizer import *
+from utils.lookup_table import open_lookup_table
+
+
+class StreamAnonymizer:
+    '''
+    Reentrant and thread-safe anonymizer of DICOM bytes or file-like objects.
+
+    Parameters
+    ----------
+    extra_anonymization_rules : dict or AnonymizationPlan
+        Rules overriding or added to the DICOM standard ones, or plan compiled by compile_actions.
+    delete_private_tags : bool
+        Whether to delete private tags.
+    lookup : str or LookupTable
+        Path to the lookup table csv file or sharded lookup table folder, or lookup table
+        object (anything with a get_pseudonyms method). If None, the lookup table is only
+        kept in memory.
+    uid_key : bytes
+        Secret key used to derive the UIDs, cf generate_keyed_UID. If None, random UIDs
+        are kept in memory by the object.
+    store : SQLiteStore
+        Store of the pseudonyms and UIDs, used instead of lookup and of the in-memory UIDs.
+        The store is committed after each file but not closed by the object.
+    '''
+
+    def __init__(self, extra_anonymization_rules: dict = None, delete_private_tags: bool = True,
+                 lookup=None, uid_key: bytes = None, store=None):
+        if isinstance(extra_anonymization_rules, AnonymizationPlan):
+            self.plan = extra_anonymization_rules
+        else:
+            self.plan = compile_actions(extra_anonymization_rules)
+        self.delete_private_tags = delete_private_tags
+        self.uid_key = uid_key
+        self.store = store
+
+        # Only a lookup table opened by the object is closed by it
+        self.own_lookup_table = store is None and (lookup is None or isinstance(lookup, str))
+        if store is not None:
+            self.lookup_table = store
+        elif self.own_lookup_table:
+            self.lookup_table = open_lookup_table(lookup)
+        else:
+            self.lookup_table = lookup
+
+        # Original UID -> random UID
+        self.uids = {}
+        self.uids_lock = threading.Lock()
+
+    def get_UID(self, uid: str) -> str:
+        '''
+        Get the replacement of a UID, cf replace_element_UID.
+        '''
+        if self.uid_key is not None:
+            return generate_keyed_UID(uid, self.uid_key)
+        if self.store is not None:
+            return self.store.get_UID(uid, generate_random_UID)
+        with self.uids_lock:
+            new_uid = self.uids.get(uid)
+            if new_uid is None:
+                new_uid = self.uids[uid] = generate_random_UID(uid)
+            return new_uid
+
+    def anonymize_dataset(self, dataset: pydicom.Dataset) -> None:
+        '''
+        Anonymize a pydicom Dataset in place, with the rules and state of the object.
+        '''
+        token = current_anonymizer.set(self)
+        try:
+            anonymize_dataset(dataset, self.plan, self.delete_private_tags)
+        finally:
+            current_anonymizer.reset(token)
+
+    def anonymize(self, data) -> bytes:
+        '''
+        Anonymize a DICOM file held in memory.
+
+        Parameters
+        ----------
+        data : bytes or file-like object
+            Content of the DICOM file, or binary file-like object positioned at its start.
+
+        Returns
+        -------
+        b : bytes
+            Content of the anonymized DICOM file.
+        '''
+        fp = io.BytesIO(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+        # A large file (cf set_large_file_size) is read header only, its pixel data is then copied from fp
+        dataset, pixel_data_range = read_dicom_file(fp)
+        dataset, pixel_data_range = load_pixel_data_to_mask(dataset, fp, pixel_data_range, self.plan)
+        self.anonymize_dataset(dataset)
+
+        out_fp = io.BytesIO()
+        write_dicom_file(dataset, out_fp, fp, pixel_data_range)
+        if self.store is not None:
+            self.store.commit()
+        return out_fp.getvalue()
+
+    def anonymize_stream(self, items):
+        '''
+        Anonymize DICOM files one by one, cf anonymize.
+
+        Parameters
+        ----------
+        items : iterable
+            bytes or file-like objects.
+
+        Returns
+        -------
+        g : generator
+            The anonymized bytes of each item, in order.
+        '''
+        for data in items:
+            yield self.anonymize(data)
+
+    def close(self) -> None:
+        '''
+        Write the pending rows of the lookup table opened by the object.
+        '''
+        if self.own_lookup_table:
+            self.lookup_table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
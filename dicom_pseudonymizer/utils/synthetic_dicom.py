@@ -0,0 +1,161 @@
+'''
+Generation of synthetic DICOM corpora, used to benchmark the pseudonymizer.
+
+The files are deterministic for a given seed and contain the kind of elements the
+anonymization rules apply to: patient and study identifiers, UIDs, nested sequences,
+private tags and overlay (repeating) groups.
+'''
+
+import os
+
+import numpy as np
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian
+
+# Root of the synthetic UIDs
+UID_ROOT = '1.2.826.0.1.3680043.9.7229.'
+# Secondary Capture Image Storage
+SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.7'
+
+
+def generate_sequence(index: int, depth: int) -> Sequence:
+    '''
+    Generate a sequence of referenced images nested `depth` times.
+    '''
+    item = Dataset()
+    item.ReferencedSOPClassUID = SOP_CLASS_UID
+    item.ReferencedSOPInstanceUID = UID_ROOT + '3.{}.{}'.format(index, depth)
+    item.PatientName = 'Nested^Name{}'.format(depth)
+    if depth > 1:
+        item.ReferencedImageSequence = generate_sequence(index, depth - 1)
+    return Sequence([item])
+
+
+def generate_dataset(path: str, index: int, patients: int = 10, accessions_per_patient: int = 2,
+                     rows: int = 256, columns: int = 256, frames: int = 1, private_tags: int = 8,
+                     sequence_depth: int = 2, overlay_groups: int = 1, seed: int = 0) -> FileDataset:
+    '''
+    Generate a synthetic DICOM dataset with 16 bits monochrome pixel data.
+
+    Parameters
+    ----------
+    path : str
+        Path the dataset will be saved to.
+    index : int
+        Index of the file in the corpus, files are spread over the patients and accessions.
+    patients : int
+        Number of different patient IDs in the corpus.
+    accessions_per_patient : int
+        Number of different accession numbers per patient.
+    rows, columns, frames : int
+        Size of the pixel data.
+    private_tags : int
+        Number of private tags, in one private block.
+    sequence_depth : int
+        Nesting depth of the referenced image sequence, 0 for no sequence.
+    overlay_groups : int
+        Number of overlay groups (6000, 6002, ...), at most 16.
+    seed : int
+        Seed of the pixel data.
+
+    Returns
+    -------
+    ds : FileDataset
+        The generated dataset.
+    '''
+    patient = index % patients
+    accession = (index // patients) % accessions_per_patient
+    study = patient * accessions_per_patient + accession
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = SOP_CLASS_UID
+    file_meta.MediaStorageSOPInstanceUID = UID_ROOT + '1.{}'.format(index)
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = SOP_CLASS_UID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = UID_ROOT + '2.{}'.format(study)
+    ds.SeriesInstanceUID = UID_ROOT + '2.{}.1'.format(study)
+    ds.FrameOfReferenceUID = UID_ROOT + '2.{}.2'.format(study)
+    ds.PatientName = 'Synthetic^Patient{}'.format(patient)
+    ds.PatientID = 'PAT{:06d}'.format(patient)
+    ds.PatientBirthDate = '19{:02d}0101'.format(patient % 100)
+    ds.PatientSex = 'MF'[patient % 2]
+    ds.AccessionNumber = 'ACC{:06d}{:02d}'.format(patient, accession)
+    ds.StudyID = str(study)
+    ds.StudyDate = '20200101'
+    ds.StudyTime = '120000'
+    ds.SeriesNumber = 1
+    ds.InstanceNumber = index + 1
+    ds.Modality = 'OT'
+    ds.Manufacturer = 'Synthetic'
+    ds.InstitutionName = 'Synthetic Hospital'
+    ds.ReferringPhysicianName = 'Synthetic^Physician'
+    ds.OperatorsName = 'Synthetic^Operator'
+    ds.StudyDescription = 'Synthetic study {}'.format(study)
+
+    if sequence_depth > 0:
+        ds.ReferencedImageSequence = generate_sequence(index, sequence_depth)
+
+    if private_tags > 0:
+        block = ds.private_block(0x0009, 'SYNTHETIC', create=True)
+        for element in range(private_tags):
+            block.add_new(element, 'LO', 'Private value {} {}'.format(index, element))
+
+    # One bit per pixel, padded to an even length
+    overlay_length = (rows * columns + 15) // 16 * 2
+    for overlay in range(min(overlay_groups, 16)):
+        group = 0x6000 + 2 * overlay
+        ds.add_new((group, 0x0010), 'US', rows)
+        ds.add_new((group, 0x0011), 'US', columns)
+        ds.add_new((group, 0x0022), 'LO', 'Overlay of {}'.format(ds.PatientName))
+        ds.add_new((group, 0x0040), 'CS', 'G')
+        ds.add_new((group, 0x0050), 'SS', [1, 1])
+        ds.add_new((group, 0x0100), 'US', 1)
+        ds.add_new((group, 0x0102), 'US', 0)
+        ds.add_new((group, 0x3000), 'OW', bytes(overlay_length))
+
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows = rows
+    ds.Columns = columns
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    rng = np.random.default_rng(seed + index)
+    ds.PixelData = rng.integers(0, 4096, (frames, rows, columns), dtype=np.uint16).tobytes()
+    return ds
+
+
+def generate_corpus(folder: str, files: int, **kwargs) -> list:
+    '''
+    Generate a synthetic corpus in a folder, cf generate_dataset.
+
+    Parameters
+    ----------
+    folder : str
+        Output folder, created if it does not exist.
+    files : int
+        Number of files.
+    kwargs :
+        Parameters of generate_dataset.
+
+    Returns
+    -------
+    l : list
+        Paths of the generated files.
+    '''
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for index in range(files):
+        path = os.path.join(folder, '{:06d}.dcm'.format(index))
+        generate_dataset(path, index, **kwargs).save_as(path, write_like_original=False)
+        paths.append(path)
+    return paths
@@ -0,0 +1,173 @@
+'''
+Lossless re-encoding of the pixel data of the anonymized files, enabled by
+simple_dicomanonymizer.set_transcoding.
+
+The pixel data of the files read entirely with an uncompressed little endian transfer
+syntax is compressed by pydicom (Dataset.compress) just before the file is written.
+RLE Lossless is always available, JPEG-LS and JPEG 2000 lossless need a version of
+pydicom with encoders for them and the plugins of these codecs (pylibjpeg or gdcm):
+only the transfer syntaxes whose encoder is available are offered (cf
+get_available_transfer_syntaxes). A file whose pixel data cannot be encoded (e.g. a
+pixel type not supported by the encoder) keeps its transfer syntax, the failure is
+printed and reported, and the run goes on. The other files are written as they are:
+already compressed, big endian, or read header only (--headerOnly or --largeFileSize),
+whose pixel data is copied without being loaded.
+
+The size before and after compression and the encoding time of each file are kept
+in a TranscodingReport, which can be written to a csv file.
+'''
+
+import csv
+import threading
+import time
+
+import pydicom
+from pydicom.encoders import get_encoder
+
+# Name of the option -> transfer syntax
+TRANSFER_SYNTAXES = {
+    'rle': pydicom.uid.RLELossless,
+    'jpegls': pydicom.uid.JPEGLSLossless,
+    'jpeg2000': pydicom.uid.JPEG2000Lossless,
+}
+
+REPORT_HEADER = ['file', 'status', 'raw_bytes', 'encoded_bytes', 'ratio', 'encode_seconds']
+
+
+def get_transfer_syntax(name: str) -> pydicom.uid.UID:
+    '''
+    Get the transfer syntax of a name of TRANSFER_SYNTAXES, checking that it can be encoded.
+
+    Raises
+    ------
+    ValueError
+        If the name is unknown or if the encoder of the transfer syntax is not available.
+    '''
+    if name not in TRANSFER_SYNTAXES:
+        raise ValueError('Unknown transfer syntax {}, expected one of {}'.format(name, ', '.join(TRANSFER_SYNTAXES)))
+    transfer_syntax = TRANSFER_SYNTAXES[name]
+    try:
+        encoder = get_encoder(transfer_syntax)
+    except NotImplementedError: # Not supported by this version of pydicom
+        raise ValueError('No encoder available for ' + transfer_syntax.name)
+    if not encoder.is_available:
+        raise ValueError('No encoder available for {}, missing: {}'.format(
+            transfer_syntax.name, ', '.join(encoder.missing_dependencies)))
+    return transfer_syntax
+
+
+def get_available_transfer_syntaxes() -> list:
+    '''
+    Get the names of TRANSFER_SYNTAXES whose encoder is available, cf get_transfer_syntax.
+    '''
+    available = []
+    for name in TRANSFER_SYNTAXES:
+        try:
+            get_transfer_syntax(name)
+        except ValueError:
+            continue
+        available.append(name)
+    return available
+
+
+def transcode_dataset(dataset: pydicom.Dataset, transfer_syntax: pydicom.uid.UID) -> tuple:
+    '''
+    Compress the pixel data of a dataset in place, if it is uncompressed, cf module documentation.
+
+    Returns
+    -------
+    t : tuple
+        (status, raw bytes, encoded bytes, encode seconds) where status is 'encoded',
+        'compressed' (already compressed), 'big_endian', 'no_pixel_data' or 'failed'
+        (the encoder raised an error, the dataset is left unchanged). The encoded bytes
+        are the raw bytes when the dataset is not encoded.
+    '''
+    if 'PixelData' not in dataset:
+        return 'no_pixel_data', 0, 0, 0.0
+    raw_size = len(dataset.PixelData)
+    if dataset.file_meta.TransferSyntaxUID.is_compressed:
+        return 'compressed', raw_size, raw_size, 0.0
+    if not dataset.is_little_endian:
+        return 'big_endian', raw_size, raw_size, 0.0
+
+    start = time.perf_counter()
+    try:
+        # The pixel data and the transfer syntax are only replaced once encoded
+        dataset.compress(transfer_syntax)
+    except Exception as e:
+        print('Warning, pixel data not compressed to {}, kept as is: {}'.format(transfer_syntax.name, e))
+        return 'failed', raw_size, raw_size, time.perf_counter() - start
+    return 'encoded', raw_size, len(dataset.PixelData), time.perf_counter() - start
+
+
+class TranscodingReport:
+    '''
+    Per-file results of transcode_dataset, possibly added by several threads.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = []
+
+    def add(self, path: str, result: tuple) -> None:
+        '''
+        Add the result of transcode_dataset for a file.
+        '''
+        status, raw_size, encoded_size, seconds = result
+        with self.lock:
+            self.rows.append([path, status, raw_size, encoded_size, raw_size / encoded_size if encoded_size else 1.0, seconds])
+
+    def pop_rows(self) -> list:
+        '''
+        Get the rows added so far and forget them, e.g. to send the results of a worker
+        process to the main process after each file.
+        '''
+        with self.lock:
+            rows = self.rows
+            self.rows = []
+        return rows
+
+    def extend(self, rows: list) -> None:
+        '''
+        Add rows of another report, e.g. of a worker process.
+        '''
+        with self.lock:
+            self.rows.extend(rows)
+
+    def get_summary(self) -> dict:
+        '''
+        Get the number of files by status and the total sizes, ratio and encoding time of the encoded files.
+        '''
+        with self.lock:
+            encoded = [row for row in self.rows if row[1] == 'encoded']
+            statuses = {}
+            for row in self.rows:
+                statuses[row[1]] = statuses.get(row[1], 0) + 1
+        raw_size = sum(row[2] for row in encoded)
+        encoded_size = sum(row[3] for row in encoded)
+        return {
+            'files': statuses,
+            'raw_bytes': raw_size,
+            'encoded_bytes': encoded_size,
+            'ratio': raw_size / encoded_size if encoded_size else 1.0,
+            'encode_seconds': sum(row[5] for row in encoded),
+        }
+
+    def print_summary(self) -> None:
+        '''
+        Print the summary of the transcoding.
+        '''
+        summary = self.get_summary()
+        print('Transcoding: {}, {:.1f} MB -> {:.1f} MB (ratio {:.2f}), encode time {:.2f} s'.format(
+            ', '.join('{} {}'.format(count, status) for status, count in sorted(summary['files'].items())),
+            summary['raw_bytes'] / (1024 * 1024), summary['encoded_bytes'] / (1024 * 1024), summary['ratio'],
+            summary['encode_seconds']))
+
+    def write_csv(self, path: str) -> None:
+        '''
+        Write the per-file report to a csv file.
+        '''
+        with self.lock, open(path, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(REPORT_HEADER)
+            writer.writerows(self.rows)
@@ -0,0 +1,269 @@
+'''
+Continuous anonymization of the files dropped in a spool folder (watch-folder mode).
+
+The input tree is polled every `poll_interval` seconds. A new file is anonymized once
+its size and modification time have not changed for `settle_time` seconds, so that
+files still being written by a modality are not read. Once anonymized, the input file
+is moved to the done folder (with the same relative path), so that each poll only
+sees the files which arrived since the last one. The rules are compiled once and the
+lookup table (or store) stays open for the whole run.
+
+The ingest latency of a file is the time between its first detection by a poll and
+the end of the write of its anonymized copy, it includes the settle time. The queue
+depth is the number of files detected but not processed yet.
+'''
+
+import os
+import shutil
+import time
+from collections import deque
+
+from utils.simple_dicomanonymizer import *
+from utils.file_discovery import iter_files
+
+
+class FolderWatcher:
+    '''
+    Detection of the new files of a folder which are completely written.
+
+    Parameters
+    ----------
+    folder : str
+        Path to the folder watched recursively.
+    settle_time : float
+        Number of seconds without change after which a file is considered complete.
+    exclude : iterable of str
+        Folders not to watch, e.g. the output folder when it is inside the watched folder.
+    '''
+
+    def __init__(self, folder: str, settle_time: float = 2.0, exclude=()):
+        self.folder = folder
+        self.settle_time = settle_time
+        self.exclude = tuple(exclude)
+        # Relative path -> [size, mtime, first seen, last change]
+        self.pending = {}
+        # Relative path -> (size, mtime) of the files which could not be anonymized,
+        # only retried once modified
+        self.failed = {}
+
+    def poll(self) -> list:
+        '''
+        Scan the folder.
+
+        Returns
+        -------
+        l : list
+            (path, relative path, first seen) tuples of the complete files, in order of detection.
+        '''
+        now = time.time()
+        seen = set()
+        ready = []
+        for entry, relative_path in iter_files(self.folder, exclude=self.exclude):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError: # Removed since the folder was listed
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            seen.add(relative_path)
+            if self.failed.get(relative_path) == signature:
+                continue
+            state = self.pending.get(relative_path)
+            if state is None:
+                self.pending[relative_path] = [signature[0], signature[1], now, now]
+                continue
+            if (state[0], state[1]) != signature:
+                state[0], state[1], state[3] = signature[0], signature[1], now
+            elif now - state[3] >= self.settle_time:
+                ready.append((entry.path, relative_path, state[2]))
+
+        # Files removed or renamed before being complete
+        for relative_path in list(self.pending):
+            if relative_path not in seen:
+                del self.pending[relative_path]
+        self.failed = {relative_path: signature for relative_path, signature in self.failed.items()
+                       if relative_path in seen}
+        ready.sort(key=lambda item: item[2])
+        return ready
+
+    def done(self, relative_path: str) -> None:
+        '''
+        Forget a file which has been processed and moved.
+        '''
+        self.pending.pop(relative_path, None)
+
+    def fail(self, relative_path: str) -> None:
+        '''
+        Skip a file which could not be anonymized, until it is modified.
+        '''
+        state = self.pending.pop(relative_path, None)
+        if state is not None:
+            self.failed[relative_path] = (state[0], state[1])
+
+    def get_queue_depth(self) -> int:
+        '''
+        Get the number of files detected and not processed yet.
+        '''
+        return len(self.pending)
+
+
+class WatchStats:
+    '''
+    Counters of a watch-folder run, with the ingest latencies of the last files.
+
+    Parameters
+    ----------
+    window : int
+        Number of latencies kept for the percentiles.
+    '''
+
+    def __init__(self, window: int = 1000):
+        self.files = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.max_queue_depth = 0
+        self.latencies = deque(maxlen=window)
+
+    def add_file(self, latency: float) -> None:
+        '''
+        Count an anonymized file.
+        '''
+        self.files += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.latencies.append(latency)
+
+    def get_report(self, queue_depth: int) -> dict:
+        '''
+        Get the counters, the latencies in seconds and the current queue depth.
+        '''
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] if latencies else 0.0
+
+        return {
+            'files': self.files,
+            'failed': self.failed,
+            'mean_latency': self.total_latency / self.files if self.files else 0.0,
+            'p50_latency': percentile(0.5),
+            'p95_latency': percentile(0.95),
+            'max_latency': self.max_latency,
+            'queue_depth': queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+
+def print_watch_report(report: dict) -> None:
+    '''
+    Print a report returned by WatchStats.get_report on one line.
+    '''
+    print('{} files, {} failed, queue {} (max {}), latency (s) mean {:.2f} p50 {:.2f} p95 {:.2f} max {:.2f}'.format(
+        report['files'], report['failed'], report['queue_depth'], report['max_queue_depth'], report['mean_latency'],
+        report['p50_latency'], report['p95_latency'], report['max_latency']), flush=True)
+
+
+def watch_folder(input_folder: str, output_folder: str, done_folder: str, lookup_path: str,
+                 anonymization_actions: AnonymizationPlan, delete_private_tags: bool, rename_files: bool,
+                 header_only: bool = False, poll_interval: float = 1.0, settle_time: float = 2.0,
+                 report_every: float = 60.0, stop=None, max_files: int = None) -> dict:
+    '''
+    Anonymize the files dropped in a folder until stopped, cf module documentation.
+
+    Parameters
+    ----------
+    input_folder : str
+        Spool folder watched recursively.
+    output_folder : str
+        Folder where the anonymized files are written, with the relative path of the input file.
+    done_folder : str
+        Folder where the input files are moved once anonymized.
+    lookup_path : str
+        Path to lookup table csv path, written after each poll which anonymized files.
+    anonymization_actions : AnonymizationPlan
+        Plan of the actions that will be applied on tags.
+    delete_private_tags : bool
+        Whether to delete private tags.
+    rename_files : bool
+        Whether to remane output files with pseudo.
+    header_only : bool
+        Whether to only read the header and copy the pixel data as is.
+    poll_interval : float
+        Number of seconds between two scans of the input folder.
+    settle_time : float
+        Number of seconds without change after which a file is considered complete.
+    report_every : float
+        Number of seconds between two reports printed, 0 to only print the last one.
+    stop : threading.Event
+        Event stopping the run after the current file. If None, the run is stopped by
+        KeyboardInterrupt (Ctrl+C) or max_files.
+    max_files : int
+        Number of files after which the run stops, None for no limit.
+
+    Returns
+    -------
+    d : dict
+        The last report, cf WatchStats.get_report.
+    '''
+    set_lookup_path(lookup_path)
+    watcher = FolderWatcher(input_folder, settle_time, exclude=(output_folder, done_folder))
+    stats = WatchStats()
+    created_folders = set()
+    last_report = time.time()
+    profiler = get_profiler()
+    try:
+        while (stop is None or not stop.is_set()) and (max_files is None or stats.files < max_files):
+            poll_start = time.time()
+            ready = watcher.poll()
+            stats.max_queue_depth = max(stats.max_queue_depth, watcher.get_queue_depth())
+
+            for in_file, relative_path, first_seen in ready:
+                if (stop is not None and stop.is_set()) or (max_files is not None and stats.files >= max_files):
+                    break
+                out_file = output_folder + '/' + relative_path
+                done_file = done_folder + '/' + relative_path
+                for folder in (os.path.dirname(out_file), os.path.dirname(done_file)):
+                    if folder not in created_folders:
+                        os.makedirs(folder, exist_ok=True)
+                        created_folders.add(folder)
+                try:
+                    anonymize_dicom_file(in_file, out_file, lookup_path, anonymization_actions, delete_private_tags,
+                                         rename_files, header_only)
+                except Exception as e:
+                    print('Error, cannot anonymize', in_file, ':', e, flush=True)
+                    if profiler is not None:
+                        profiler.end_file()
+                    stats.failed += 1
+                    watcher.fail(relative_path)
+                    continue
+                latency = time.time() - first_seen
+                try:
+                    # Copied then removed if the done folder is on another file system
+                    shutil.move(in_file, done_file)
+                except OSError as e:
+                    # The anonymized copy is kept, the file is retried once modified
+                    print('Error, cannot move', in_file, 'to the done folder:', e, flush=True)
+                    stats.failed += 1
+                    watcher.fail(relative_path)
+                    continue
+                stats.add_file(latency)
+                watcher.done(relative_path)
+
+            # The rows added by the files of this poll are written before the next one
+            if ready and lookup_path is not None:
+                get_lookup_table().flush()
+
+            now = time.time()
+            if report_every and now - last_report >= report_every:
+                print_watch_report(stats.get_report(watcher.get_queue_depth()))
+                last_report = now
+            if not ready:
+                time.sleep(max(0.0, poll_interval - (now - poll_start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_lookup_table()
+
+    report = stats.get_report(watcher.get_queue_depth())
+    print_watch_report(report)
+    return report